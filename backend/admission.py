@@ -0,0 +1,166 @@
+"""
+アドミッション制御（Gemini / Embedding / TTS の同時実行数制限と順番待ち）
+
+- 依存先ごとに同時実行数の上限を持ち、超えた分は待ち行列に並ぶ
+- 待ち行列はセッションごとのラウンドロビン（Discordの連投でブラウザが待たされ続けない）
+- 待ち行列が満杯なら QueueFull（stream_chat では 429 + Retry-After）
+- 待ち行列の長さ・待ち時間は backend.metrics から見える
+
+上限はプロセスごと。MIO_WORKERS で複数ワーカーにする場合はワーカー数で割った値を設定すること。
+"""
+import os
+import time
+import asyncio
+import contextlib
+from collections import OrderedDict, deque
+
+from backend import metrics
+
+
+class QueueFull(Exception):
+    """待ち行列が満杯"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} queue is full")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """待ち行列の整理券"""
+
+    def __init__(self, limiter, session):
+        self.limiter = limiter
+        self.session = session
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+
+    @property
+    def granted(self):
+        return self.future.done() and not self.future.cancelled()
+
+    def position(self):
+        """自分より先に呼ばれる人数（0 = 次）"""
+        return self.limiter._position(self)
+
+    async def wait(self, timeout=None):
+        """順番が来たら True。timeout 秒待っても来なければ False"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def release(self):
+        """実行枠を返す。まだ並んでいる場合は列から抜ける"""
+        if self.released:
+            return
+        self.released = True
+        if self.granted:
+            self.limiter._release(self)
+        else:
+            self.limiter._remove(self)
+
+
+class FairLimiter:
+    """依存先ひとつ分の同時実行数制限 + セッション単位のラウンドロビン待ち行列"""
+
+    def __init__(self, name, limit, max_queue):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.queues = OrderedDict()  # session -> deque[Ticket]（先頭のセッションが次に呼ばれる）
+        self.waiting = 0
+        self.rejected = 0
+        self.wait_time = metrics.summary("mio_admission_wait_seconds", dependency=name)
+        self.service_time = deque(maxlen=50)  # Retry-After の見積もり用
+        metrics.register_gauge("mio_admission_active", lambda: self.active, dependency=name)
+        metrics.register_gauge("mio_admission_queue_depth", lambda: self.waiting, dependency=name)
+        metrics.register_counter("mio_admission_rejected_total", lambda: self.rejected, dependency=name)
+
+    def enqueue(self, session="default"):
+        """整理券を発行する。空きがあれば即実行可能、満杯なら QueueFull"""
+        ticket = Ticket(self, session)
+        if self.active < self.limit and self.waiting == 0:
+            self._grant(ticket)
+            return ticket
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.name, self.retry_after())
+        self.queues.setdefault(session, deque()).append(ticket)
+        self.waiting += 1
+        return ticket
+
+    @contextlib.asynccontextmanager
+    async def slot(self, session="default"):
+        """順番が来るまで待ってから実行枠を確保する"""
+        ticket = self.enqueue(session)
+        try:
+            await ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    def retry_after(self):
+        """待ち行列がはけるまでのおおよその秒数"""
+        avg = sum(self.service_time) / len(self.service_time) if self.service_time else 5.0
+        return max(1, int(avg * (self.waiting + 1) / max(self.limit, 1)))
+
+    def _grant(self, ticket):
+        self.active += 1
+        self.wait_time.observe(time.monotonic() - ticket.enqueued_at)
+        ticket.granted_at = time.monotonic()
+        ticket.future.set_result(True)
+
+    def _release(self, ticket):
+        self.active -= 1
+        self.service_time.append(time.monotonic() - ticket.granted_at)
+        self._dispatch()
+
+    def _remove(self, ticket):
+        queue = self.queues.get(ticket.session)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[ticket.session]
+
+    def _dispatch(self):
+        # ラウンドロビン: 先頭セッションの1件を呼び、まだ残っていれば末尾へ回す
+        while self.active < self.limit and self.queues:
+            session, queue = self.queues.popitem(last=False)
+            ticket = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self.queues[session] = queue
+            if not ticket.future.done():
+                self._grant(ticket)
+
+    def _position(self, ticket):
+        queue = self.queues.get(ticket.session)
+        if not queue or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        order = list(self.queues)
+        mine = order.index(ticket.session)
+        ahead = index
+        for i, session in enumerate(order):
+            if i == mine:
+                continue
+            # 自分の番 (index 周目) までに、前のセッションは index+1 件、後ろのセッションは index 件呼ばれる
+            ahead += min(len(self.queues[session]), index + 1 if i < mine else index)
+        return ahead
+
+
+def _limiter(name, default_limit, default_queue):
+    limit = int(os.getenv(f"MIO_LIMIT_{name.upper()}", str(default_limit)))
+    max_queue = int(os.getenv(f"MIO_QUEUE_{name.upper()}", str(default_queue)))
+    return FairLimiter(name, limit, max_queue)
+
+
+# 依存先ごとの制限（環境変数 MIO_LIMIT_CHAT / MIO_QUEUE_CHAT などで変更可）
+chat_limiter = _limiter("chat", 2, 8)
+embedding_limiter = _limiter("embedding", 4, 32)
+tts_limiter = _limiter("tts", 2, 32)
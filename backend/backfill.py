@@ -0,0 +1,143 @@
+"""
+ベクトルの後埋め（バックフィル）
+
+Embedding API が一時的に失敗した発言は embedding=NULL で保存され、そのままだと RAG から見えない。
+- 定期的に（と /api/memory/backfill で手動でも）ベクトルのない行を探して、まとめてベクトル化する
+- 今のモデルのベクトルがない行も作る（モデルを変えたとき全件やり直し。前のモデルのベクトルは残すので戻すときは不要）
+- API を呼ぶプロバイダではバッチの間を MIO_BACKFILL_INTERVAL 秒空ける（ローカルのプロバイダは待たない）
+- 失敗したら指数バックオフで再試行する
+- 複数ワーカーでも同時に動くのは1つだけ（ファイルロック）
+"""
+import os
+import time
+import random
+import asyncio
+
+from backend.database import db
+from backend.locks import file_lock, LockBusy
+from backend.admission import embedding_limiter
+from backend import embeddings
+
+BACKFILL_PERIOD = float(os.getenv("MIO_BACKFILL_PERIOD", "300"))     # 定期実行の間隔（秒）。0 = 起動時と手動のみ
+BACKFILL_BATCH = int(os.getenv("MIO_BACKFILL_BATCH", "32"))          # 1回の API 呼び出しでベクトル化する件数
+BACKFILL_INTERVAL = float(os.getenv("MIO_BACKFILL_INTERVAL", "2"))   # バッチ間の待ち（秒）。API を呼ぶプロバイダのみ
+BACKFILL_RETRIES = int(os.getenv("MIO_BACKFILL_RETRIES", "5"))
+BACKFILL_RETRY_BASE = float(os.getenv("MIO_BACKFILL_RETRY_BASE", "2"))  # 再試行の最初の待ち（秒）。失敗するたびに倍
+BACKFILL_MAX_BACKOFF = 300.0
+
+TABLES = ("conversation_logs", "conversation_archive")
+
+
+class BackfillWorker:
+    def __init__(self, provider=None, interval=None, retry_base=BACKFILL_RETRY_BASE):
+        provider = provider or embeddings.provider
+        self.embed = provider.embed_texts
+        self.model = provider.model
+        # ローカルのプロバイダは API の制限がないので、バッチの間で待たない
+        self.interval = (BACKFILL_INTERVAL if provider.remote else 0.0) if interval is None else interval
+        self.retry_base = retry_base
+        self.running = False
+        self.progress = {}  # テーブル -> {"done", "failed", "total"}
+        self.last_run = None
+        self.last_error = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    async def _embed_with_retry(self, texts):
+        for attempt in range(BACKFILL_RETRIES + 1):
+            try:
+                # 会話のベクトル化より優先しないよう、専用セッションとして順番待ちする
+                async with embedding_limiter.slot("backfill"):
+                    return await self.embed(texts)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                if attempt == BACKFILL_RETRIES:
+                    raise
+                delay = min(BACKFILL_MAX_BACKOFF, self.retry_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                print(f"⚠ [Backfill] Embedding failed ({self.last_error}). Retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _backfill_table(self, table):
+        pending = await db.count_missing_embeddings(self.model)
+        progress = self.progress[table] = {"done": 0, "failed": 0, "total": pending[table]}
+        after_id = 0
+        while True:
+            rows = await db.find_missing_embeddings(table, self.model, after_id, BACKFILL_BATCH)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            texts = [content for _, content in rows]
+            try:
+                vectors = await self._embed_with_retry(texts)
+            except Exception:
+                # このバッチは諦めて次へ（次回の実行でまた拾われる）
+                progress["failed"] += len(rows)
+                continue
+            progress["done"] += await db.update_embeddings(
+                table, [(row_id, vec) for (row_id, _), vec in zip(rows, vectors)], self.model
+            )
+            await asyncio.sleep(self.interval)  # 0 でも他の処理に順番を回す
+
+    async def run_once(self):
+        """1回分の後埋めを実行する。別のワーカーが実行中なら何もしない"""
+        try:
+            async with file_lock("embedding_backfill", blocking=False):
+                self.running = True
+                self.last_error = None
+                started = time.time()
+                try:
+                    for table in TABLES:
+                        await self._backfill_table(table)
+                finally:
+                    self.running = False
+                    self.last_run = started
+        except LockBusy:
+            return False
+        done = sum(p["done"] for p in self.progress.values())
+        failed = sum(p["failed"] for p in self.progress.values())
+        if done or failed:
+            print(f"[Backfill] Embedded {done} rows ({failed} failed) with {self.model}")
+        return True
+
+    async def _loop(self, period):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"[Backfill] Error: {self.last_error}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), period if period > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self, period=BACKFILL_PERIOD):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(period))
+
+    def trigger(self):
+        """次の実行を今すぐ始める"""
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def status(self):
+        return {
+            "model": self.model,
+            "running": self.running,
+            "pending": await db.count_missing_embeddings(self.model),
+            "progress": self.progress,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+
+worker = BackfillWorker()
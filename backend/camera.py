@@ -0,0 +1,41 @@
+"""
+カメラ連携 (Tapo)
+
+import cv2 がとても重いので、実際に撮影するとき（スレッド内）で初めて import する。
+"""
+import os
+import base64
+import urllib.parse
+
+TAPO_IP = os.getenv("TAPO_IP", "")
+TAPO_USER = os.getenv("TAPO_USER", "")
+TAPO_PASSWORD = os.getenv("TAPO_PASSWORD", "")
+
+
+def is_configured():
+    return bool(TAPO_IP and TAPO_USER and TAPO_PASSWORD)
+
+
+def capture_snapshot():
+    """RTSPから1フレーム取得してJPEG(Base64)で返す（ブロッキング処理なのでスレッドで呼ぶこと）"""
+    import cv2 # カメラ処理用（初回だけ重い）
+
+    encoded_user = urllib.parse.quote(TAPO_USER)
+    encoded_pass = urllib.parse.quote(TAPO_PASSWORD)
+    rtsp_url = f"rtsp://{encoded_user}:{encoded_pass}@{TAPO_IP}:554/stream1"
+    
+    print(f"📸 Connecting to: rtsp://{encoded_user}:****@{TAPO_IP}:554/stream1")
+    
+    cap = cv2.VideoCapture(rtsp_url)
+    if not cap.isOpened():
+        return None, "Could not open RTSP stream"
+        
+    ret, frame = cap.read()
+    cap.release()
+    
+    if not ret:
+        return None, "Failed to read frame"
+        
+    _, buffer = cv2.imencode('.jpg', frame)
+    img_b64 = base64.b64encode(buffer).decode('utf-8')
+    return img_b64, None
@@ -0,0 +1,221 @@
+"""
+記憶のコンパクション（司書AI + 編纂AI）
+
+Gemini SDK を使うので、エンドポイントが呼ばれたときに遅延ロードする。
+"""
+import os
+import json
+
+from backend import gemini
+from backend.database import db
+from backend.locks import file_lock, LockBusy, write_file_atomic
+from backend.memory_sections import MemoryDoc, select_context, format_context, apply_ops
+from backend.model_chain import ModelChain, COMPACTION_MODELS, COMPACTION_DEADLINE_MS
+
+
+def read_memory_file(filepath):
+    if not os.path.exists(filepath):
+        return ""
+    with open(filepath, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+async def run_compaction():
+    """司書AIで会話ログを分析し、編纂AIで長期記憶ファイルを更新する（全ワーカーで同時に1つだけ）"""
+    try:
+        async with file_lock("compaction", blocking=False):
+            return await _run_compaction()
+    except LockBusy:
+        return {"status": "error", "message": "Compaction is already running."}
+
+
+async def _run_compaction():
+    print("--- Starting Advanced Compaction ---")
+    
+    # 1. 会話ログを全取得
+    logs = await db.get_recent_context(limit=1000) # 十分な量を取得
+    if not logs:
+        return {"status": "ok", "message": "No logs to compact.", "token_usage": 0}
+
+    # テキスト化
+    conversation_text = ""
+    for log in logs:
+        conversation_text += f"{log['role']}: {log['content']}\n"
+
+    # 2. 司書AI (Librarian) による分析
+    librarian_prompt = """
+    あなたは会話ログ整理の専門AI（司書）です。以下の会話ログを分析し、長期記憶ファイルに保存すべき重要な情報を抽出してください。
+    
+    【重要ルール：情報の振り分け】
+    以下の3つのカテゴリに情報を厳密に振り分けてください。**同じ情報を複数のカテゴリに入れないこと。**
+
+    1. **user_updates (ユーザー情報)**:
+       - ユーザーのプロフィール、性格、好み、癖、思想、身体的特徴、仕事、家族構成など。
+       - 「ユーザーそのもの」に関する不変または半永久的な属性情報。
+       - 例：「リンゴが好き」「プログラマーである」「猫派」
+
+    2. **identity_updates (AIアイデンティティ)**:
+       - AI（MIO）自身の性格、話し方、行動指針、ユーザーに対する呼び名や態度、自分ルール。
+       - 「AI自身」に関する自己定義のみ。
+       - 例：「のんびり屋である」「～だよ口調を使う」「ユーザーをマスターと呼ぶ」
+
+    3. **memory_updates (長期記憶・エピソード)**:
+       - 過去に起こった具体的な出来事、約束、会話したトピック、一緒に行った場所、特定の文脈での合意事項。
+       - **※ユーザーのプロフィール的情報はここには含めず、user_updatesに入れてください。**
+       - 例：「遊園地に行く約束をした」「AI倫理について議論した」「2024年の誕生日の思い出」
+
+    【出力形式】
+    以下のJSON形式で出力してください：
+    {
+      "user_updates": ["追加すべきユーザーの事柄"],
+      "identity_updates": ["追加すべきAI自身の事柄"],
+      "memory_updates": ["追加すべきイベントや知識"],
+      "summary": "会話全体の簡潔な要約（100文字以内）"
+    }
+    """
+    
+    token_usage = {"prompt_token_count": 0, "candidates_token_count": 0, "total_token_count": 0}
+    updates = {}
+    models_used = {}  # 工程ごとに使ったモデル（フォールバックの記録つき）
+    changes = {}      # ファイルごとの差分の件数 (added / updated / deleted / skipped)
+    
+    if gemini.GEMINI_API_KEY:
+        try:
+            # 分析用モデル（遅い/混んでいるときは次のモデルへ）
+            librarian = ModelChain(
+                COMPACTION_MODELS,
+                lambda name: gemini.genai.GenerativeModel(
+                    name,
+                    system_instruction=librarian_prompt,
+                    generation_config={"response_mime_type": "application/json"}
+                ),
+                deadline_ms=COMPACTION_DEADLINE_MS
+            )
+            
+            resp, models_used["librarian"] = await librarian.generate(conversation_text)
+            
+            # トークン使用量の取得（詳細）
+            if resp.usage_metadata:
+                token_usage = {
+                    "prompt_token_count": resp.usage_metadata.prompt_token_count,
+                    "candidates_token_count": resp.usage_metadata.candidates_token_count,
+                    "total_token_count": resp.usage_metadata.total_token_count
+                }
+            
+            updates = json.loads(resp.text)
+            print(f"Librarian Analysis: {updates}")
+            
+            # 3. 編纂AI (Compiler) による情報の統合と更新
+            #    ファイル全体ではなく、新しい情報に関係するセクションだけを見せて差分 (JSON) をもらう
+            compiler_model = ModelChain(
+                COMPACTION_MODELS,
+                lambda name: gemini.genai.GenerativeModel(
+                    name,
+                    generation_config={"response_mime_type": "application/json"}
+                ),
+                deadline_ms=COMPACTION_DEADLINE_MS
+            )
+
+            async def update_file(filepath, new_info_list, category_name):
+                if not new_info_list: return
+                
+                # 既存の内容を読み込んで、セクション/エントリに分ける
+                doc = MemoryDoc.parse(read_memory_file(filepath))
+                selected = select_context(doc, new_info_list)
+                visible_ids = {entry.id for entries in selected.values() for entry in entries}
+                
+                # 統合プロンプト
+                compiler_prompt = f"""
+                あなたは記憶ファイルの編纂者です。
+                以下の「現在のファイル内容（関係する部分のみ）」と「新しく判明した情報」を元に、ファイルへの変更を差分として出力してください。
+                
+                【現在のファイル内容 ({category_name})】
+                {format_context(doc, selected)}
+                
+                【新しく判明した情報】
+                {json.dumps(new_info_list, ensure_ascii=False)}
+                
+                【編集ルール】
+                1. 情報が重複している場合は、既存のエントリを update して一つにまとめてください（重複した方は delete）。
+                2. 新しい情報が既存の情報と矛盾する場合、新しい情報を優先して既存のエントリを update してください。
+                3. 新しい情報は、内容の合うセクションに add してください。合うセクションがなければ add_section で見出しを作ってください。
+                4. update / delete できるのは、上に [e-...] の ID つきで表示されたエントリだけです。
+                5. 変更の必要がないエントリは出力しないでください。
+                
+                【出力形式】
+                以下のJSON形式で出力してください：
+                {{
+                  "ops": [
+                    {{"op": "add", "section": "セクションID", "text": "追加する内容"}},
+                    {{"op": "add_section", "heading": "新しい見出し", "entries": ["内容", "..."]}},
+                    {{"op": "update", "id": "エントリID", "text": "書き換え後の内容"}},
+                    {{"op": "delete", "id": "エントリID"}}
+                  ]
+                }}
+                """
+                
+                try:
+                    # 編纂実行
+                    resp, models_used[category_name] = await compiler_model.generate(compiler_prompt)
+                    ops = json.loads(resp.text).get("ops")
+                    
+                    # トークン計算（加算）
+                    if resp.usage_metadata:
+                        token_usage["prompt_token_count"] += resp.usage_metadata.prompt_token_count
+                        token_usage["candidates_token_count"] += resp.usage_metadata.candidates_token_count
+                        token_usage["total_token_count"] += resp.usage_metadata.total_token_count
+
+                    async with file_lock("memory_files"):
+                        # 編纂中に手で書き換えられていてもいいように、ロックの中で読み直してから当てる
+                        doc = MemoryDoc.parse(read_memory_file(filepath))
+                        before = doc.entry_count()
+                        stats = apply_ops(doc, ops, visible_ids)
+                        changes[category_name] = stats
+
+                        # 全部消えるような差分は当てない（安全策）
+                        if before and not doc.entry_count():
+                            print(f"⚠ Warning: Diff for {category_name} would empty the file, skipping update.")
+                        elif stats["added"] or stats["updated"] or stats["deleted"]:
+                            write_file_atomic(filepath, doc.render())
+                            print(f"★ Updated {category_name} Memory (編纂完了: {stats})")
+                        else:
+                            print(f"[Compaction] No changes for {category_name} ({stats})")
+                        
+                except Exception as e:
+                    print(f"Compiler Error ({category_name}): {e}")
+
+            # 各カテゴリごとに更新を実行
+            await update_file("memory/USER.md", updates.get("user_updates"), "User Profile")
+            await update_file("memory/IDENTITY.md", updates.get("identity_updates"), "AI Identity")
+            await update_file("memory/MEMORY.md", updates.get("memory_updates"), "Long Term Memory")
+
+            # 4. コンパクション履歴の保存
+            summary_text = updates.get("summary", "No summary provided.")
+            await db.log_compaction(
+                summary=summary_text,
+                start_id=0, 
+                end_id=0,   
+                token_usage=token_usage.get("total_token_count", 0),
+                added_memories=updates
+            )
+            
+            # 5. 短期記憶をアーカイブへ移動 (Compaction成功時のみ)
+            #    消さずに圧縮して残すので、RAGで後から一言一句思い出せる
+            #    司書AIに渡した分だけ移す（コンパクション中に届いた発言は次回に回す）
+            await db.archive_logs(up_to_id=logs[-1]["id"])
+            await db.apply_archive_retention()
+
+        except Exception as e:
+            import traceback
+            error_detail = traceback.format_exc()
+            print(f"Compaction Error: {error_detail}")
+            return {"status": "error", "message": f"Compaction process failed: {str(e)}"}
+    
+    return {
+        "status": "ok", 
+        "message": "Smart Compaction complete.",
+        "updates": updates,
+        "token_usage": token_usage,
+        "models": models_used,
+        "changes": changes
+    }
@@ -1,17 +1,136 @@
 import aiosqlite
+import asyncio
 import time
 import json
 import os
+import re
+import zlib
+import unicodedata
+import numpy as np
+
+from backend.locks import file_lock
 
 DB_PATH = "mio_memory.db"
+DB_BUSY_TIMEOUT = float(os.getenv("MIO_DB_BUSY_TIMEOUT", "30"))  # 書き込み待ちの最大秒数
+IMAGE_TTL = float(os.getenv("MIO_IMAGE_TTL", "3600"))  # アップロード画像の保持秒数
+LEGACY_EMBEDDING_MODEL = "models/gemini-embedding-001"  # embedding_model カラム追加前のベクトルを作ったモデル
+# ベクトルは (行, モデル) ごとに別テーブルに持つ。モデルを変えても前のベクトル空間は上書きされない
+VECTOR_TABLES = {"conversation_logs": "log_vectors", "conversation_archive": "archive_vectors"}
+
+# --- アーカイブ（コンパクション済みログ）の保持ポリシー ---
+ARCHIVE_RETENTION_DAYS = float(os.getenv("MIO_ARCHIVE_RETENTION_DAYS", "0"))  # 0 = 無期限
+ARCHIVE_MAX_ROWS = int(os.getenv("MIO_ARCHIVE_MAX_ROWS", "0"))                # 0 = 無制限
+
+
+# --- 全文検索 (FTS5 trigram) ---
+LEXICAL_MIN_COVERAGE = float(os.getenv("MIO_LEXICAL_MIN_COVERAGE", "0.2"))  # クエリのトライグラムの何割が一致すれば採用するか
+RRF_K = 60  # Reciprocal Rank Fusion の定数
+
+_HIRAGANA_ONLY = re.compile(r"^[\u3040-\u309f]+$")
+_SEGMENT_SPLIT = re.compile(r"[\s\W_]+")
+
+
+def query_trigrams(text, max_terms=48):
+    """検索クエリをトライグラムに分解する
+
+    ひらがなだけのトライグラム（「ってる」「だよね」など）はほぼ全ての発言に出てくるので、
+    固有名詞などを含むトライグラムがあればそちらだけを使う。
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    grams = []
+    for segment in _SEGMENT_SPLIT.split(text):
+        for i in range(len(segment) - 2):
+            gram = segment[i:i + 3]
+            if gram not in grams:
+                grams.append(gram)
+    informative = [g for g in grams if not _HIRAGANA_ONLY.match(g)]
+    return (informative or grams)[:max_terms]
+
+
+def quantize_embedding(vector):
+    """float ベクトルを int8 + スケールに量子化する（float32比で約1/4のサイズ）"""
+    vec = np.asarray(vector, dtype=np.float32)
+    max_abs = float(np.abs(vec).max()) if vec.size else 0.0
+    scale = max_abs / 127 if max_abs > 0 else 1.0
+    quantized = np.clip(np.rint(vec / scale), -127, 127).astype(np.int8)
+    return quantized.tobytes(), scale
+
+
+def dequantize_embedding(blob, scale):
+    return np.frombuffer(blob, dtype=np.int8).astype(np.float32) * scale
+
+
+def import_key(table, row):
+    """インポートで「同じ記録」とみなすキー（同じエクスポートを何度取り込んでも重複させない）"""
+    if table == "memory_summaries":
+        return float(row["created_at"]), row["summary"]
+    return float(row["timestamp"]), row["role"], row["content"]
+
+
+def hamming_distance(a, b):
+    """64bit 知覚ハッシュ（符号付き）の違うビット数"""
+    return ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def embedding_filter(model):
+    """ベクトルテーブル (別名 v) の WHERE 句と引数（model を指定するとそのベクトル空間だけ）"""
+    if model is None:
+        return "1", ()
+    return "v.model = ?", (model,)
+
+def _filter_lexical(rows, grams, min_coverage, limit):
+    """クエリのトライグラムが min_coverage 以上含まれる行だけ残す [(id, 本文, 時刻, bm25)]"""
+    results = []
+    for row_id, content, timestamp, rank in rows:
+        normalized = unicodedata.normalize("NFKC", content).lower()
+        coverage = sum(1 for g in grams if g in normalized) / len(grams)
+        if coverage >= min_coverage:
+            results.append({"id": row_id, "content": content, "bm25": rank, "coverage": coverage, "timestamp": timestamp})
+    return results[:limit]
+
+def _to_archive_rows(rows, vectors, archived_at):
+    """conversation_logs の行とベクトルをアーカイブ用にする（本文は zlib 圧縮、ベクトルは int8 量子化）
+
+    アーカイブの id は挿入するまで分からないので、ベクトルは (rows の何番目か, モデル, int8, スケール) で返す。
+    """
+    index = {row[0]: i for i, row in enumerate(rows)}
+    archive_rows = [
+        (role, zlib.compress(content.encode("utf-8"), 9), timestamp, metadata, archived_at)
+        for _, role, content, timestamp, metadata in rows
+    ]
+    archive_vectors = []
+    for row_id, model, vector_json in vectors:
+        vec = json.loads(vector_json)
+        if vec and row_id in index:
+            archive_vectors.append((index[row_id], model, *quantize_embedding(vec)))
+    return archive_rows, archive_vectors
 
 class ConversationDB:
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
+        self._archive_cache = {} # モデル -> (キー, ids, 行列, ノルム)。ベクトル空間ごとに別の索引
+        self.fts_enabled = False
+
+    def _connect(self):
+        """接続を開く
+
+        複数ワーカーでも安全なように、書き込みトランザクションは最初から
+        書き込みロックを取る (BEGIN IMMEDIATE)。取れなければ busy_timeout まで順番待ち。
+        WAL モードなので読み込みは書き込み中でもブロックされない。
+        """
+        return aiosqlite.connect(self.db_path, timeout=DB_BUSY_TIMEOUT, isolation_level="IMMEDIATE")
 
     async def init_db(self):
         """データベースとテーブルの初期化"""
-        async with aiosqlite.connect(self.db_path) as db:
+        # 複数ワーカーが同時に起動してもマイグレーションは1プロセスずつ
+        async with file_lock("db_init"):
+            await self._init_db()
+
+    async def _init_db(self):
+        async with self._connect() as db:
+            # 読み込みと書き込みを並行できる WAL モード（設定はDBファイルに残る）
+            await db.execute("PRAGMA journal_mode=WAL")
+
             # 会話ログテーブル
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS conversation_logs (
@@ -19,16 +138,9 @@ class ConversationDB:
                     role TEXT NOT NULL,         -- 'user' or 'assistant' or 'system'
                     content TEXT NOT NULL,      -- 会話内容
                     timestamp REAL NOT NULL,    -- UNIXタイムスタンプ
-                    metadata TEXT,              -- その他の情報（JSON形式）
-                    embedding TEXT              -- ベクトルデータ（JSON配列）
+                    metadata TEXT               -- その他の情報（JSON形式）
                 )
             """)
-            
-            # 既存のテーブルに embedding カラムがない場合のマイグレーション
-            try:
-                await db.execute("ALTER TABLE conversation_logs ADD COLUMN embedding TEXT")
-            except Exception:
-                pass # 既にある場合は無視
 
             # 記憶要約（コンパクション）履歴テーブル
             await db.execute("""
@@ -50,16 +162,282 @@ class ConversationDB:
             except Exception:
                 pass
 
+            # コンパクション済みログのアーカイブ（本文はzlib圧縮。ベクトルは archive_vectors に int8 量子化で持つ）
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    role TEXT NOT NULL,
+                    content BLOB NOT NULL,      -- zlib圧縮した会話内容
+                    timestamp REAL NOT NULL,
+                    metadata TEXT,
+                    archived_at REAL NOT NULL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_timestamp ON conversation_archive(timestamp)")
+
+            # ベクトル（行 x モデル）。モデルごとに別のベクトル空間として共存させる
+            await self._init_vectors(db)
+
+            # アップロード画像（ワーカー間で共有するためDBに置く）
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_images (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,         -- Base64
+                    created_at REAL NOT NULL
+                )
+            """)
+            try:
+                await db.execute("ALTER TABLE uploaded_images ADD COLUMN phash INTEGER") # 知覚ハッシュ（分かっていれば）
+            except Exception:
+                pass
+
+            # 画像の説明キャッシュ（ほぼ同じカメラ画像は画像を送らずに説明文で済ませる）
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS vision_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phash INTEGER NOT NULL,     -- 64bit dHash（符号付きで保存）
+                    description TEXT NOT NULL,  -- 空文字 = 説明文を作っている途中
+                    created_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_created ON vision_cache(created_at)")
+
+            # 全文検索インデックス（日本語は単語区切りがないので trigram トークナイザー）
+            await self._init_fts(db)
+
+            # SDカード上のDBファイルを小さく保つため、空きページを少しずつ返せるようにする
+            async with db.execute("PRAGMA auto_vacuum") as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+
             await db.commit()
+
+            if auto_vacuum != 2: # 2 = INCREMENTAL
+                # 既存DBは VACUUM し直さないとモードが切り替わらない（初回のみ）
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await db.execute("VACUUM")
+                print("[DB] Switched to incremental auto_vacuum.")
+
             print(f"[DB] Initialized at {self.db_path}")
 
+    async def _init_vectors(self, db):
+        """ベクトルテーブルを作り、旧形式（行の embedding / embedding_model カラム）から移す"""
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS log_vectors (
+                row_id INTEGER NOT NULL,    -- conversation_logs.id
+                model TEXT NOT NULL,        -- ベクトルを作ったモデル（ベクトル空間）
+                vector TEXT NOT NULL,       -- JSON配列
+                PRIMARY KEY (row_id, model)
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS archive_vectors (
+                row_id INTEGER NOT NULL,    -- conversation_archive.id
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,       -- int8量子化したベクトル
+                scale REAL NOT NULL,        -- 復元用スケール
+                PRIMARY KEY (row_id, model)
+            )
+        """)
+        for table, vectors in VECTOR_TABLES.items():
+            # ベクトル空間ごとに絞り込むための索引
+            await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{vectors}_model ON {vectors}(model, row_id)")
+            # 行を消したらベクトルも消す（短期記憶の id はアーカイブ後に振り直される）
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_vectors_delete AFTER DELETE ON {table} BEGIN
+                    DELETE FROM {vectors} WHERE row_id = old.id;
+                END
+            """)
+
+        # 旧形式のDB: 行に入っていたベクトルを移して、元のカラムは消す
+        for table, vectors in VECTOR_TABLES.items():
+            async with db.execute(f"PRAGMA table_info({table})") as cursor:
+                columns = {r[1] for r in await cursor.fetchall()}
+            legacy = [c for c in ("embedding", "embedding_scale", "embedding_model") if c in columns]
+            if not legacy:
+                continue
+            if "embedding" in columns:
+                model = "COALESCE(embedding_model, ?)" if "embedding_model" in columns else "?"
+                if vectors == "log_vectors":
+                    sql = f"INSERT OR IGNORE INTO log_vectors (row_id, model, vector) SELECT id, {model}, embedding"
+                else:
+                    sql = f"INSERT OR IGNORE INTO archive_vectors (row_id, model, vector, scale) SELECT id, {model}, embedding, embedding_scale"
+                await db.execute(f"{sql} FROM {table} WHERE embedding IS NOT NULL", (LEGACY_EMBEDDING_MODEL,))
+            await db.execute(f"DROP INDEX IF EXISTS idx_{table}_embedding_model")
+            try:
+                for column in legacy:
+                    await db.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+            except Exception as e:
+                # DROP COLUMN のない SQLite (3.35未満) では中身だけ消して残す（もう読まない）
+                await db.execute(f"UPDATE {table} SET {', '.join(c + ' = NULL' for c in legacy)}")
+                print(f"[DB] Could not drop legacy columns of {table}: {e}")
+            print(f"[DB] Moved {table} embeddings to {vectors}.")
+
+    async def _init_fts(self, db):
+        """conversation_logs.content とアーカイブ本文の FTS5 インデックスを作る"""
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name='conversation_fts'") as cursor:
+            exists = await cursor.fetchone() is not None
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name='archive_fts'") as cursor:
+            archive_exists = await cursor.fetchone() is not None
+        try:
+            await db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5(
+                    content, content='conversation_logs', content_rowid='id', tokenize='trigram'
+                )
+            """)
+        except Exception as e:
+            # FTS5 / trigram が使えない SQLite (3.34未満) ではベクトル検索のみ
+            print(f"[DB] FTS5 trigram not available, lexical search disabled: {e}")
+            self.fts_enabled = False
+            return
+
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_logs_fts_insert AFTER INSERT ON conversation_logs BEGIN
+                INSERT INTO conversation_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_logs_fts_delete AFTER DELETE ON conversation_logs BEGIN
+                INSERT INTO conversation_fts(conversation_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversation_logs_fts_update AFTER UPDATE OF content ON conversation_logs BEGIN
+                INSERT INTO conversation_fts(conversation_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO conversation_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        if not exists:
+            # 既存の会話ログをインデックスに取り込む（初回のみ）
+            await db.execute("INSERT INTO conversation_fts(conversation_fts) VALUES ('rebuild')")
+            print("[DB] FTS index built.")
+
+        # アーカイブの本文は zlib 圧縮なので外部コンテンツにできない。
+        # 本文を二重に持たないよう contentless にして、アーカイブするときに平文を入れる
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(
+                content, content='', tokenize='trigram'
+            )
+        """)
+        if not archive_exists:
+            async with db.execute("SELECT id, content FROM conversation_archive") as cursor:
+                rows = await cursor.fetchall()
+            await db.executemany(
+                "INSERT INTO archive_fts(rowid, content) VALUES (?, ?)",
+                [(row_id, zlib.decompress(content).decode("utf-8")) for row_id, content in rows]
+            )
+            if rows:
+                print(f"[DB] Archive FTS index built ({len(rows)} rows).")
+        self.fts_enabled = True
+
+    async def _inserted_ids(self, db, table, count):
+        """直前に executemany で挿入した行の id（挿入順）。挿入と同じトランザクションで呼ぶ
+
+        書き込みロック中なので、末尾の count 件が今挿入した行。
+        """
+        if not count:
+            return []
+        async with db.execute(f"SELECT id FROM {table} ORDER BY id DESC LIMIT ?", (count,)) as cursor:
+            return [r[0] for r in await cursor.fetchall()][::-1]
+
+    async def _index_archive(self, db, ids, texts):
+        """アーカイブ行の本文を全文検索に入れる（挿入と同じトランザクションで呼ぶ）"""
+        if not self.fts_enabled or not texts:
+            return
+        await db.executemany("INSERT INTO archive_fts(rowid, content) VALUES (?, ?)", list(zip(ids, texts)))
+
+    async def _delete_archive(self, db, where, params=()):
+        """アーカイブ行を削除する（contentless の全文検索は元の本文を渡して消す）"""
+        if self.fts_enabled:
+            async with db.execute(f"SELECT id, content FROM conversation_archive WHERE {where}", params) as cursor:
+                rows = await cursor.fetchall()
+            await db.executemany(
+                "INSERT INTO archive_fts(archive_fts, rowid, content) VALUES ('delete', ?, ?)",
+                [(row_id, zlib.decompress(content).decode("utf-8")) for row_id, content in rows]
+            )
+        cursor = await db.execute(f"DELETE FROM conversation_archive WHERE {where}", params)
+        return cursor.rowcount
+
+    async def save_image(self, image_id, data, phash=None):
+        """アップロード画像を保存する（期限切れの画像はついでに掃除）"""
+        now = time.time()
+        async with self._connect() as db:
+            await db.execute("DELETE FROM uploaded_images WHERE created_at < ?", (now - IMAGE_TTL,))
+            await db.execute(
+                "INSERT INTO uploaded_images (id, data, created_at, phash) VALUES (?, ?, ?, ?)",
+                (image_id, data, now, phash)
+            )
+            await db.commit()
+
+    async def pop_image(self, image_id):
+        """画像を取り出して削除する（１回使ったら消す）。(Base64, 知覚ハッシュ) を返す"""
+        async with self._connect() as db:
+            # DELETE ... RETURNING で取り出しと削除を一度に（他のワーカーと取り合わない）
+            async with db.execute("DELETE FROM uploaded_images WHERE id = ? RETURNING data, phash", (image_id,)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+            return (row[0], row[1]) if row else (None, None)
+
+    async def _nearest_vision(self, db, phash, max_distance, ttl, described):
+        """ハミング距離が max_distance 以内で一番近い行 (id, 説明文, 距離)"""
+        async with db.execute(
+            f"SELECT id, phash, description FROM vision_cache WHERE created_at >= ? AND description {'!=' if described else '='} ''",
+            (time.time() - ttl,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        best = None
+        for row_id, cached, description in rows:
+            distance = hamming_distance(cached, phash)
+            if distance <= max_distance and (best is None or distance < best[2]):
+                best = (row_id, description, distance)
+        return best
+
+    async def find_vision_cache(self, phash, max_distance, ttl):
+        """ハミング距離が max_distance 以内で一番近いキャッシュを返す (説明文, 距離)"""
+        async with self._connect() as db:
+            best = await self._nearest_vision(db, phash, max_distance, ttl, described=True)
+            if best is None:
+                return None, None
+            await db.execute("UPDATE vision_cache SET hits = hits + 1 WHERE id = ?", (best[0],))
+            await db.commit()
+            return best[1], best[2]
+
+    async def claim_vision_description(self, phash, max_distance, ttl):
+        """説明文を作る権利を取る。作成中の行 (id) を返す
+
+        ほぼ同じ画像の説明文を誰か（他のワーカーも含む）が作っている途中なら None。
+        """
+        now = time.time()
+        async with self._connect() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute("DELETE FROM vision_cache WHERE created_at < ?", (now - ttl,))
+            if await self._nearest_vision(db, phash, max_distance, ttl, described=False):
+                await db.rollback()
+                return None
+            cursor = await db.execute(
+                "INSERT INTO vision_cache (phash, description, created_at) VALUES (?, '', ?)", (phash, now)
+            )
+            await db.commit()
+            return cursor.lastrowid
+
+    async def set_vision_description(self, row_id, description):
+        """作成中の行に説明文を入れる（空なら行を消して、次の画像でまた作れるようにする）"""
+        async with self._connect() as db:
+            if description:
+                await db.execute(
+                    "UPDATE vision_cache SET description = ?, created_at = ? WHERE id = ?", (description, time.time(), row_id)
+                )
+            else:
+                await db.execute("DELETE FROM vision_cache WHERE id = ?", (row_id,))
+            await db.commit()
+
     async def log_compaction(self, summary, start_id, end_id, token_usage=0, added_memories=None):
         """コンパクション履歴を保存"""
         import time
         import json
         added_json = json.dumps(added_memories) if added_memories else "{}"
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("""
                 INSERT INTO memory_summaries 
                 (summary, created_at, range_start_id, range_end_id, token_usage, added_memories)
@@ -69,7 +447,7 @@ class ConversationDB:
 
     async def get_compaction_history(self, limit=10):
         """コンパクション履歴を取得"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             async with db.execute("SELECT * FROM memory_summaries ORDER BY id DESC LIMIT ?", (limit,)) as cursor:
                 rows = await cursor.fetchall()
@@ -84,39 +462,48 @@ class ConversationDB:
                     })
                 return result
 
-    async def log_message(self, role, content, metadata=None, embedding=None):
+    async def log_message(self, role, content, metadata=None, embedding=None, embedding_model=None):
         """会話を1件保存する（ベクトル付き）"""
         meta_json = json.dumps(metadata) if metadata else None
         embed_json = json.dumps(embedding) if embedding else None
         
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT INTO conversation_logs (role, content, timestamp, metadata, embedding) VALUES (?, ?, ?, ?, ?)",
-                (role, content, time.time(), meta_json, embed_json)
+        async with self._connect() as db:
+            cursor = await db.execute(
+                "INSERT INTO conversation_logs (role, content, timestamp, metadata) VALUES (?, ?, ?, ?)",
+                (role, content, time.time(), meta_json)
             )
+            if embed_json:
+                await db.execute(
+                    "INSERT INTO log_vectors (row_id, model, vector) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, embedding_model or LEGACY_EMBEDDING_MODEL, embed_json)
+                )
             await db.commit()
             print(f"[DB] Logged: {role} -> {content[:20]}... (Vec: {'Yes' if embedding else 'No'})")
 
     async def get_recent_context(self, limit=10):
         """直近の会話履歴を取得する（古い順に並べて返す）"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             async with db.execute(
-                "SELECT role, content FROM conversation_logs ORDER BY id DESC LIMIT ?",
+                "SELECT id, role, content FROM conversation_logs ORDER BY id DESC LIMIT ?",
                 (limit,)
             ) as cursor:
                 rows = await cursor.fetchall()
                 # 取得時は新しい順なので、逆転させて古い順（時系列）にする
-                return [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+                return [{"id": r[0], "role": r[1], "content": r[2]} for r in reversed(rows)]
     
-    async def search_similar_context(self, query_vector, limit=3, threshold=0.6):
-        """ベクトル類似度検索（Cosine Similarity）"""
+    async def search_similar_context(self, query_vector, limit=3, threshold=0.6, model=None):
+        """ベクトル類似度検索（Cosine Similarity）。model を指定するとそのモデルのベクトルだけと比べる"""
         import math
         
         if not query_vector: return []
 
-        async with aiosqlite.connect(self.db_path) as db:
+        where, params = embedding_filter(model)
+        async with self._connect() as db:
             # 全件取得してPython側で計算（数千件なら爆速。数万件になったらsqlite-vec検討）
-            async with db.execute("SELECT content, embedding, timestamp FROM conversation_logs WHERE embedding IS NOT NULL") as cursor:
+            async with db.execute(f"""
+                SELECT l.id, l.content, v.vector, l.timestamp
+                FROM log_vectors v JOIN conversation_logs l ON l.id = v.row_id WHERE {where}
+            """, params) as cursor:
                 rows = await cursor.fetchall()
 
         results = []
@@ -124,7 +511,7 @@ class ConversationDB:
         query_norm = math.sqrt(sum(x*x for x in query_vector))
         if query_norm == 0: return []
 
-        for content, embed_json, timestamp in rows:
+        for row_id, content, embed_json, timestamp in rows:
             vec = json.loads(embed_json)
             if not vec: continue
 
@@ -138,15 +525,383 @@ class ConversationDB:
             similarity = dot_product / (query_norm * vec_norm)
             
             if similarity >= threshold:
-                results.append({"content": content, "similarity": similarity, "timestamp": timestamp})
+                results.append({"id": row_id, "content": content, "similarity": similarity, "timestamp": timestamp})
         
-        # 類似度順にソートして上位を返す
+        # 類似度順にソートして上位を返す（model 未指定だと同じ行が複数のベクトル空間で当たるので1回だけ）
         results.sort(key=lambda x: x["similarity"], reverse=True)
+        seen = set()
+        results = [r for r in results if not (r["id"] in seen or seen.add(r["id"]))]
+        return results[:limit]
+
+    async def archive_logs(self, up_to_id=None):
+        """会話ログをアーカイブへ移す（コンパクション後に呼ぶ）
+
+        up_to_id を指定するとその id まで（コンパクションで読んだ分）だけ移す。
+        読み出し・アーカイブへの書き込み・削除は1つの BEGIN IMMEDIATE の中で行うので、
+        途中で届いた発言を消したり二重にアーカイブしたりしない。
+        """
+        async with self._connect() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            where, params = ("WHERE id <= ?", (up_to_id,)) if up_to_id is not None else ("", ())
+            async with db.execute(
+                f"SELECT id, role, content, timestamp, metadata FROM conversation_logs {where} ORDER BY id",
+                params
+            ) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                await db.rollback()
+                return 0
+            async with db.execute("SELECT row_id, model, vector FROM log_vectors WHERE row_id <= ?", (rows[-1][0],)) as cursor:
+                vectors = await cursor.fetchall()
+
+            # 圧縮と量子化は重いのでスレッドで（書き込みロックは持ったまま）
+            archive_rows, archive_vectors = await asyncio.to_thread(_to_archive_rows, rows, vectors, time.time())
+            await db.executemany("""
+                INSERT INTO conversation_archive (role, content, timestamp, metadata, archived_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, archive_rows)
+            ids = await self._inserted_ids(db, "conversation_archive", len(archive_rows))
+            await db.executemany(
+                "INSERT INTO archive_vectors (row_id, model, vector, scale) VALUES (?, ?, ?, ?)",
+                [(ids[i], model, blob, scale) for i, model, blob, scale in archive_vectors]
+            )
+            await self._index_archive(db, ids, [r[2] for r in rows])
+            await db.execute("DELETE FROM conversation_logs WHERE id <= ?", (rows[-1][0],))
+            async with db.execute("SELECT 1 FROM conversation_logs LIMIT 1") as cursor:
+                if await cursor.fetchone() is None:
+                    await db.execute("DELETE FROM sqlite_sequence WHERE name='conversation_logs'") # 空になったらIDリセット
+            await db.commit()
+            await self._incremental_vacuum(db)
+            print(f"[DB] Archived {len(archive_rows)} logs.")
+            return len(archive_rows)
+
+    async def apply_archive_retention(self, retention_days=ARCHIVE_RETENTION_DAYS, max_rows=ARCHIVE_MAX_ROWS):
+        """保持期間・最大件数を超えた古いアーカイブを削除する"""
+        deleted = 0
+        async with self._connect() as db:
+            if retention_days > 0:
+                deleted += await self._delete_archive(db, "timestamp < ?", (time.time() - retention_days * 86400,))
+            if max_rows > 0:
+                deleted += await self._delete_archive(db, """id NOT IN (
+                    SELECT id FROM conversation_archive ORDER BY timestamp DESC LIMIT ?
+                )""", (max_rows,))
+            await db.commit()
+            if deleted:
+                await self._incremental_vacuum(db)
+                print(f"[DB] Retention: deleted {deleted} archived logs.")
+        return deleted
+
+    async def _incremental_vacuum(self, db):
+        # execute() だと1ステップ=1ページしか解放されないので executescript で最後まで回す
+        await db.executescript("PRAGMA incremental_vacuum;")
+
+    async def _load_archive_matrix(self, db, model=None):
+        """アーカイブの量子化ベクトルを行列にまとめて返す（件数が変わるまではキャッシュ）"""
+        where, params = embedding_filter(model)
+        async with db.execute(f"SELECT COUNT(*), MAX(v.rowid) FROM archive_vectors v WHERE {where}", params) as cursor:
+            key = (model, *await cursor.fetchone())
+        cached = self._archive_cache.get(model)
+        if cached and cached[0] == key:
+            return cached[1], cached[2], cached[3]
+
+        async with db.execute(
+            f"SELECT v.row_id, v.vector, v.scale FROM archive_vectors v WHERE {where}", params
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        dims = {len(r[1]) for r in rows}
+        if len(dims) > 1:
+            # 次元が違うベクトルが混ざっていたら多数派だけ使う
+            major = max(dims, key=lambda d: sum(1 for r in rows if len(r[1]) == d))
+            keep = [i for i, r in enumerate(rows) if len(r[1]) == major]
+            rows = [rows[i] for i in keep]
+            ids = ids[keep]
+        matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.int8).reshape(len(rows), -1) if rows else np.zeros((0, 0), dtype=np.int8)
+        norms = np.linalg.norm(matrix.astype(np.float32), axis=1) if rows else np.zeros(0, dtype=np.float32)
+        self._archive_cache[model] = (key, ids, matrix, norms)
+        return ids, matrix, norms
+
+    async def search_archive(self, query_vector, limit=3, threshold=0.6, model=None):
+        """アーカイブのベクトル検索
+
+        float32 のクエリと int8 のベクトルのコサイン類似度で1回だけスコアリングし、上位の本文だけ解凍して返す。
+        （行ごとのスケールはコサイン類似度では打ち消し合うので、int8 のまま掛けても復元したのと同じ値になる）
+        """
+        if not query_vector: return []
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = float(np.linalg.norm(query))
+        if query_norm == 0: return []
+
+        async with self._connect() as db:
+            ids, matrix, norms = await self._load_archive_matrix(db, model)
+            if len(ids) == 0 or matrix.shape[1] != query.shape[0]:
+                return []
+
+            scores = (matrix @ query) / (np.maximum(norms, 1e-6) * query_norm)
+            # model 未指定だと同じ行が複数のモデルのベクトルで当たるので、重複を除いて上位 limit 件
+            ranked = []
+            for i in np.argsort(-scores):
+                if scores[i] < threshold or len(ranked) >= limit:
+                    break
+                if all(row_id != ids[i] for _, row_id in ranked):
+                    ranked.append((float(scores[i]), int(ids[i])))
+            if not ranked: return []
+
+            placeholders = ",".join("?" * len(ranked))
+            async with db.execute(
+                f"SELECT id, content, timestamp FROM conversation_archive WHERE id IN ({placeholders})",
+                [row_id for _, row_id in ranked]
+            ) as cursor:
+                found = {r[0]: (r[1], r[2]) for r in await cursor.fetchall()}
+
+        return [
+            {"id": row_id, "content": zlib.decompress(found[row_id][0]).decode("utf-8"), "similarity": score, "timestamp": found[row_id][1]}
+            for score, row_id in ranked if row_id in found
+        ]
+
+    async def search_lexical(self, query_text, limit=10, min_coverage=LEXICAL_MIN_COVERAGE):
+        """FTS5 (trigram) による全文検索。BM25 順で返す"""
+        if not self.fts_enabled: return []
+        grams = query_trigrams(query_text)
+        if not grams: return []
+
+        match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+        async with self._connect() as db:
+            async with db.execute("""
+                SELECT l.id, l.content, l.timestamp, bm25(conversation_fts) AS rank
+                FROM conversation_fts JOIN conversation_logs l ON l.id = conversation_fts.rowid
+                WHERE conversation_fts MATCH ?
+                ORDER BY rank LIMIT ?
+            """, (match, limit * 3)) as cursor:
+                rows = await cursor.fetchall()
+        return _filter_lexical(rows, grams, min_coverage, limit)
+
+    async def search_archive_lexical(self, query_text, limit=10, min_coverage=LEXICAL_MIN_COVERAGE):
+        """アーカイブ（コンパクション済みの会話）の全文検索。BM25 順で返す"""
+        if not self.fts_enabled: return []
+        grams = query_trigrams(query_text)
+        if not grams: return []
+
+        match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+        async with self._connect() as db:
+            async with db.execute("""
+                SELECT a.id, a.content, a.timestamp, bm25(archive_fts) AS rank
+                FROM archive_fts JOIN conversation_archive a ON a.id = archive_fts.rowid
+                WHERE archive_fts MATCH ?
+                ORDER BY rank LIMIT ?
+            """, (match, limit * 3)) as cursor:
+                rows = await cursor.fetchall()
+        rows = [(row_id, zlib.decompress(content).decode("utf-8"), timestamp, rank) for row_id, content, timestamp, rank in rows]
+        return _filter_lexical(rows, grams, min_coverage, limit)
+
+    async def hybrid_search(self, query_text, query_vector=None, limit=3, threshold=0.6, model=None):
+        """ベクトル検索と全文検索（どちらも短期記憶+アーカイブ）を RRF で統合する
+
+        ベクトルが取れなかった（Embedding API 失敗など）ときは全文検索だけで返す。
+        """
+        ranked_lists = []
+        if query_vector:
+            ranked_lists.append(("log", await self.search_similar_context(query_vector, limit=20, threshold=threshold, model=model)))
+            ranked_lists.append(("archive", await self.search_archive(query_vector, limit=limit, threshold=threshold, model=model)))
+        if query_text:
+            ranked_lists.append(("log", await self.search_lexical(query_text, limit=20)))
+            ranked_lists.append(("archive", await self.search_archive_lexical(query_text, limit=20)))
+
+        fused = {}
+        for source, results in ranked_lists:
+            for rank, item in enumerate(results):
+                key = (source, item["id"])
+                entry = fused.setdefault(key, {
+                    "content": item["content"], "timestamp": item["timestamp"],
+                    "similarity": None, "score": 0.0
+                })
+                entry["score"] += 1.0 / (RRF_K + rank + 1)
+                if "similarity" in item:
+                    entry["similarity"] = item["similarity"]
+
+        results = sorted(fused.values(), key=lambda x: x["score"], reverse=True)
         return results[:limit]
 
+    # --- エクスポート / インポート (backend.memory_io) ---
+    async def export_page(self, table, after_id=0, limit=500):
+        """id 順に1ページ分の行を返す（アーカイブは解凍・ベクトル復元済み）
+
+        ページごとに接続を開き直すので、長いエクスポート中も書き込みを止めない。
+        """
+        columns = {
+            "conversation_logs": "id, role, content, timestamp, metadata",
+            "conversation_archive": "id, role, content, timestamp, metadata, archived_at",
+            "memory_summaries": "id, summary, created_at, range_start_id, range_end_id, token_usage, added_memories",
+        }[table]
+        vectors = []
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                f"SELECT {columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+            ) as cursor:
+                rows = [dict(r) for r in await cursor.fetchall()]
+            if rows and table in VECTOR_TABLES:
+                # そのページの行の全モデルのベクトル
+                async with db.execute(
+                    f"SELECT * FROM {VECTOR_TABLES[table]} WHERE row_id > ? AND row_id <= ?", (after_id, rows[-1]["id"])
+                ) as cursor:
+                    vectors = [dict(r) for r in await cursor.fetchall()]
+
+        if table in VECTOR_TABLES:
+            embeddings = {}
+            for v in vectors:
+                vector = json.loads(v["vector"]) if table == "conversation_logs" else dequantize_embedding(v["vector"], v["scale"])
+                embeddings.setdefault(v["row_id"], {})[v["model"]] = vector
+            for row in rows:
+                row["embeddings"] = embeddings.get(row["id"], {})
+                if table == "conversation_archive":
+                    row["content"] = zlib.decompress(row["content"]).decode("utf-8")
+        return rows
+
+    async def _drop_existing(self, db, table, rows):
+        """rows から、同じ記録がもうDBにある行を除く（会話はアーカイブ済みのものも探す。rows の中の重複も1つにする）"""
+        if table == "memory_summaries":
+            sources = [("memory_summaries", "created_at, summary", "created_at")]
+        else:
+            sources = [("conversation_logs", "timestamp, role, content", "timestamp"),
+                       ("conversation_archive", "timestamp, role, content", "timestamp")]
+        stamps = sorted({import_key(table, r)[0] for r in rows})
+        keys = set()
+        for i in range(0, len(stamps), 500):
+            chunk = stamps[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for source, columns, stamp in sources:
+                async with db.execute(f"SELECT {columns} FROM {source} WHERE {stamp} IN ({placeholders})", chunk) as cursor:
+                    for r in await cursor.fetchall():
+                        if source == "conversation_archive":
+                            r = (r[0], r[1], zlib.decompress(r[2]).decode("utf-8"))
+                        keys.add(tuple(r))
+        fresh = []
+        for r in rows:
+            key = import_key(table, r)
+            if key not in keys:
+                keys.add(key)
+                fresh.append(r)
+        return fresh
+
+    async def new_rows(self, table, rows):
+        """まだDBにない行だけを返す（インポートでベクトル化する前に重複を除くため）"""
+        if not rows:
+            return []
+        async with self._connect() as db:
+            return await self._drop_existing(db, table, rows)
+
+    async def import_rows(self, table, rows):
+        """まとめて1トランザクションで挿入する（1行ごとの接続・コミットはしない）。挿入した件数を返す
+
+        会話ログ/アーカイブの行は embeddings = {モデル: ベクトル} を持てる。
+        すでにある記録（import_key が同じ行）は飛ばすので、同じエクスポートを何度取り込んでもよい。
+        """
+        if not rows:
+            return 0
+        async with self._connect() as db:
+            await db.execute("BEGIN IMMEDIATE")  # 確認から挿入までの間に別のインポートが入らないように
+            fresh = await self._drop_existing(db, table, rows)
+            if fresh:
+                await self._insert_rows(db, table, fresh)
+            await db.commit()
+        return len(fresh)
+
+    async def _insert_rows(self, db, table, rows):
+        if table == "conversation_logs":
+            sql = "INSERT INTO conversation_logs (role, content, timestamp, metadata) VALUES (?, ?, ?, ?)"
+            params = [(r["role"], r["content"], r["timestamp"], r.get("metadata")) for r in rows]
+        elif table == "conversation_archive":
+            sql = """
+                INSERT INTO conversation_archive (role, content, timestamp, metadata, archived_at)
+                VALUES (?, ?, ?, ?, ?)
+            """
+            params = [
+                (r["role"], zlib.compress(r["content"].encode("utf-8"), 9), r["timestamp"],
+                 r.get("metadata"), r.get("archived_at") or time.time())
+                for r in rows
+            ]
+        elif table == "memory_summaries":
+            sql = """
+                INSERT INTO memory_summaries
+                (summary, created_at, range_start_id, range_end_id, token_usage, added_memories)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """
+            params = [
+                (r["summary"], r["created_at"], r.get("range_start_id"), r.get("range_end_id"),
+                 r.get("token_usage"), r.get("added_memories"))
+                for r in rows
+            ]
+        else:
+            raise ValueError(f"unknown table: {table}")
+
+        await db.executemany(sql, params)
+        if table in VECTOR_TABLES:
+            ids = await self._inserted_ids(db, table, len(rows))
+            for model in {m for r in rows for m in (r.get("embeddings") or {})}:
+                items = [(row_id, r["embeddings"][model]) for row_id, r in zip(ids, rows)
+                         if (r.get("embeddings") or {}).get(model) is not None]
+                await self._write_vectors(db, table, items, model)
+            if table == "conversation_archive":
+                await self._index_archive(db, ids, [r["content"] for r in rows])
+
+    # --- ベクトルの後埋め (backend.backfill) ---
+    async def find_missing_embeddings(self, table, model, after_id=0, limit=32):
+        """model のベクトルがない行を id 順に返す [(id, 本文)]（他のモデルのベクトルはあってもよい）"""
+        async with self._connect() as db:
+            async with db.execute(f"""
+                SELECT id, content FROM {table} t WHERE id > ?
+                AND NOT EXISTS (SELECT 1 FROM {VECTOR_TABLES[table]} v WHERE v.row_id = t.id AND v.model = ?)
+                ORDER BY id LIMIT ?
+            """, (after_id, model, limit)) as cursor:
+                rows = await cursor.fetchall()
+        if table == "conversation_archive":
+            rows = [(row_id, zlib.decompress(content).decode("utf-8")) for row_id, content in rows]
+        return rows
+
+    async def count_missing_embeddings(self, model):
+        """テーブルごとの後埋め待ちの件数"""
+        counts = {}
+        async with self._connect() as db:
+            for table, vectors in VECTOR_TABLES.items():
+                async with db.execute(f"""
+                    SELECT COUNT(*) FROM {table} t
+                    WHERE NOT EXISTS (SELECT 1 FROM {vectors} v WHERE v.row_id = t.id AND v.model = ?)
+                """, (model,)) as cursor:
+                    counts[table] = (await cursor.fetchone())[0]
+        return counts
+
+    async def update_embeddings(self, table, items, model):
+        """[(id, ベクトル)] を model のベクトルとしてまとめて1トランザクションで書き込む（他のモデルのベクトルは残す）"""
+        async with self._connect() as db:
+            count = await self._write_vectors(db, table, items, model)
+            await db.commit()
+        return count
+
+    async def _write_vectors(self, db, table, items, model):
+        if table == "conversation_logs":
+            sql = "INSERT OR REPLACE INTO log_vectors (row_id, model, vector) VALUES (?, ?, ?)"
+            params = [(row_id, model, json.dumps([float(x) for x in vector])) for row_id, vector in items]
+        else:
+            sql = "INSERT OR REPLACE INTO archive_vectors (row_id, model, vector, scale) VALUES (?, ?, ?, ?)"
+            params = [(row_id, model, *quantize_embedding(vector)) for row_id, vector in items]
+        await db.executemany(sql, params)
+        return len(params)
+
+    async def get_archive_stats(self):
+        """アーカイブの件数と圧縮後サイズ"""
+        async with self._connect() as db:
+            async with db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM conversation_archive") as cursor:
+                count, content_bytes = await cursor.fetchone()
+            async with db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM archive_vectors") as cursor:
+                embedding_bytes = (await cursor.fetchone())[0]
+        return {"count": count, "content_bytes": content_bytes, "embedding_bytes": embedding_bytes}
+
     async def get_context_stats(self):
         """メッセージ数と概算トークン数（文字数ベース）を返す"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             async with db.execute("SELECT content FROM conversation_logs") as cursor:
                 rows = await cursor.fetchall()
                 count = len(rows)
@@ -162,7 +917,7 @@ class ConversationDB:
 
     async def clear_logs(self):
         """（危険）ログの全消去"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute("DELETE FROM conversation_logs")
             await db.execute("DELETE FROM sqlite_sequence WHERE name='conversation_logs'") # IDリセット
             await db.commit()
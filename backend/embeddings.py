@@ -0,0 +1,141 @@
+"""
+Embedding (ベクトル化)
+
+ベクトルは DB にモデルごとに保存し（log_vectors / archive_vectors の model）、
+違うモデルのベクトル同士は比べない（モデルを変えたら backend.backfill が作り直す）。
+
+ベクトル化の方法は MIO_EMBEDDING_PROVIDER で選ぶ。
+- gemini: Gemini の Embedding API（3072次元。毎ターン API を呼ぶ）
+- local:  文字 n-gram をハッシュして固定長にするだけのローカル版（NumPy のみ・オフラインで動く）
+          日本語は単語の区切りがないので、形態素解析の代わりに文字 1〜3-gram を使う
+"""
+import os
+import zlib
+import asyncio
+import unicodedata
+
+import numpy as np
+
+from backend.lazy import load_module
+
+EMBEDDING_PROVIDER = os.getenv("MIO_EMBEDDING_PROVIDER", "gemini").lower()  # gemini or local
+GEMINI_EMBEDDING_MODEL = os.getenv("MIO_EMBEDDING_MODEL", "models/gemini-embedding-001")
+EMBED_BATCH_SIZE = 100  # Gemini の batchEmbedContents の上限
+
+LOCAL_EMBEDDING_DIMS = int(os.getenv("MIO_LOCAL_EMBEDDING_DIMS", "256"))
+LOCAL_NGRAM_WEIGHTS = {1: 0.5, 2: 1.0, 3: 1.0}  # n -> 重み（1文字だけの一致は弱めに数える）
+
+
+class EmbeddingProvider:
+    """ベクトル化の方法ひとつ分
+
+    model は DB のベクトルテーブルの model に入る名前。ベクトルの作り方が変わるときは必ず変えること
+    （同じ名前のベクトル同士しか比べないので、名前が違えば別のベクトル空間として扱われる）。
+    """
+
+    model = ""
+    threshold = 0.6  # ベクトル検索で「関連あり」とみなすコサイン類似度
+    remote = False   # API を呼ぶか（後埋めでバッチの間を空けるかどうかに使う）
+
+    def available(self):
+        return True
+
+    async def embed_texts(self, texts):
+        raise NotImplementedError
+
+
+class GeminiProvider(EmbeddingProvider):
+    remote = True
+
+    def __init__(self, model=GEMINI_EMBEDDING_MODEL):
+        self.model = model
+
+    def available(self):
+        return bool(os.getenv("GEMINI_API_KEY"))
+
+    async def embed_texts(self, texts):
+        gemini = await load_module("backend.gemini")
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            result = await asyncio.to_thread(
+                gemini.genai.embed_content,
+                model=self.model,
+                content=texts[i:i + EMBED_BATCH_SIZE],
+                task_type="retrieval_document" # 検索・保存用として最適化
+            )
+            vectors += result["embedding"]
+        return vectors
+
+
+class LocalNgramProvider(EmbeddingProvider):
+    """文字 n-gram のハッシュ埋め込み（feature hashing）
+
+    n-gram ごとに crc32 で次元と符号を決めて足し込み、log(1+tf) にして L2 正規化する。
+    意味までは分からないが、同じ言葉・言い回しを含む発言はちゃんと近くなる。
+    短文なら1件 0.1ms 程度で、API もモデルファイルもいらない。
+    """
+
+    threshold = 0.3  # 文字の重なりだけで測るので Gemini より低めにする
+
+    def __init__(self, dims=LOCAL_EMBEDDING_DIMS, weights=LOCAL_NGRAM_WEIGHTS):
+        self.dims = dims
+        self.weights = weights
+        self.model = f"local:ngram-v1-{dims}"
+
+    def _normalize(self, text):
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        return " ".join(text.split())
+
+    def embed_one(self, text):
+        text = self._normalize(text)
+        vec = np.zeros(self.dims, dtype=np.float32)
+        if not text:
+            return vec.tolist()
+        slots, values = [], []
+        for n, weight in self.weights.items():
+            for i in range(len(text) - n + 1):
+                gram = text[i:i + n]
+                if gram.isspace():
+                    continue
+                # hash() はプロセスごとに値が変わるので、保存するベクトルには使えない
+                h = zlib.crc32(gram.encode("utf-8"))
+                slots.append(h % self.dims)
+                values.append(weight if (h >> 31) & 1 else -weight)
+        if slots:
+            np.add.at(vec, np.array(slots), np.array(values, dtype=np.float32))
+            vec = np.sign(vec) * np.log1p(np.abs(vec))
+            norm = float(np.linalg.norm(vec))
+            if norm > 0:
+                vec /= norm
+        return vec.tolist()
+
+    async def embed_texts(self, texts):
+        # 十分速いのでスレッドに逃がさずそのまま計算する
+        return [self.embed_one(text) for text in texts]
+
+
+def _build_provider():
+    if EMBEDDING_PROVIDER == "local":
+        return LocalNgramProvider()
+    if EMBEDDING_PROVIDER != "gemini":
+        print(f"⚠ [Embedding] Unknown MIO_EMBEDDING_PROVIDER '{EMBEDDING_PROVIDER}'. Using gemini.")
+    return GeminiProvider()
+
+
+provider = _build_provider()
+EMBEDDING_MODEL = provider.model
+
+
+def available():
+    """今のプロバイダでベクトル化できるか（gemini は API キーが必要）"""
+    return provider.available()
+
+
+async def embed_texts(texts):
+    """まとめてベクトル化する（失敗したら例外）"""
+    return await provider.embed_texts(texts)
+
+
+async def embed_text(text):
+    """1件だけベクトル化する（失敗したら例外）"""
+    return (await embed_texts([text]))[0]
@@ -0,0 +1,12 @@
+"""
+Gemini SDK (google.generativeai) の読み込みと設定
+
+import が重いので backend.lazy.load_module("backend.gemini") 経由で遅延ロードする。
+"""
+import os
+import google.generativeai as genai
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
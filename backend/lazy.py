@@ -0,0 +1,34 @@
+"""
+重いモジュールの遅延ロード
+
+cv2 や google.generativeai は import だけでラズパイだと数秒かかるので、
+初回使用時（または起動時に並列で）スレッドで import してイベントループを止めないようにする。
+"""
+import sys
+import time
+import asyncio
+import importlib
+
+# モジュール名 -> import にかかった時間 (ms)。起動ベンチマーク用
+import_times = {}
+startup_stats = {}
+
+
+def import_module_timed(name):
+    """import して所要時間を記録する（同期版）"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times[name] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"[Lazy] Loaded {name} ({import_times[name]}ms)")
+    return module
+
+
+async def load_module(name):
+    """初回だけスレッドで import する。2回目以降は sys.modules から即返す"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return await asyncio.to_thread(import_module_timed, name)
@@ -0,0 +1,67 @@
+"""
+プロセス間ロックとアトミックなファイル書き込み
+
+uvicorn --workers N で複数プロセス動かしても、コンパクションや記憶ファイルの書き込みが
+同時に走らないようにする。Windows (fcntl なし) ではプロセス内ロックのみ（単一ワーカー前提）。
+"""
+import os
+import asyncio
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_DIR = os.getenv("MIO_LOCK_DIR", ".locks")
+
+_local_locks = {}
+
+
+class LockBusy(Exception):
+    """blocking=False で取得しようとしたロックが使用中"""
+
+
+@contextlib.asynccontextmanager
+async def file_lock(name, blocking=True):
+    """名前付きのプロセス間ロック（同じプロセス内のコルーチン同士も排他）"""
+    local = _local_locks.setdefault(name, asyncio.Lock())
+    if not blocking and local.locked():
+        raise LockBusy(name)
+
+    async with local:
+        if fcntl is None:
+            yield
+            return
+
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        with open(os.path.join(LOCK_DIR, f"{name}.lock"), "a+") as f:
+            if blocking:
+                # 他プロセスが持っている間はスレッドで待つ（イベントループは止めない）
+                await asyncio.to_thread(fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+            else:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise LockBusy(name)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_file_atomic(path, content):
+    """一時ファイルに書いてから置き換える（途中で落ちても中途半端なファイルが残らない）"""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -1,20 +1,36 @@
 import os
+import time
 import base64
-import requests
-import google.generativeai as genai
-from fastapi import FastAPI, HTTPException
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-import httpx # インポート追加！
 
 from dotenv import load_dotenv
 
+# .envファイルから環境変数を読み込む（各モジュールが import 時に設定を読むので最初に）
+load_dotenv()
+
 from contextlib import asynccontextmanager
-import cv2 # カメラ処理用
+# cv2 / google.generativeai / httpx は重いので backend.lazy で遅延ロードする
+from backend.lazy import load_module, import_times, startup_stats
 from backend.database import db # 記憶DBをインポート
-
-# --- 長期記憶ファイル読み込み ---
-def load_memory_files():
+from backend.locks import write_file_atomic
+from backend import tts
+from backend.tts import TTS_MODE, synthesize_clip
+from backend.profiling import profiler, lag_monitor, ProfilingMiddleware # オンデマンド計測
+from backend.static_assets import PrecompressedStaticFiles
+from backend.admission import chat_limiter, embedding_limiter, QueueFull
+from backend import metrics
+from backend.model_chain import CHAT_MODELS
+from backend import vision_cache
+from backend.prefetch import prefetch_cache
+from backend import embeddings, backfill
+from backend.embeddings import EMBEDDING_MODEL
+from backend.memory_index import memory_index
+from backend.prompt_cache import PromptPrefix
+
+# --- 長期記憶ファイル ---
+def ensure_memory_files():
+    """記憶ファイルがなければデフォルトを作る（中身は backend.memory_index が読む）"""
     # ディレクトリ作成
     os.makedirs("memory", exist_ok=True)
     
@@ -35,80 +51,95 @@ def load_memory_files():
 """
     }
 
-    # memoryフォルダ配下を見る
-    files = ["memory/IDENTITY.md", "memory/USER.md", "memory/MEMORY.md"]
-    content = ""
-    
-    for f in files:
+    for f, default in defaults.items():
         # ファイルがない場合はデフォルトを作成
         if not os.path.exists(f):
             print(f"[Memory] Creating default file: {f}")
-            with open(f, "w", encoding="utf-8") as file:
-                file.write(defaults.get(f, ""))
-
-        # 読み込み
-        if os.path.exists(f):
-            with open(f, "r", encoding="utf-8") as file:
-                content += f"\n\n--- {os.path.basename(f)} ---\n{file.read()}"
-    return content
+            write_file_atomic(f, default)
 
-# 基本プロンプト + 長期記憶
+# 基本プロンプト + 長期記憶（IDENTITY.md と USER.md のタイトル直下。それ以外のユーザー情報と思い出は関係する分だけ発言の前に付ける）
 BASE_SYSTEM_PROMPT = """
 あなたはAIパートナー「澪（MIO）」です。
-以下の記憶ファイルを元に会話してください。
+以下の記憶ファイルと、発言の前に付く【長期記憶】を元に会話してください。
 
 【重要：絶対厳守ルール】
 1. キャラクター性は維持し、親しみやすいトーンで。
 """
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
 # --- 設定 ---
 # Gemini APIキー (環境変数から読み込む)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 if not GEMINI_API_KEY:
     print("WARNING: GEMINI_API_KEY environment variable is not set.")
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
 
-# --- TTS設定 ---
-TTS_MODE = os.getenv("TTS_MODE", "LOCAL") # LOCAL or API
-AIVIS_API_URL = os.getenv("AIVIS_API_URL", "http://127.0.0.1:10101")
-AIVIS_CLOUD_KEY = os.getenv("AIVIS_CLOUD_KEY", "")
-AIVIS_CLOUD_URL = "https://api.aivis-project.com/v1/tts/synthesize"
-AIVIS_MODEL_UUID = "22e8ed77-94fe-4ef2-871f-a86f94e9a579" # コハク (ノーマル)
-SPEAKER_ID = 1878365376 # ローカル用コハク ID
+# 1 にするとカメラ(cv2)も起動直後にバックグラウンドで読み込んでおく
+PRELOAD_CAMERA = os.getenv("MIO_PRELOAD_CAMERA", "0") == "1"
+
+# システムプロンプトの版管理 + Gemini のコンテキストキャッシュ
+prompt_prefix = PromptPrefix(CHAT_MODELS)
+
+def system_prompt():
+    return BASE_SYSTEM_PROMPT + memory_index.system_text
 
-model = None
+def current_chat_chain():
+    """記憶ファイルが書き換わっていたら読み直し、システムプロンプトが変わっていればモデルを作り直す"""
+    memory_index.refresh()
+    if not GEMINI_API_KEY:
+        return None
+    return prompt_prefix.update(system_prompt())
 
 # --- Lifespan (起動/終了処理) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model
     # 起動時の処理
-    await db.init_db()
+    started = time.perf_counter()
+
+    # DB初期化と重いSDKの import、フロントエンドの事前圧縮を並列に行う
+    await asyncio.gather(
+        db.init_db(),
+        static_files.prepare(),
+        load_module("backend.gemini") if GEMINI_API_KEY else asyncio.sleep(0),
+        load_module("httpx"),
+    )
     
-    # 長期記憶を読み込んでシステムプロンプトを構築
-    long_term_memory = load_memory_files()
-    full_prompt = BASE_SYSTEM_PROMPT + long_term_memory
+    # 長期記憶を読み込んでシステムプロンプトを構築（以降は記憶ファイルが変わるたびに作り直す）
+    ensure_memory_files()
+    chat_chain = current_chat_chain()
     
     print("--- SYSTEM PROMPT LOADED ---")
-    print(full_prompt[:200] + "...") # 先頭だけ表示
-    
-    print(full_prompt[:200] + "...") # 先頭だけ表示
+    print(system_prompt()[:200] + "...") # 先頭だけ表示
     
-    if GEMINI_API_KEY:
-        # ごめんなさい！元の指定に戻します！
-        model = genai.GenerativeModel('gemini-3-flash-preview', system_instruction=full_prompt)
-        print("Gemini Model Initialized with Memory (gemini-3-flash-preview).")
+    if chat_chain:
+        print(f"Gemini Model Initialized with Memory ({' -> '.join(CHAT_MODELS)}).")
+
+    # カメラ・コンパクションは初回使用時に読み込む（指定があれば裏で先読み）
+    if PRELOAD_CAMERA:
+        asyncio.create_task(load_module("cv2"))
+
+    # イベントループ遅延モニター (MIO_LOOP_LAG_MS > 0 のときだけ)
+    lag_monitor.start()
+
+    # TTS 合成先のヘルスチェック（ローカルの Aivis があるときだけ）
+    tts.start()
+
+    # ベクトルのない発言の後埋め（定期実行）
+    if embeddings.available():
+        backfill.worker.start()
+
+    startup_stats["ready_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"MIO Ready in {startup_stats['ready_ms']}ms (imports: {import_times})")
 
     yield
     # 終了時の処理
+    await lag_monitor.stop()
+    await backfill.worker.stop()
+    await prompt_prefix.close()
+    await tts.close()
     print("MIO Shutdown.")
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
 class ChatRequest(BaseModel):
     text: str
@@ -117,71 +148,11 @@ class SpeakRequest(BaseModel):
     text: str
     mode: str = None  # LOCAL, API, or None (use default)
 
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 import json
 import asyncio
 
-# グローバルなHTTPクライアント（コネクションプール用）
-client = httpx.AsyncClient(timeout=30.0)
-
-# Aivisで音声を合成する関数（非同期版・コネクション再利用）
-async def synthesize_audio_async(text, mode=None):
-    if not text: return None
-    
-    current_mode = mode if mode else TTS_MODE
-    
-    if current_mode == "SILENT":
-        return None # 無言モード
-
-    print(f"Synthesizing Async ({current_mode}): {text[:10]}...") # デバッグログ
-
-    try:
-        if current_mode == "API":
-             # Aivis Cloud API 実装
-             if not AIVIS_CLOUD_KEY:
-                 print("Error: AIVIS_CLOUD_KEY is not set.")
-                 return None
-
-             headers = {
-                 "Authorization": f"Bearer {AIVIS_CLOUD_KEY}",
-                 "Content-Type": "application/json"
-             }
-             payload = {
-                 "model_uuid": AIVIS_MODEL_UUID,
-                 "text": text,
-                 "style_id": 0,
-                 "output_format": "mp3"
-             }
-             
-             res = await client.post(AIVIS_CLOUD_URL, headers=headers, json=payload)
-             res.raise_for_status()
-             return base64.b64encode(res.content).decode('utf-8')
-
-        else:
-            # LOCAL (Default)
-            q_res = await client.post(
-                f"{AIVIS_API_URL}/audio_query",
-                params={"text": text, "speaker": SPEAKER_ID}
-            )
-            q_res.raise_for_status()
-            query_data = q_res.json()
-
-            s_res = await client.post(
-                f"{AIVIS_API_URL}/synthesis",
-                params={"speaker": SPEAKER_ID},
-                json=query_data
-            )
-            s_res.raise_for_status()
-            
-            raw_audio = s_res.content
-            print(f"★ Audio generated: {len(raw_audio)} bytes") # サイズ確認
-            
-            return base64.b64encode(raw_audio).decode('utf-8')
-
-    except Exception as e:
-        print(f"Audio synth error: {e}")
-        return None
-
 # --- テキスト読み上げAPI (TTS Only) ---
 @app.post("/api/speak")
 async def speak_text(request: SpeakRequest):
@@ -193,77 +164,78 @@ async def speak_text(request: SpeakRequest):
     active_mode = request.mode if request.mode else TTS_MODE
     
     try:
-        audio_b64 = await synthesize_audio_async(text, mode=active_mode)
+        audio_b64, tts_backend = await synthesize_clip(text, mode=active_mode)
         if audio_b64:
-            return {"status": "ok", "audio": audio_b64}
+            return {"status": "ok", "audio": audio_b64, "backend": tts_backend}
         else:
             return {"status": "error", "message": "Audio synthesis failed"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 # --- カメラ連携API (Tapo) ---
-TAPO_IP = os.getenv("TAPO_IP", "")
-TAPO_USER = os.getenv("TAPO_USER", "")
-TAPO_PASSWORD = os.getenv("TAPO_PASSWORD", "")
-
 @app.get("/api/camera/snapshot")
 async def get_camera_snapshot():
-    if not TAPO_IP or not TAPO_USER or not TAPO_PASSWORD:
+    camera = await load_module("backend.camera")
+    if not camera.is_configured():
         return {"status": "error", "message": "Tapo credentials not set in .env"}
 
-    def _capture():
-        import urllib.parse
-        encoded_user = urllib.parse.quote(TAPO_USER)
-        encoded_pass = urllib.parse.quote(TAPO_PASSWORD)
-        rtsp_url = f"rtsp://{encoded_user}:{encoded_pass}@{TAPO_IP}:554/stream1"
-        
-        print(f"📸 Connecting to: rtsp://{encoded_user}:****@{TAPO_IP}:554/stream1")
-        
-        cap = cv2.VideoCapture(rtsp_url)
-        if not cap.isOpened():
-            return None, "Could not open RTSP stream"
-            
-        ret, frame = cap.read()
-        cap.release()
-        
-        if not ret:
-            return None, "Failed to read frame"
-            
-        _, buffer = cv2.imencode('.jpg', frame)
-        img_b64 = base64.b64encode(buffer).decode('utf-8')
-        return img_b64, None
-
     try:
-        # 非同期実行でブロック回避
-        img_base64, error_msg = await asyncio.to_thread(_capture)
+        # 非同期実行でブロック回避（cv2 の初回 import もスレッド側で行われる）
+        img_base64, error_msg = await asyncio.to_thread(camera.capture_snapshot)
         
         if error_msg:
              return {"status": "error", "message": error_msg}
 
         print("📸 Snapshot capture success!")
-        return {"status": "ok", "image": img_base64}
+
+        # そのまま会話に使えるように保存しておく（アップロードの往復を省く）
+        # 知覚ハッシュもここで計算して、前回とほぼ同じ画像なら会話時に画像を送らずに済ませる
+        import uuid
+        image_id = str(uuid.uuid4())
+        phash = await vision_cache.hash_image(base64.b64decode(img_base64))
+        await db.save_image(image_id, img_base64, phash=phash)
+        return {"status": "ok", "image": img_base64, "image_id": image_id}
 
     except Exception as e:
         print(f"Camera Error: {e}")
         return {"status": "error", "message": str(e)}
 
 # --- Embedding Helper ---
-async def get_embedding(text):
+async def get_embedding(text, session="default"):
     if not text: return None
     try:
-        if not GEMINI_API_KEY: return None
-        # gemini-embedding-001 モデルを使用
-        result = await asyncio.to_thread(
-            genai.embed_content,
-            model="models/gemini-embedding-001",
-            content=text,
-            task_type="retrieval_document" # 検索・保存用として最適化
-        )
-        return result['embedding']
+        if not embeddings.available(): return None
+        # 同時実行数を制限（混雑時は順番待ち、満杯なら諦めて全文検索だけにする）
+        async with embedding_limiter.slot(session):
+            return await embeddings.embed_text(text)
+    except QueueFull:
+        print("Embedding skipped: queue is full")
+        return None
     except Exception as e:
         print(f"Embedding Error ({type(e).__name__}): {e}") # 詳細エラーログ
         return None
 
+# --- RAG (ベクトル化 + 記憶検索) ---
+async def retrieve_context(text, session="default"):
+    """発言をベクトル化し、関連する記憶を探す。(ベクトル, 関連記憶) を返す"""
+    # 1. ユーザー発言のベクトル化
+    embedding = await get_embedding(text, session=session)
+    # 2. 類似記憶の検索 (RAG: ベクトル + 全文検索のハイブリッド。ベクトルが無くても全文検索は効く)
+    memories = await db.hybrid_search(
+        text, embedding, limit=3, threshold=embeddings.provider.threshold, model=EMBEDDING_MODEL
+    )
+    return embedding, memories
+
+class PrefetchRequest(BaseModel):
+    text: str
+    session: str = "default"
+
+@app.post("/api/prefetch")
+async def prefetch(req: PrefetchRequest):
+    # 入力中の下書きで先にベクトル化・記憶検索しておく（結果は stream_chat で使う）
+    scheduled = prefetch_cache.schedule(req.text, lambda t: retrieve_context(t, req.session), session=req.session)
+    return {"status": "ok", "scheduled": scheduled}
+
 # --- 履歴取得API ---
 @app.get("/api/history")
 async def get_history(limit: int = 20):
@@ -273,9 +245,7 @@ async def get_history(limit: int = 20):
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-# --- 簡易画像ストレージ (In-Memory) ---
-image_storage = {}
-
+# --- 画像ストレージ (DB上。複数ワーカーでも共有される) ---
 class ImageUploadRequest(BaseModel):
     image: str # Base64
 
@@ -283,76 +253,117 @@ class ImageUploadRequest(BaseModel):
 async def upload_image(req: ImageUploadRequest):
     import uuid
     image_id = str(uuid.uuid4())
-    image_storage[image_id] = req.image
+    await db.save_image(image_id, req.image)
     print(f"★ Image Uploaded: {image_id[:8]}...")
     return {"status": "ok", "image_id": image_id}
 
 @app.get("/api/stream_chat")
-async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None):
+async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None, session: str = None):
     print(f"Mio v4 (Streaming) - Received: {text} (Mode: {mode}, Image: {image_id})")
-    
-    # 画像データの準備（あれば）
-    gemini_image_part = None
-    if image_id and image_id in image_storage:
-        try:
-            # Base64デコード
-            img_data = base64.b64decode(image_storage[image_id])
-            # Geminiに入力できる形式 (Blobなど) に変換する必要があるが、
-            # google.generativeai は PIL image や辞書形式を受け取れる
-            gemini_image_part = {
-                "mime_type": "image/jpeg",
-                "data": img_data
-            }
-            print("★ Image retrieved for prompt!")
-            # １回使ったら消す（メモリ節約）
-            del image_storage[image_id]
-        except Exception as e:
-            print(f"Image load error: {e}")
 
-    # 1. ユーザー発言のベクトル化
-    user_embedding = await get_embedding(text)
-
-    # 2. 類似記憶の検索 (RAG)
-    related_memories = []
-    if user_embedding:
-        related_memories = await db.search_similar_context(user_embedding, limit=3)
+    # 混雑時の順番待ち（セッションごとに公平に）。待ち行列が満杯なら 429
+    session = session or "default"
+    try:
+        chat_ticket = chat_limiter.enqueue(session)
+    except QueueFull as e:
+        return JSONResponse(
+            {"status": "error", "message": "Too many requests. Please retry later."},
+            status_code=429, headers={"Retry-After": str(e.retry_after)}
+        )
     
-    # 3. ユーザー発言を保存 (ベクトル付き)
-    await db.log_message("user", text, embedding=user_embedding)
-
-    # 4. プロンプトの構築 (記憶の注入)
-    # 過去の会話履歴を取得
-    history_data = await db.get_recent_context(limit=10)
-    gemini_history = []
+    try:
+        # 画像データの準備（あれば）
+        gemini_image_part = None
+        scene_description = None # ほぼ同じ画像を前に見ていれば、その説明文
+        user_metadata = None
+        # １回使ったら消す（取り出しと同時にDBから削除）
+        image_b64, image_hash = await db.pop_image(image_id) if image_id else (None, None)
+        if image_b64:
+            try:
+                # Base64デコード
+                img_data = base64.b64decode(image_b64)
+                # 知覚ハッシュはカメラ画像にだけ付いている（アップロードされた写真はキャッシュしない）
+                scene_description = await vision_cache.lookup(image_hash)
+                if not scene_description:
+                    # Geminiに入力できる形式 (Blobなど) に変換する必要があるが、
+                    # google.generativeai は PIL image や辞書形式を受け取れる
+                    gemini_image_part = {
+                        "mime_type": "image/jpeg",
+                        "data": img_data
+                    }
+                    # 次からほぼ同じ画像は説明文で済ませられるように、裏で説明文を作る
+                    await vision_cache.remember(image_hash, img_data)
+                    print("★ Image retrieved for prompt!")
+                if image_hash is not None:
+                    user_metadata = {"image_hash": image_hash, "vision_cache": "hit" if scene_description else "miss"}
+            except Exception as e:
+                print(f"Image load error: {e}")
+
+        # 1-2. ユーザー発言のベクトル化と類似記憶の検索（入力中に先読みしてあればそれを使う）
+        prefetched = await prefetch_cache.take(text, session)
+        if prefetched:
+            user_embedding, related_memories = prefetched
+            if user_embedding is None:
+                # 下書きと少し違う（またはベクトル化に失敗していた）。保存するベクトルは送信文で作り直す
+                user_embedding = await get_embedding(text, session=session)
+        else:
+            user_embedding, related_memories = await retrieve_context(text, session)
     
-    for log in history_data:
-        role = "model" if log["role"] == "assistant" else "user"
-        gemini_history.append({"role": role, "parts": [log["content"]]})
-
-    # もし関連記憶が見つかったら、入力テキストに情報を付与する (Context Injection)
-    augmented_text = text
-    if related_memories:
-        memory_text = "\n".join([f"- {m['content']}" for m in related_memories])
-        print(f"★ RAG Hit: {len(related_memories)} memories found.")
-        augmented_text = f"【関連する過去の記憶】\n{memory_text}\n\n【ユーザーの発言】\n{text}"
+        # 3. ユーザー発言を保存 (ベクトル付き)
+        await db.log_message("user", text, metadata=user_metadata, embedding=user_embedding, embedding_model=EMBEDDING_MODEL)
 
-    # フロントからの指定があればそれを使い、なければ環境変数のデフォルトを使う
-    active_mode = mode if mode else TTS_MODE
+        # 4. プロンプトの構築 (記憶の注入)
+        # 過去の会話履歴を取得
+        history_data = await db.get_recent_context(limit=10)
+        gemini_history = []
+    
+        for log in history_data:
+            role = "model" if log["role"] == "assistant" else "user"
+            gemini_history.append({"role": role, "parts": [log["content"]]})
+
+        # もし関連記憶が見つかったら、入力テキストに情報を付与する (Context Injection)
+        chain = current_chat_chain()
+        augmented_text = text
+        if related_memories:
+            memory_text = "\n".join([f"- {m['content']}" for m in related_memories])
+            print(f"★ RAG Hit: {len(related_memories)} memories found.")
+            augmented_text = f"【関連する過去の記憶】\n{memory_text}\n\n【ユーザーの発言】\n{text}"
+        # 長期記憶ファイル（ユーザー情報・思い出）のうち、この発言に関係するエントリだけ
+        long_term = memory_index.select(text)
+        if long_term:
+            print(f"★ Long-term Memory Hit: {len(long_term)} entries ({sum(len(t) for _, t in long_term)} chars).")
+            if not related_memories:
+                augmented_text = f"【ユーザーの発言】\n{text}"
+            augmented_text = f"{memory_index.format(long_term)}\n\n{augmented_text}"
+        if scene_description:
+            # 画像の代わりに、前に見たほぼ同じ画像の説明文を渡す
+            augmented_text = f"【ユーザーが送ったカメラ画像の内容（少し前に見た画像とほぼ同じ）】\n{scene_description}\n\n{augmented_text}"
+
+        # フロントからの指定があればそれを使い、なければ環境変数のデフォルトを使う
+        active_mode = mode if mode else TTS_MODE
+    except BaseException:
+        # ストリームを返す前に失敗したら（DB エラー・クライアントの切断など）枠を返す
+        chat_ticket.release()
+        raise
 
     async def event_generator():
-        if not model:
+        if not chain:
+            chat_ticket.release()
             yield f"data: {json.dumps({'error': 'Model not loaded'})}\n\n"
             return
         
         try:
+            # 順番が来るまで待ち、その間は待ち順を知らせる
+            while not await chat_ticket.wait(timeout=1.0):
+                yield f"data: {json.dumps({'type': 'queued', 'position': chat_ticket.position() + 1})}\n\n"
+
             # Input Content (Text or Multimodal)
             input_content = augmented_text
             if gemini_image_part:
                 input_content = [augmented_text, gemini_image_part]
                 print("★ Sending Multimodal Request to Gemini...")
 
-            chat_session = model.start_chat(history=gemini_history)
-            response_stream = await asyncio.to_thread(chat_session.send_message, input_content, stream=True)
+            response_stream = chain.stream_chat(gemini_history, input_content)
             
             buffer = ""
             full_response_text = "" # 最終的にDBに保存するための全文バッファ
@@ -360,7 +371,7 @@ async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None
             pending_audio_tasks = []
             usage_info = {} # トークン情報格納用
 
-            for chunk in response_stream:
+            async for chunk in response_stream:
                 # 最後のチャンクにusageメタデータが含まれる場合がある
                 if hasattr(chunk, 'usage_metadata') and chunk.usage_metadata:
                     usage_info = {
@@ -397,9 +408,12 @@ async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None
                         
                         # 完了した音声タスクから順に送出
                         while pending_audio_tasks and pending_audio_tasks[0].done():
-                            audio = await pending_audio_tasks.pop(0)
+                            audio, tts_backend = await pending_audio_tasks.pop(0)
                             if audio:
-                                yield f"data: {json.dumps({'type': 'audio', 'content': audio})}\n\n"
+                                yield f"data: {json.dumps({'type': 'audio', 'content': audio, 'backend': tts_backend})}\n\n"
+
+            # Gemini の生成は終わったので、音声合成を待つ間に次の人へ枠を譲る
+            chat_ticket.release()
 
             if buffer.strip():
                  # 最後に残ったテキストの音声合成
@@ -417,17 +431,18 @@ async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None
             
             # 全ての音声合成が終わるのを待って順番に送信
             for task in pending_audio_tasks:
-                 audio_b64 = await task
+                 audio_b64, tts_backend = await task
                  if audio_b64:
                      # テキストは送らず音声のみ（テキストは逐次送ってるから）
-                     yield f"data: {json.dumps({'type': 'audio', 'content': audio_b64})}\n\n"
+                     yield f"data: {json.dumps({'type': 'audio', 'content': audio_b64, 'backend': tts_backend})}\n\n"
             
             # もしループ内で取れなくても、全体のレスポンスから取れる場合がある
-            if not usage_info and hasattr(response_stream, 'usage_metadata'):
+            response = response_stream.response
+            if not usage_info and getattr(response, 'usage_metadata', None):
                  usage_info = {
-                    "prompt_token_count": response_stream.usage_metadata.prompt_token_count,
-                    "candidates_token_count": response_stream.usage_metadata.candidates_token_count,
-                    "total_token_count": response_stream.usage_metadata.total_token_count,
+                    "prompt_token_count": response.usage_metadata.prompt_token_count,
+                    "candidates_token_count": response.usage_metadata.candidates_token_count,
+                    "total_token_count": response.usage_metadata.total_token_count,
                  }
 
             if usage_info:
@@ -437,8 +452,12 @@ async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None
             # ★全ての処理が終わったら、MIOの返答を記憶（DB保存）
             if full_response_text:
                 # 返答もベクトル化して保存（非同期でやるのが理想だけど、ここではawaitで確実に）
-                ai_embedding = await get_embedding(full_response_text)
-                await db.log_message("assistant", full_response_text, embedding=ai_embedding)
+                ai_embedding = await get_embedding(full_response_text, session=session)
+                # どのモデルが答えたか（フォールバックしたか）も残す
+                await db.log_message(
+                    "assistant", full_response_text, metadata=response_stream.info,
+                    embedding=ai_embedding, embedding_model=EMBEDDING_MODEL
+                )
 
             yield f"data: {json.dumps({'type': 'end'})}\n\n"
 
@@ -446,13 +465,19 @@ async def stream_chat_endpoint(text: str, mode: str = None, image_id: str = None
             import traceback
             print(f"Stream Error: {traceback.format_exc()}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            chat_ticket.release()
             
     # ヘルパー関数: タスク内で呼び出して結果を返す用
     async def synthesize_audio_task(text, mode):
         print(f"Synthesizing Async ({mode}): {text}")
-        return await synthesize_audio_async(text, mode)
+        return await synthesize_clip(text, mode, session=session)
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    # 途中で切断されてジェネレーターが動かなかった場合も枠を返す
+    return StreamingResponse(
+        event_generator(), media_type="text/event-stream",
+        background=BackgroundTask(chat_ticket.release)
+    )
 
 # --- 記憶管理API ---
 @app.get("/favicon.ico")
@@ -462,7 +487,12 @@ async def favicon():
 @app.get("/api/memory/status")
 async def get_memory_status():
     stats = await db.get_context_stats()
-    return {"status": "ok", "message_count": stats["count"], "total_chars": stats["total_chars"]}
+    archive = await db.get_archive_stats()
+    memory_index.refresh()
+    return {
+        "status": "ok", "message_count": stats["count"], "total_chars": stats["total_chars"],
+        "archive": archive, "long_term": memory_index.status(), "prompt_cache": prompt_prefix.status()
+    }
 
 @app.get("/api/chat_history")
 async def get_chat_history(limit: int = 50):
@@ -472,158 +502,51 @@ async def get_chat_history(limit: int = 50):
 
 @app.post("/api/memory/compact")
 async def compact_memory():
-    print("--- Starting Advanced Compaction ---")
-    
-    # 1. 会話ログを全取得
-    logs = await db.get_recent_context(limit=1000) # 十分な量を取得
-    if not logs:
-        return {"status": "ok", "message": "No logs to compact.", "token_usage": 0}
-
-    # テキスト化
-    conversation_text = ""
-    for log in logs:
-        conversation_text += f"{log['role']}: {log['content']}\n"
-
-    # 2. 司書AI (Librarian) による分析
-    librarian_prompt = """
-    あなたは会話ログ整理の専門AI（司書）です。以下の会話ログを分析し、長期記憶ファイルに保存すべき重要な情報を抽出してください。
-    
-    【重要ルール：情報の振り分け】
-    以下の3つのカテゴリに情報を厳密に振り分けてください。**同じ情報を複数のカテゴリに入れないこと。**
-
-    1. **user_updates (ユーザー情報)**:
-       - ユーザーのプロフィール、性格、好み、癖、思想、身体的特徴、仕事、家族構成など。
-       - 「ユーザーそのもの」に関する不変または半永久的な属性情報。
-       - 例：「リンゴが好き」「プログラマーである」「猫派」
-
-    2. **identity_updates (AIアイデンティティ)**:
-       - AI（MIO）自身の性格、話し方、行動指針、ユーザーに対する呼び名や態度、自分ルール。
-       - 「AI自身」に関する自己定義のみ。
-       - 例：「のんびり屋である」「～だよ口調を使う」「ユーザーをマスターと呼ぶ」
-
-    3. **memory_updates (長期記憶・エピソード)**:
-       - 過去に起こった具体的な出来事、約束、会話したトピック、一緒に行った場所、特定の文脈での合意事項。
-       - **※ユーザーのプロフィール的情報はここには含めず、user_updatesに入れてください。**
-       - 例：「遊園地に行く約束をした」「AI倫理について議論した」「2024年の誕生日の思い出」
-
-    【出力形式】
-    以下のJSON形式で出力してください：
-    {
-      "user_updates": ["追加すべきユーザーの事柄"],
-      "identity_updates": ["追加すべきAI自身の事柄"],
-      "memory_updates": ["追加すべきイベントや知識"],
-      "summary": "会話全体の簡潔な要約（100文字以内）"
-    }
-    """
-    
-    token_usage = {"prompt_token_count": 0, "candidates_token_count": 0, "total_token_count": 0}
-    updates = {}
-    
-    if GEMINI_API_KEY:
-        try:
-            # 分析用モデル
-            librarian = genai.GenerativeModel(
-                'gemini-3-flash-preview', 
-                system_instruction=librarian_prompt,
-                generation_config={"response_mime_type": "application/json"}
-            )
-            
-            resp = await asyncio.to_thread(librarian.generate_content, conversation_text)
-            
-            # トークン使用量の取得（詳細）
-            if resp.usage_metadata:
-                token_usage = {
-                    "prompt_token_count": resp.usage_metadata.prompt_token_count,
-                    "candidates_token_count": resp.usage_metadata.candidates_token_count,
-                    "total_token_count": resp.usage_metadata.total_token_count
-                }
-            
-            updates = json.loads(resp.text)
-            print(f"Librarian Analysis: {updates}")
-            
-            # 3. 編纂AI (Compiler) による情報の統合と更新
-            compiler_model = genai.GenerativeModel('gemini-3-flash-preview')
-
-            async def update_file(filepath, new_info_list, category_name):
-                if not new_info_list: return
-                
-                # 既存の内容を読み込み
-                current_content = ""
-                if os.path.exists(filepath):
-                    with open(filepath, "r", encoding="utf-8") as f:
-                        current_content = f.read()
-                
-                # 統合プロンプト
-                compiler_prompt = f"""
-                あなたは記憶ファイルの編纂者です。
-                以下の「現在のファイル内容」と「新しく判明した情報」を元に、情報を整理・統合して、新しいファイルの内容を作成してください。
-                
-                【現在のファイル内容 ({category_name})】
-                {current_content}
-                
-                【新しく判明した情報】
-                {json.dumps(new_info_list, ensure_ascii=False)}
-                
-                【編集ルール】
-                1. 情報が重複している場合は、一つにまとめてください。
-                2. 新しい情報が既存の情報と矛盾する場合、新しい情報を優先して更新してください。
-                3. 似たような情報は箇条書きでまとめて整理してください。
-                4. 出力はファイルの内容そのもの（Markdown形式）のみを出力してください。余計な説明は不要です。
-                5. ヘッダー（# User Profile など）は維持してください。
-                """
-                
-                try:
-                    # 編纂実行
-                    resp = await asyncio.to_thread(compiler_model.generate_content, compiler_prompt)
-                    new_content = resp.text.strip()
-                    
-                    # トークン計算（加算）
-                    if resp.usage_metadata:
-                        token_usage["prompt_token_count"] += resp.usage_metadata.prompt_token_count
-                        token_usage["candidates_token_count"] += resp.usage_metadata.candidates_token_count
-                        token_usage["total_token_count"] += resp.usage_metadata.total_token_count
-
-                    # 内容が空でないことを確認して書き込み（安全策）
-                    if new_content and len(new_content) > 10:
-                        with open(filepath, "w", encoding="utf-8") as f:
-                            f.write(new_content)
-                        print(f"★ Updated {category_name} Memory (編纂完了)")
-                    else:
-                        print(f"⚠ Warning: Empty response for {category_name}, skipping update.")
-                        
-                except Exception as e:
-                    print(f"Compiler Error ({category_name}): {e}")
-
-            # 各カテゴリごとに更新を実行
-            await update_file("memory/USER.md", updates.get("user_updates"), "User Profile")
-            await update_file("memory/IDENTITY.md", updates.get("identity_updates"), "AI Identity")
-            await update_file("memory/MEMORY.md", updates.get("memory_updates"), "Long Term Memory")
-
-            # 4. コンパクション履歴の保存
-            summary_text = updates.get("summary", "No summary provided.")
-            await db.log_compaction(
-                summary=summary_text,
-                start_id=0, 
-                end_id=0,   
-                token_usage=token_usage.get("total_token_count", 0),
-                added_memories=updates
-            )
-            
-            # 5. 短期記憶の消去 (Compaction成功時のみ)
-            await db.clear_logs()
+    compaction = await load_module("backend.compaction")
+    return await compaction.run_compaction()
+
+# --- 記憶のエクスポート / インポート (NDJSON) ---
+@app.get("/api/memory/export")
+async def export_memory(files: bool = True):
+    memory_io = await load_module("backend.memory_io")
+    filename = time.strftime("mio_memory_%Y%m%d_%H%M%S.ndjson")
+    return StreamingResponse(
+        memory_io.export_ndjson(include_files=files),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/api/memory/import")
+async def import_memory(request: Request, reembed: str = "missing", files: bool = True):
+    memory_io = await load_module("backend.memory_io")
+
+    async def embed(texts):
+        async with embedding_limiter.slot("import"):
+            return await embeddings.embed_texts(texts)
 
-        except Exception as e:
-            import traceback
-            error_detail = traceback.format_exc()
-            print(f"Compaction Error: {error_detail}")
-            return {"status": "error", "message": f"Compaction process failed: {str(e)}"}
-    
-    return {
-        "status": "ok", 
-        "message": "Smart Compaction complete.",
-        "updates": updates,
-        "token_usage": token_usage
-    }
+    try:
+        stats = await memory_io.import_ndjson(
+            memory_io.iter_lines(request.stream()),
+            embed=embed if embeddings.available() else None,
+            reembed=reembed,
+            include_files=files
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "ok", "imported": stats}
+
+# --- ベクトルの後埋め ---
+@app.get("/api/memory/backfill")
+async def get_backfill_status():
+    return {"status": "ok", "backfill": await backfill.worker.status()}
+
+@app.post("/api/memory/backfill")
+async def start_backfill():
+    if not embeddings.available():
+        return {"status": "error", "message": "GEMINI_API_KEY is not set."}
+    backfill.worker.start()
+    backfill.worker.trigger()
+    return {"status": "ok", "message": "Backfill started."}
 
 @app.get("/api/memory/compaction_logs")
 async def get_compaction_logs(limit: int = 10):
@@ -633,6 +556,56 @@ async def get_compaction_logs(limit: int = 10):
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+# --- プロファイリングAPI (管理用) ---
+class ProfileRequest(BaseModel):
+    count: int = 1
+    targets: list[str] = None  # stream_chat, compact (None = 両方)
+    mode: str = None           # sample or cprofile
+    loop_lag_ms: float = None  # 指定するとイベントループ遅延モニターを起動
+
+@app.post("/api/admin/profile")
+async def arm_profiler(req: ProfileRequest):
+    profiler.arm(req.count, targets=req.targets, mode=req.mode)
+    if req.loop_lag_ms:
+        lag_monitor.start(threshold_ms=req.loop_lag_ms)
+    return {"status": "ok", "profiler": profiler.status(), "loop_lag": lag_monitor.status()}
+
+@app.get("/api/admin/profile")
+async def get_profiler_status():
+    return {"status": "ok", "profiler": profiler.status(), "loop_lag": lag_monitor.status()}
+
+# --- 読み上げバックエンドの状態 ---
+@app.get("/api/tts/status")
+async def get_tts_status():
+    return {"status": "ok", "backends": tts.pool.status()}
+
+# --- メトリクス (待ち行列の長さ・待ち時間など) ---
+# フロントの音声再生の計測（送信から最初の音まで / 音声の間の隙間）
+class ClientMetricsRequest(BaseModel):
+    first_sound_ms: float | None = None  # 音声が鳴らなかったターンは null
+    gaps_ms: list[float] = []
+    clips: int = 0
+    mode: str | None = None
+
+CLIENT_METRIC_MAX_MS = 600_000  # 10分を超える値は計測の誤りとみなして捨てる
+
+@app.post("/api/metrics/client")
+async def post_client_metrics(req: ClientMetricsRequest):
+    mode = req.mode if req.mode in ("LOCAL", "API") else "other"
+    if req.first_sound_ms is not None and 0 <= req.first_sound_ms <= CLIENT_METRIC_MAX_MS:
+        metrics.summary("mio_client_first_sound_seconds", mode=mode).observe(req.first_sound_ms / 1000)
+    gap_summary = metrics.summary("mio_client_audio_gap_seconds", mode=mode)
+    for gap in req.gaps_ms[:200]:
+        if 0 <= gap <= CLIENT_METRIC_MAX_MS:
+            gap_summary.observe(gap / 1000)
+    return {"status": "ok"}
+
+@app.get("/api/metrics")
+async def get_metrics(format: str = "json"):
+    if format == "prometheus":
+        return PlainTextResponse(metrics.render_prometheus())
+    return {"status": "ok", "metrics": metrics.snapshot()}
+
 # 旧エンドポイントは互換性のために残すか、削除してもOK
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
@@ -641,4 +614,6 @@ async def chat_endpoint(request: ChatRequest):
 # フロントエンド配信の設定
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FRONTEND_DIR = os.path.join(os.path.dirname(BASE_DIR), "frontend")
-app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="static")
+# 事前圧縮・ハッシュ付きURL・Service Worker 対応の配信
+static_files = PrecompressedStaticFiles(directory=FRONTEND_DIR, html=True)
+app.mount("/", static_files, name="static")
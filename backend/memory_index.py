@@ -0,0 +1,157 @@
+"""
+長期記憶ファイルの索引（関係する部分だけをプロンプトに入れる）
+
+以前は起動時に memory/*.md を全部つなげて system_instruction に入れていたので、
+MEMORY.md が育つほど毎ターンの入力トークンが増え、コンパクションの結果は再起動まで反映されなかった。
+- IDENTITY.md は常にシステムプロンプトに入れる（キャラクターの核なので）
+- USER.md のタイトル直下（名前など基本のプロフィール）も常に入れる（「おはよう」のような発言でも相手が誰か分かるように）
+- USER.md の見出しより下と MEMORY.md はエントリ単位 (backend.memory_sections) に分けて文字 n-gram ベクトルで索引し、
+  そのターンの発言に関係するものだけを MIO_MEMORY_BUDGET_CHARS 文字まで発言の前に付ける
+- ファイルの更新時刻を毎ターン見て、変わっていたら読み直す（別ワーカーのコンパクションにも追従する）
+
+MIO_MEMORY_RETRIEVAL=0 なら従来どおり全ファイルをシステムプロンプトに入れる（読み直しは同じく効く）。
+"""
+import os
+import hashlib
+
+import numpy as np
+
+from backend import metrics
+from backend.embeddings import LocalNgramProvider
+from backend.memory_sections import MemoryDoc, TOP_SECTION, strip_bullet
+
+MEMORY_RETRIEVAL = os.getenv("MIO_MEMORY_RETRIEVAL", "1") == "1"
+MEMORY_BUDGET_CHARS = int(os.getenv("MIO_MEMORY_BUDGET_CHARS", "1200"))          # 1ターンに入れる長期記憶の上限（文字数）
+MEMORY_MIN_SIMILARITY = float(os.getenv("MIO_MEMORY_MIN_SIMILARITY", "0.12"))    # これ未満のエントリは入れない
+MEMORY_INDEX_DIMS = 1024  # DB には保存しないので、短い文でもハッシュの衝突が少ないよう大きめにする
+
+IDENTITY_FILE = "memory/IDENTITY.md"
+INDEXED_FILES = {"memory/USER.md": "ユーザーについて", "memory/MEMORY.md": "これまでの思い出"}
+PROFILE_FILES = ("memory/USER.md",)  # タイトル直下のセクションは索引せず、常にシステムプロンプトに入れる
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        return None
+
+
+def _profile_text(doc):
+    """タイトルとタイトル直下のエントリ（最初の見出しより前）"""
+    lines = list(doc.title_lines) + [e.text for e in doc.sections[0].entries]
+    return "\n".join(lines) + "\n" if doc.sections[0].entries else ""
+
+
+class MemoryIndex:
+    def __init__(self, identity_file=IDENTITY_FILE, indexed_files=INDEXED_FILES,
+                 retrieval=MEMORY_RETRIEVAL, budget=MEMORY_BUDGET_CHARS, min_similarity=MEMORY_MIN_SIMILARITY,
+                 profile_files=PROFILE_FILES):
+        self.identity_file = identity_file
+        self.indexed_files = dict(indexed_files)
+        self.profile_files = set(profile_files)
+        self.retrieval = retrieval
+        self.budget = budget
+        self.min_similarity = min_similarity
+        self.scorer = LocalNgramProvider(dims=MEMORY_INDEX_DIMS)
+        self.chunks = []  # (ファイル, 本文)
+        self.matrix = np.zeros((0, self.scorer.dims), dtype=np.float32)
+        self.system_text = ""
+        self.prompt_version = None  # システムプロンプトに入る部分のハッシュ（変わったらモデルを作り直す）
+        self._stamps = None
+        metrics.register_gauge("mio_memory_chunks", lambda: len(self.chunks))
+
+    def refresh(self):
+        """ファイルが変わっていたら読み直す。読み直したら True"""
+        paths = [self.identity_file, *self.indexed_files]
+        stamps = [_stamp(p) for p in paths]
+        if stamps == self._stamps:
+            return False
+        self._load()
+        self._stamps = stamps
+        return True
+
+    def _load(self):
+        texts = {path: _read(path) for path in [self.identity_file, *self.indexed_files]}
+
+        if self.retrieval:
+            docs = {path: MemoryDoc.parse(texts[path]) for path in self.indexed_files}
+            system_parts = [(self.identity_file, texts[self.identity_file])]
+            for path in self.indexed_files:
+                if path in self.profile_files:
+                    profile = _profile_text(docs[path])
+                    if profile:
+                        system_parts.append((path, profile))
+        else:
+            system_parts = list(texts.items())
+        self.system_text = "".join(
+            f"\n\n--- {os.path.basename(path)} ---\n{text}" for path, text in system_parts
+        )
+        self.prompt_version = hashlib.sha1(self.system_text.encode("utf-8")).hexdigest()[:12]
+
+        chunks, vectors = [], []
+        if self.retrieval:
+            for path, doc in docs.items():
+                for section, entry in doc.entries():
+                    if path in self.profile_files and section.id == TOP_SECTION:
+                        continue  # システムプロンプトに入っている
+                    body = " ".join(strip_bullet(entry.text).split())
+                    if not body:
+                        continue
+                    # 見出しはモデルに渡すときだけ付ける（「約束」の下の「遊園地」など、意味を補う）。
+                    # ベクトルに混ぜると短いエントリの一致が薄まるので本文だけで作る
+                    chunks.append((path, f"{section.heading}: {body}" if section.heading else body))
+                    vectors.append(self.scorer.embed_one(body))
+        self.chunks = chunks
+        self.matrix = (
+            np.array(vectors, dtype=np.float32) if vectors else np.zeros((0, self.scorer.dims), dtype=np.float32)
+        )
+        print(f"[Memory] Loaded long-term memory ({len(chunks)} entries indexed, prompt {self.prompt_version})")
+
+    def select(self, query):
+        """発言に関係するエントリを予算内で選ぶ。[(ファイル, 本文), ...]（関係が強い順）"""
+        if not self.retrieval or not self.chunks or not query:
+            return []
+        q = np.array(self.scorer.embed_one(query), dtype=np.float32)
+        scores = self.matrix @ q
+        picked, used = [], 0
+        for i in np.argsort(-scores):
+            if scores[i] < self.min_similarity:
+                break
+            path, text = self.chunks[i]
+            if used + len(text) > self.budget:
+                continue  # 長いものは飛ばして、入る短いものを探す
+            picked.append((path, text))
+            used += len(text)
+        return picked
+
+    def format(self, picked):
+        """選んだエントリを発言の前に付けるテキストにする（ファイルごとにまとめる）"""
+        if not picked:
+            return ""
+        blocks = []
+        for path, label in self.indexed_files.items():
+            lines = [f"- {text}" for p, text in picked if p == path]
+            if lines:
+                blocks.append(f"({label})\n" + "\n".join(lines))
+        return "【長期記憶（今の話題に関係するもの）】\n" + "\n".join(blocks)
+
+    def status(self):
+        return {
+            "retrieval": self.retrieval,
+            "entries": len(self.chunks),
+            "budget_chars": self.budget,
+            "prompt_version": self.prompt_version,
+            "system_chars": len(self.system_text),
+        }
+
+
+memory_index = MemoryIndex()
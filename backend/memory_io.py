@@ -0,0 +1,252 @@
+"""
+記憶のエクスポート / インポート (NDJSON)
+
+開発PCとラズパイの間で mio_memory.db と memory/*.md を手でコピーしなくて済むようにする。
+1行1レコードの NDJSON で、先頭はヘッダー:
+
+    {"type": "header", "format": "mio-memory", "version": 2, "exported_at": ...}
+    {"type": "file", "path": "memory/USER.md", "content": "..."}
+    {"type": "log", "role": "user", "content": "...", "timestamp": ..., "metadata": ..., "embeddings": {"<model>": "<base64>"}}
+    {"type": "archive", ... , "archived_at": ...}
+    {"type": "summary", "summary": "...", "created_at": ..., ...}
+
+- embeddings はモデルごとのベクトル。float32 リトルエンディアンの Base64（JSON配列より小さく、誤差なし）
+- version 1 の "embedding" / "embedding_model"（1行1ベクトル）も読める
+- エクスポートはページ単位で読んで流すだけ、インポートも1行ずつ読むのでメモリは一定
+- インポートは BATCH_SIZE 件ずつ1トランザクションでまとめて挿入する
+- 今のモデルのベクトルが入っている行は再ベクトル化しない（reembed="missing"）。"all" で全部作り直し、"none" で一切しない
+- インポートは追記のみ（既存の記憶は消さない）。すでにある記録（同じ時刻・話者・本文）は飛ばすので、
+  同じファイルを何度取り込んでも重複しない（飛ばした件数は duplicates）
+
+CLI:
+    python -m backend.memory_io export mio_memory.ndjson
+    python -m backend.memory_io import mio_memory.ndjson [--reembed none|missing|all] [--no-files]
+"""
+import os
+import sys
+import json
+import time
+import codecs
+import base64
+import asyncio
+import argparse
+
+import numpy as np
+
+if __name__ == "__main__":
+    # CLI のときは各モジュールが設定を読む前に .env を読み込む
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from backend.database import db, LEGACY_EMBEDDING_MODEL
+from backend.embeddings import embed_texts, available as embedding_available, EMBEDDING_MODEL
+from backend.locks import file_lock, write_file_atomic
+
+FORMAT = "mio-memory"
+VERSION = 2
+BATCH_SIZE = int(os.getenv("MIO_IMPORT_BATCH_SIZE", "500"))
+MEMORY_FILES = ("memory/IDENTITY.md", "memory/USER.md", "memory/MEMORY.md")
+
+# レコードの type -> テーブル
+TABLES = {
+    "log": "conversation_logs",
+    "archive": "conversation_archive",
+    "summary": "memory_summaries",
+}
+REQUIRED_FIELDS = {
+    "log": ("role", "content", "timestamp"),
+    "archive": ("role", "content", "timestamp"),
+    "summary": ("summary", "created_at"),
+}
+REEMBED_MODES = ("none", "missing", "all")
+
+
+def encode_embedding(vector):
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def decode_embedding(text):
+    vector = np.frombuffer(base64.b64decode(text, validate=True), dtype="<f4").tolist()
+    if not vector:
+        raise ValueError("empty vector")
+    return vector
+
+
+def _read_embeddings(record):
+    """レコードのベクトルを {モデル: ベクトル} にする（version 1 の embedding / embedding_model も読む）"""
+    embeddings = {model: decode_embedding(text) for model, text in (record.pop("embeddings", None) or {}).items()}
+    legacy, model = record.pop("embedding", None), record.pop("embedding_model", None)
+    if legacy is not None:
+        embeddings.setdefault(model or LEGACY_EMBEDDING_MODEL, decode_embedding(legacy))
+    return embeddings
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+# --- エクスポート ---
+async def export_ndjson(include_files=True, page_size=BATCH_SIZE):
+    """NDJSON を1行ずつ yield する"""
+    yield _line({"type": "header", "format": FORMAT, "version": VERSION, "exported_at": time.time()})
+
+    if include_files:
+        for path in MEMORY_FILES:
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    yield _line({"type": "file", "path": path, "content": f.read()})
+
+    for record_type, table in TABLES.items():
+        after_id = 0
+        while True:
+            rows = await db.export_page(table, after_id, page_size)
+            if not rows:
+                break
+            for row in rows:
+                after_id = row.pop("id")
+                if "embeddings" in row:
+                    row["embeddings"] = {model: encode_embedding(v) for model, v in row["embeddings"].items()}
+                yield _line({"type": record_type, **row})
+
+
+# --- インポート ---
+async def iter_lines(chunks):
+    """バイト列のチャンク（HTTPボディなど）を行に分ける。未完了の行だけを保持する"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _flush(table, batch, embed, reembed, stats):
+    rows = await db.new_rows(table, batch)  # 取り込み済みの行はベクトル化もしない
+    stats["duplicates"] += len(batch) - len(rows)
+    batch.clear()
+    if embed and reembed != "none":
+        targets = [r for r in rows if reembed == "all" or EMBEDDING_MODEL not in r["embeddings"]]
+        if targets:
+            try:
+                vectors = await embed([r["content"] for r in targets])
+                for row, vector in zip(targets, vectors):
+                    row["embeddings"][EMBEDDING_MODEL] = vector
+                stats["embedded"] += len(targets)
+            except Exception as e:
+                # ベクトルなしでも全文検索では見つかるので、取り込み自体は続ける
+                print(f"⚠ [Import] Embedding failed for {len(targets)} rows: {e}")
+    inserted = await db.import_rows(table, rows)
+    stats["duplicates"] += len(rows) - inserted  # 確認してから挿入するまでの間に別のインポートが入れた分
+    stats[table] += inserted
+
+
+async def import_ndjson(lines, embed=None, reembed="missing", include_files=True, batch_size=BATCH_SIZE):
+    """NDJSON の行を読み込んで取り込む。件数を返す"""
+    if reembed not in REEMBED_MODES:
+        raise ValueError(f"reembed must be one of {REEMBED_MODES}")
+
+    stats = {table: 0 for table in TABLES.values()}
+    stats.update({"files": 0, "embedded": 0, "skipped": 0, "duplicates": 0})
+    batches = {table: [] for table in TABLES.values()}
+    header = None
+    line_no = 0
+
+    async for line in lines:
+        line_no += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {line_no}: invalid JSON ({e})") from None
+
+        record_type = record.pop("type", None)
+        if header is None:
+            if record_type != "header" or record.get("format") != FORMAT:
+                raise ValueError("not a MIO memory export (missing header)")
+            if record.get("version", 0) > VERSION:
+                raise ValueError(f"unsupported export version: {record.get('version')}")
+            header = record
+            continue
+
+        if record_type == "file":
+            # 書き込み先は決まった記憶ファイルだけ（パスをそのまま信じない）
+            if include_files and record.get("path") in MEMORY_FILES:
+                os.makedirs(os.path.dirname(record["path"]), exist_ok=True)
+                async with file_lock("memory_files"):
+                    write_file_atomic(record["path"], record.get("content", ""))
+                stats["files"] += 1
+            else:
+                stats["skipped"] += 1
+            continue
+
+        table = TABLES.get(record_type)
+        if table is None:
+            stats["skipped"] += 1
+            continue
+        missing = [f for f in REQUIRED_FIELDS[record_type] if record.get(f) is None]
+        if missing:
+            raise ValueError(f"line {line_no}: missing {', '.join(missing)}")
+        try:
+            if table != "memory_summaries":
+                record["embeddings"] = _read_embeddings(record)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"line {line_no}: invalid embedding ({e})") from None
+
+        batch = batches[table]
+        batch.append(record)
+        if len(batch) >= batch_size:
+            await _flush(table, batch, embed if table != "memory_summaries" else None, reembed, stats)
+
+    if header is None:
+        raise ValueError("empty import")
+    for table, batch in batches.items():
+        await _flush(table, batch, embed if table != "memory_summaries" else None, reembed, stats)
+
+    print(f"[Import] Done: {stats}")
+    return stats
+
+
+# --- CLI ---
+async def _file_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield line
+
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(prog="python -m backend.memory_io", description="MIO memory export/import (NDJSON)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export")
+    p_export.add_argument("path", help="出力先 (- で標準出力)")
+    p_export.add_argument("--no-files", action="store_true", help="memory/*.md を含めない")
+    p_import = sub.add_parser("import")
+    p_import.add_argument("path")
+    p_import.add_argument("--reembed", choices=REEMBED_MODES, default="missing")
+    p_import.add_argument("--no-files", action="store_true", help="memory/*.md を上書きしない")
+    args = parser.parse_args(argv)
+
+    await db.init_db()
+    if args.command == "export":
+        out = sys.stdout if args.path == "-" else open(args.path, "w", encoding="utf-8")
+        try:
+            async for line in export_ndjson(include_files=not args.no_files):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    else:
+        embed = embed_texts if embedding_available() else None
+        stats = await import_ndjson(
+            _file_lines(args.path), embed=embed, reembed=args.reembed, include_files=not args.no_files
+        )
+        print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1:]))
@@ -0,0 +1,272 @@
+"""
+長期記憶ファイル (memory/*.md) のセクション分け
+
+ファイルを「見出し (## 以下) ごとのセクション」と「エントリ（1行。箇条書きはインデントされた続きの行も含む）」に分け、
+セクションには見出しから、エントリには内容のハッシュから ID を振る。
+- コンパクションでは、新しい情報に関係するセクション/エントリだけを ID つきで編纂AIに見せる
+- 編纂AIは add / update / delete の差分を JSON で返し、それを ID で当てはめる
+- ID は内容のハッシュなので、見せた後に手で書き換えられたエントリへの差分は当たらない（捨てる）
+- 差分が当たらなかったり JSON が壊れていても、ファイル全体が壊れることはない
+
+Gemini も DB も使わない（パースと差分の適用だけ）。
+"""
+import re
+import hashlib
+
+import numpy as np
+
+from backend.embeddings import LocalNgramProvider
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*\S)\s*$")
+_BULLET = re.compile(r"^\s*(?:[-*+]|\d+\.)\s+")
+
+TOP_SECTION = "top"  # 最初の見出しより前（タイトル直下）のセクション
+
+
+def _digest(text, length=8):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:length]
+
+
+def strip_bullet(text):
+    return _BULLET.sub("", text, count=1).strip()
+
+
+class Entry:
+    __slots__ = ("id", "text")
+
+    def __init__(self, text):
+        self.text = text.rstrip()
+        self.id = None  # MemoryDoc.assign_ids で振る
+
+    @property
+    def is_bullet(self):
+        return bool(_BULLET.match(self.text))
+
+
+class Section:
+    __slots__ = ("id", "heading", "level", "entries")
+
+    def __init__(self, heading=None, level=2, entries=None):
+        self.heading = heading
+        self.level = level
+        self.entries = entries or []
+        self.id = TOP_SECTION if heading is None else "s-" + _digest(heading.strip(), 6)
+
+    def uses_bullets(self):
+        return bool(self.entries) and sum(e.is_bullet for e in self.entries) * 2 >= len(self.entries)
+
+    def render(self):
+        lines = [] if self.heading is None else ["#" * self.level + " " + self.heading]
+        lines += [e.text for e in self.entries]
+        return "\n".join(lines)
+
+
+class MemoryDoc:
+    """記憶ファイル1つ分（タイトル行 + セクションの並び）"""
+
+    def __init__(self, title_lines, sections):
+        self.title_lines = title_lines
+        self.sections = sections
+        self.assign_ids()
+
+    @classmethod
+    def parse(cls, text):
+        title_lines = []
+        top = Section()
+        sections = [top]
+        current = top
+        for line in (text or "").splitlines():
+            if not line.strip():
+                continue
+            m = _HEADING.match(line)
+            if m and len(m.group(1)) == 1 and current is top and not top.entries:
+                title_lines.append(line.rstrip())  # "# User Profile" などのファイルタイトル
+                continue
+            if m:
+                current = Section(m.group(2), len(m.group(1)))
+                sections.append(current)
+                continue
+            if line[:1] in (" ", "\t") and current.entries and current.entries[-1].is_bullet:
+                # 箇条書きの続きの行（ネストした箇条書きも親のエントリに含める）
+                current.entries[-1].text += "\n" + line.rstrip()
+                continue
+            current.entries.append(Entry(line))
+        return cls(title_lines, sections)
+
+    def assign_ids(self):
+        """内容のハッシュで ID を振る（同じ内容が複数あれば連番をつける）"""
+        seen = {}
+        for section in self.sections:
+            for entry in section.entries:
+                base = "e-" + _digest(" ".join(entry.text.split()))
+                seen[base] = seen.get(base, 0) + 1
+                entry.id = base if seen[base] == 1 else f"{base}-{seen[base]}"
+        section_seen = {}
+        for section in self.sections:
+            section_seen[section.id] = section_seen.get(section.id, 0) + 1
+            if section_seen[section.id] > 1:
+                section.id = f"{section.id}-{section_seen[section.id]}"
+
+    def render(self):
+        blocks = []
+        if self.title_lines:
+            blocks.append("\n".join(self.title_lines))
+        blocks += [s.render() for s in self.sections if s.heading is not None or s.entries]
+        # タイトル直下のエントリはタイトルとくっつける（元のファイルの書き方に合わせる）
+        if self.title_lines and self.sections[0].entries:
+            blocks[0:2] = [blocks[0] + "\n" + blocks[1]]
+        return "\n\n".join(blocks) + "\n"
+
+    def entries(self):
+        for section in self.sections:
+            for entry in section.entries:
+                yield section, entry
+
+    def entry_count(self):
+        return sum(len(s.entries) for s in self.sections)
+
+    def section_by_id(self, section_id):
+        """ID で探す（見出しの文字列でも可）"""
+        if not isinstance(section_id, str):
+            return None  # タイトル直下のセクションは heading が None なので、None では探さない
+        return next((s for s in self.sections if section_id in (s.id, s.heading)), None)
+
+
+# --- 関係するセクションの選択 ---
+_scorer = LocalNgramProvider()  # 設定の埋め込みプロバイダとは関係なく、オフラインで速いものを使う
+
+
+def select_context(doc, facts, threshold=0.2, full_section_entries=20, max_entries=60):
+    """新しい情報に関係するエントリを選ぶ。{セクションID: [エントリ, ...]} を返す
+
+    関係するセクションは、小さければ丸ごと、大きければ関係するエントリだけ。
+    """
+    if not facts:
+        return {}
+    fact_matrix = np.array([_scorer.embed_one(f) for f in facts], dtype=np.float32)
+
+    def score(text):
+        return float((fact_matrix @ np.array(_scorer.embed_one(text), dtype=np.float32)).max())
+
+    scored = []  # (スコア, セクション, エントリ)
+    touched = set()
+    for section in doc.sections:
+        if section.heading and score(section.heading) >= threshold:
+            touched.add(section.id)
+        for entry in section.entries:
+            s = score(strip_bullet(entry.text))
+            scored.append((s, section, entry))
+            if s >= threshold:
+                touched.add(section.id)
+
+    selected = {}
+    budget = max_entries
+    for section in doc.sections:
+        if section.id not in touched:
+            continue
+        if len(section.entries) <= full_section_entries:
+            picked = list(section.entries)
+        else:
+            ranked = sorted((x for x in scored if x[1] is section), key=lambda x: x[0], reverse=True)
+            picked = [e for s, _, e in ranked if s >= threshold][:full_section_entries]
+            picked.sort(key=section.entries.index)
+        picked = picked[:budget]
+        budget -= len(picked)
+        selected[section.id] = picked
+        if budget <= 0:
+            break
+    return selected
+
+
+def format_context(doc, selected):
+    """編纂AIに見せるテキスト（全セクションの目次 + 選んだエントリを ID つきで）"""
+    outline = []
+    for section in doc.sections:
+        heading = section.heading or "(タイトル直下)"
+        outline.append(f"- [{section.id}] {heading} ({len(section.entries)}件)")
+    body = []
+    for section in doc.sections:
+        if section.id not in selected:
+            continue
+        body.append(f"## [{section.id}] {section.heading or '(タイトル直下)'}")
+        for entry in selected[section.id]:
+            body.append(f"[{entry.id}] {entry.text}")
+        if len(selected[section.id]) < len(section.entries):
+            body.append(f"（他 {len(section.entries) - len(selected[section.id])} 件は省略）")
+    return "【セクション一覧】\n" + "\n".join(outline) + "\n\n【関係するエントリ】\n" + ("\n".join(body) or "（なし）")
+
+
+# --- 差分の適用 ---
+def apply_ops(doc, ops, visible_ids=None):
+    """編纂AIの差分を当てる。{"added", "updated", "deleted", "skipped"} の件数を返す
+
+    ops の形式:
+      {"op": "add", "section": "<セクションID>", "text": "..."}
+      {"op": "add_section", "heading": "...", "entries": ["...", ...]}
+      {"op": "update", "id": "<エントリID>", "text": "..."}
+      {"op": "delete", "id": "<エントリID>"}
+    visible_ids を渡すと、その中のエントリしか書き換え/削除しない（見せていないものは触らせない）。
+    add のセクションID が見つからなければ当てずに skipped に数える。
+    """
+    stats = {"added": 0, "updated": 0, "deleted": 0, "skipped": 0}
+    emptied = set()  # この差分の削除で中身がなくなったセクション
+    by_id = {entry.id: (section, entry) for section, entry in doc.entries()}
+    all_entries = [entry for _, entry in doc.entries()]
+    doc_bullets = not all_entries or sum(e.is_bullet for e in all_entries) * 2 >= len(all_entries)
+
+    def format_text(section, text, like=None):
+        # 箇条書きかどうかは、書き換える元のエントリ → セクション → ファイル全体の書き方に合わせる
+        text = str(text).strip()
+        if like is not None:
+            bullet = like.is_bullet
+        else:
+            bullet = section.uses_bullets() if section.entries else doc_bullets
+        if bullet and not _BULLET.match(text):
+            return "- " + text
+        if not bullet and _BULLET.match(text):
+            return strip_bullet(text)
+        return text
+
+    for op in ops if isinstance(ops, list) else []:
+        if not isinstance(op, dict):
+            stats["skipped"] += 1
+            continue
+        kind = op.get("op")
+        target = by_id.get(op.get("id"))
+        text = op.get("text")
+        if kind in ("update", "delete") and (
+            target is None or target[1] not in target[0].entries  # 無い or 同じ差分の中で削除済み
+            or (visible_ids is not None and op.get("id") not in visible_ids)
+        ):
+            stats["skipped"] += 1
+        elif kind == "update" and isinstance(text, str) and text.strip():
+            section, entry = target
+            entry.text = format_text(section, text, like=entry)
+            stats["updated"] += 1
+        elif kind == "delete":
+            section, entry = target
+            section.entries.remove(entry)
+            if not section.entries:
+                emptied.add(section)
+            stats["deleted"] += 1
+        elif kind == "add" and isinstance(text, str) and text.strip() and doc.section_by_id(op.get("section")):
+            section = doc.section_by_id(op.get("section"))
+            section.entries.append(Entry(format_text(section, text)))
+            stats["added"] += 1
+        elif kind == "add_section" and isinstance(op.get("heading"), str) and op["heading"].strip():
+            heading = op["heading"].strip().lstrip("#").strip()
+            section = next((s for s in doc.sections if s.heading == heading), None)
+            if section is None:
+                section = Section(heading, 2)
+                doc.sections.append(section)
+            for item in op.get("entries") or []:
+                if isinstance(item, str) and item.strip():
+                    section.entries.append(Entry(format_text(section, item)))
+                    stats["added"] += 1
+        else:
+            stats["skipped"] += 1
+
+    # この差分で中身がなくなった見出しだけ消す（小見出しだけを持つ親の見出しなどは元から空なので残す）
+    doc.sections = [s for s in doc.sections if s.heading is None or s.entries or s not in emptied]
+    doc.assign_ids()
+    return stats
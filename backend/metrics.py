@@ -0,0 +1,103 @@
+"""
+簡易メトリクス
+
+/api/metrics で JSON、/api/metrics?format=prometheus で Prometheus テキスト形式を返す。
+複数ワーカー時の値はプロセスごと（レスポンスに pid を含める）。
+"""
+import os
+from collections import deque
+
+
+class Summary:
+    """観測値の件数・合計・最大と、直近ウィンドウのパーセンタイル"""
+
+    def __init__(self, window=500):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, p):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "max": round(self.max, 3),
+            "p50": round(self.percentile(0.5), 3),
+            "p95": round(self.percentile(0.95), 3),
+        }
+
+
+_summaries = {}  # (name, labels) -> Summary
+_gauges = {}     # (name, labels) -> 値を返す関数（増えたり減ったりする値）
+_counters = {}   # (name, labels) -> 値を返す関数（単調増加する累計。名前は _total で終える）
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def summary(name, **labels):
+    key = _key(name, labels)
+    if key not in _summaries:
+        _summaries[key] = Summary()
+    return _summaries[key]
+
+
+def register_gauge(name, fn, **labels):
+    _gauges[_key(name, labels)] = fn
+
+
+def register_counter(name, fn, **labels):
+    _counters[_key(name, labels)] = fn
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def snapshot():
+    return {
+        "pid": os.getpid(),
+        "gauges": {name + _label_str(labels): fn() for (name, labels), fn in _gauges.items()},
+        "counters": {name + _label_str(labels): fn() for (name, labels), fn in _counters.items()},
+        "summaries": {name + _label_str(labels): s.snapshot() for (name, labels), s in _summaries.items()},
+    }
+
+
+def render_prometheus():
+    lines = []
+
+    def type_line(name, kind):
+        # 同じ名前の TYPE 行は最初の1回だけ
+        line = f"# TYPE {name} {kind}"
+        if line not in typed:
+            typed.add(line)
+            lines.append(line)
+
+    typed = set()
+    for kind, values in (("gauge", _gauges), ("counter", _counters)):
+        for (name, labels), fn in sorted(values.items()):
+            type_line(name, kind)
+            lines.append(f"{name}{_label_str(labels)} {fn()}")
+    for (name, labels), s in sorted(_summaries.items()):
+        type_line(name, "summary")
+        lines.append(f"{name}_count{_label_str(labels)} {s.count}")
+        lines.append(f"{name}_sum{_label_str(labels)} {s.total}")
+        for q in (0.5, 0.95):
+            quantile = _label_str(labels + (("quantile", q),))
+            lines.append(f"{name}{quantile} {s.percentile(q)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,201 @@
+"""
+モデルチェーン（最初のトークンの締め切り + 軽いモデルへの自動フォールバック）
+
+- MIO_CHAT_MODELS に先頭から優先順でモデル名を並べる（カンマ区切り）
+- MIO_FIRST_TOKEN_DEADLINE_MS 以内に最初のチャンクが来なければ、そのリクエストは見捨てて次のモデルでやり直す
+- 最初のチャンクが来る前のエラー（混雑による 503 など）や、チャンクなしで終わった場合も次のモデルへ
+- 最後のモデルは締め切りなしで待つ（全滅させるよりは遅くても返す）
+- 使ったモデルとフォールバックの経緯は info に入る（会話ログの metadata に保存する）
+
+SDK のストリームは同期イテレーターなので、専用スレッドで回して asyncio.Queue に流し込む。
+止まったスレッドは中断できないので、結果を捨てるだけにする（daemon スレッド）。
+モデルは factory(name) で作るので、テストでは止まる偽モデルを差し込める。
+"""
+import os
+import time
+import asyncio
+import threading
+
+from backend import metrics
+
+DEFAULT_MODELS = "gemini-3-flash-preview,gemini-2.5-flash-lite"
+
+CHAT_MODELS = [m.strip() for m in os.getenv("MIO_CHAT_MODELS", DEFAULT_MODELS).split(",") if m.strip()]
+COMPACTION_MODELS = [m.strip() for m in os.getenv("MIO_COMPACTION_MODELS", ",".join(CHAT_MODELS)).split(",") if m.strip()]
+FIRST_TOKEN_DEADLINE_MS = int(os.getenv("MIO_FIRST_TOKEN_DEADLINE_MS", "8000"))
+# コンパクションは一括生成なので「最初のトークン = 全文」。締め切りは長めに取る
+COMPACTION_DEADLINE_MS = int(os.getenv("MIO_COMPACTION_DEADLINE_MS", "120000"))
+
+
+class ModelTimeout(Exception):
+    """締め切りまでに最初のチャンクが来なかった"""
+
+
+class EmptyResponse(Exception):
+    """チャンクをひとつも返さずに終わった（安全フィルターでブロックされた場合など）"""
+
+
+def _start_thread(loop, target, *args):
+    thread = threading.Thread(target=target, args=(loop, *args), daemon=True)
+    thread.start()
+
+
+def _stream_worker(loop, queue, cancelled, model, history, content):
+    """スレッド側: SDK のストリームを回して (種類, 値) を Queue に送る"""
+    def put(item):
+        if not cancelled.is_set():
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                pass  # イベントループが終了済み
+
+    try:
+        chat = model.start_chat(history=history)
+        response = chat.send_message(content, stream=True)
+        put(("response", response))
+        for chunk in response:
+            if cancelled.is_set():
+                return
+            put(("chunk", chunk))
+        put(("done", None))
+    except Exception as e:
+        put(("error", e))
+
+
+def _generate_worker(loop, future, cancelled, model, contents):
+    def settle(method, value):
+        if not cancelled.is_set() and not future.done():
+            method(value)
+
+    try:
+        outcome = (future.set_result, model.generate_content(contents))
+    except Exception as e:
+        outcome = (future.set_exception, e)
+    try:
+        loop.call_soon_threadsafe(settle, *outcome)
+    except RuntimeError:
+        pass  # イベントループが終了済み
+
+
+class ChainStream:
+    """チェーン経由のストリーム（async for でチャンクを受け取る）"""
+
+    def __init__(self, chain, history, content):
+        self.chain = chain
+        self.history = history
+        self.content = content
+        self.response = None  # SDK のレスポンス（usage_metadata 用）
+        self.info = {"model": None, "fallbacks": []}
+
+    async def __aiter__(self):
+        names = self.chain.names
+        for i, name in enumerate(names):
+            last = i == len(names) - 1
+            queue = asyncio.Queue()
+            cancelled = threading.Event()
+            model = self.chain.get_model(name)
+            started = time.perf_counter()
+            _start_thread(asyncio.get_running_loop(), _stream_worker, queue, cancelled, model, self.history, self.content)
+
+            try:
+                try:
+                    first = await self._first_chunk(queue, None if last else self.chain.deadline)
+                except Exception as e:
+                    if last:
+                        if isinstance(e, EmptyResponse):
+                            # 最後のモデルも空なら、空のまま終える
+                            self.info["model"] = name
+                            print(f"⚠ [Model] {name} returned no content.")
+                            return
+                        raise
+                    if isinstance(e, ModelTimeout):
+                        reason = "timeout"
+                    elif isinstance(e, EmptyResponse):
+                        reason = "empty response"
+                    else:
+                        reason = f"{type(e).__name__}: {e}"
+                    elapsed = round((time.perf_counter() - started) * 1000)
+                    self.info["fallbacks"].append({"model": name, "reason": reason, "elapsed_ms": elapsed})
+                    print(f"⚠ [Model] {name} failed before first token ({reason}, {elapsed}ms). Falling back to {names[i + 1]}")
+                    continue
+
+                self.info["model"] = name
+                metrics.summary("mio_first_token_seconds", model=name).observe(time.perf_counter() - started)
+                yield first
+                while True:
+                    kind, value = await queue.get()
+                    if kind == "chunk":
+                        yield value
+                    elif kind == "response":
+                        self.response = value
+                    elif kind == "error":
+                        raise value
+                    else:
+                        return
+            finally:
+                # 見捨てた（または中断された）スレッドの結果は以後捨てる
+                cancelled.set()
+
+    async def _first_chunk(self, queue, deadline):
+        """最初のチャンクを待つ。チャンクなしで終わった場合は EmptyResponse"""
+        loop = asyncio.get_running_loop()
+        until = None if deadline is None else loop.time() + deadline
+        while True:
+            timeout = None if until is None else max(0, until - loop.time())
+            try:
+                kind, value = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                raise ModelTimeout() from None
+            if kind == "response":
+                self.response = value
+            elif kind == "chunk":
+                return value
+            elif kind == "error":
+                raise value
+            else:
+                raise EmptyResponse()
+
+
+class ModelChain:
+    """優先順に並べたモデルを締め切り付きで順に試す"""
+
+    def __init__(self, names, factory, deadline_ms=FIRST_TOKEN_DEADLINE_MS):
+        if not names:
+            raise ValueError("model chain is empty")
+        self.names = list(names)
+        self.factory = factory
+        self.deadline = deadline_ms / 1000
+        self._models = {}
+
+    def get_model(self, name):
+        if name not in self._models:
+            self._models[name] = self.factory(name)
+        return self._models[name]
+
+    def stream_chat(self, history, content):
+        """チャット履歴 + 入力でストリーミング生成する"""
+        return ChainStream(self, history, content)
+
+    async def generate(self, contents):
+        """一括生成。(レスポンス, info) を返す"""
+        info = {"model": None, "fallbacks": []}
+        loop = asyncio.get_running_loop()
+        for i, name in enumerate(self.names):
+            last = i == len(self.names) - 1
+            future = loop.create_future()
+            cancelled = threading.Event()
+            started = time.perf_counter()
+            _start_thread(loop, _generate_worker, future, cancelled, self.get_model(name), contents)
+            try:
+                result = await asyncio.wait_for(future, None if last else self.deadline)
+            except Exception as e:
+                cancelled.set()
+                if last:
+                    raise
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else f"{type(e).__name__}: {e}"
+                elapsed = round((time.perf_counter() - started) * 1000)
+                info["fallbacks"].append({"model": name, "reason": reason, "elapsed_ms": elapsed})
+                print(f"⚠ [Model] {name} failed ({reason}, {elapsed}ms). Falling back to {self.names[i + 1]}")
+                continue
+            info["model"] = name
+            return result, info
@@ -0,0 +1,129 @@
+"""
+入力中の先読み (Speculative RAG prefetch)
+
+送信されてからベクトル化と記憶検索をしていると、その分だけ Gemini の呼び出しが遅れる。
+- フロントが入力中の下書きを /api/prefetch に送る（デバウンス済み）
+- サーバーは裏でベクトル化 + 記憶検索をして、(セッション, 正規化したテキスト) をキーに少しの間だけ持っておく
+- stream_chat に同じセッションから同じテキストが来たら、その結果をそのまま使う
+- ほぼ同じテキストなら関連記憶だけ使う（ベクトルは別の文のものなので、会話ログには送信文で作り直したものを保存する）
+
+キャッシュはプロセスごと。複数ワーカーで別のワーカーに当たった場合は普通に計算するだけ。
+"""
+import os
+import re
+import time
+import asyncio
+import difflib
+import unicodedata
+from collections import OrderedDict
+
+from backend import metrics
+
+PREFETCH_TTL = float(os.getenv("MIO_PREFETCH_TTL", "30"))               # 秒
+PREFETCH_SIMILARITY = float(os.getenv("MIO_PREFETCH_SIMILARITY", "0.9"))  # ほぼ同じとみなす類似度 (difflib)
+PREFETCH_MIN_CHARS = int(os.getenv("MIO_PREFETCH_MIN_CHARS", "4"))
+PREFETCH_MAX_ENTRIES = 64
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCT = re.compile(r"[。、．，.,!?！？\s]+$")
+
+
+def normalize(text):
+    """キー用の正規化（全角半角・空白・末尾の句読点の違いを無視）"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _SPACES.sub(" ", text).strip()
+    return _TRAILING_PUNCT.sub("", text)
+
+
+class _Entry:
+    __slots__ = ("task", "session", "created_at")
+
+    def __init__(self, task, session):
+        self.task = task
+        self.session = session
+        self.created_at = time.monotonic()
+
+
+class PrefetchCache:
+    """(セッション, 下書きテキスト) -> (ベクトル, 関連記憶) の短命キャッシュ"""
+
+    def __init__(self, ttl=PREFETCH_TTL, similarity=PREFETCH_SIMILARITY, max_entries=PREFETCH_MAX_ENTRIES):
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (セッション, 正規化テキスト) -> _Entry
+        self.hits = 0
+        self.misses = 0
+        metrics.register_gauge("mio_prefetch_entries", lambda: len(self.entries))
+        metrics.register_counter("mio_prefetch_hits_total", lambda: self.hits)
+        metrics.register_counter("mio_prefetch_misses_total", lambda: self.misses)
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, e in self.entries.items() if now - e.created_at > self.ttl]:
+            self._drop(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        if not entry.task.done():
+            entry.task.cancel()
+
+    def schedule(self, text, compute, session="default"):
+        """compute(text) を裏で実行して結果を持っておく。新しく始めたら True"""
+        normalized = normalize(text)
+        if len(normalized) < PREFETCH_MIN_CHARS:
+            return False
+        self._expire()
+        key = (session, normalized)
+        if key in self.entries:
+            return False
+        # 同じセッションのまだ終わっていない古い下書きは、もう送信されないので止める
+        for old_key in [k for k, e in self.entries.items() if e.session == session and not e.task.done()]:
+            self._drop(old_key)
+        task = asyncio.create_task(compute(text))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # 例外を回収（未取得警告を出さない）
+        self.entries[key] = _Entry(task, session)
+        return True
+
+    def _find(self, session, normalized):
+        """同じセッションの同じ/ほぼ同じ下書きのキー"""
+        if (session, normalized) in self.entries:
+            return (session, normalized)
+        best_key, best_ratio = None, self.similarity
+        for candidate in self.entries:
+            if candidate[0] != session:
+                continue
+            matcher = difflib.SequenceMatcher(None, normalized, candidate[1], autojunk=False)
+            if matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best_key, best_ratio = candidate, ratio
+        return best_key
+
+    async def take(self, text, session="default"):
+        """同じセッションの先読み結果を取り出す（まだ計算中なら待つ）。なければ None
+
+        (ベクトル, 関連記憶) を返す。ほぼ同じ下書きに当たった場合、ベクトルは送信文のものではないので None。
+        """
+        self._expire()
+        normalized = normalize(text)
+        key = self._find(session, normalized)
+        if key is None:
+            self.misses += 1
+            return None
+        entry = self.entries.pop(key)
+        await asyncio.wait({entry.task})
+        if entry.task.cancelled() or entry.task.exception():
+            self.misses += 1
+            return None
+        embedding, memories = entry.task.result()
+        exact = key[1] == normalized
+        self.hits += 1
+        print(f"★ [Prefetch] Hit ({'exact' if exact else 'near'}, {time.monotonic() - entry.created_at:.1f}s ago)")
+        return (embedding if exact else None), memories
+
+
+prefetch_cache = PrefetchCache()
@@ -0,0 +1,284 @@
+"""
+オンデマンド・プロファイリング
+
+ラズパイで「どこで時間を食っているか」を調べるための仕組み。
+普段は何もしない（ゼロコスト）で、管理API か環境変数で「次のN件」だけ計測する。
+
+- sample  : 全スレッドの定期スタックサンプリング（to_thread 先の Gemini/SQLite/JSON も見える）
+            -> profiles/<request_id>.collapsed (flamegraph.pl / speedscope でそのまま読める形式)
+- cprofile: イベントループスレッドの cProfile
+            -> profiles/<request_id>.prof (+ 上位関数の .txt)
+- イベントループ遅延モニター: ループが閾値以上ブロックされた区間を記録する
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import asyncio
+import cProfile
+import pstats
+import threading
+from collections import Counter, deque
+
+PROFILE_DIR = os.getenv("MIO_PROFILE_DIR", "profiles")
+PROFILE_MODE = os.getenv("MIO_PROFILE_MODE", "sample")  # sample or cprofile
+PROFILE_REQUESTS = int(os.getenv("MIO_PROFILE_REQUESTS", "0"))  # 起動直後から計測する件数
+SAMPLE_INTERVAL = float(os.getenv("MIO_PROFILE_SAMPLE_MS", "5")) / 1000
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("MIO_LOOP_LAG_MS", "0"))  # 0 = 遅延モニター無効
+
+# 計測対象のパス -> ターゲット名
+PROFILE_TARGETS = {
+    "/api/stream_chat": "stream_chat",
+    "/api/memory/compact": "compact",
+}
+
+
+class _StackSampler:
+    """全スレッドのスタックを一定間隔で採取するサンプラー（別スレッドで動く）"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mio-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    """1リクエスト分の計測"""
+
+    def __init__(self, target, mode):
+        self.request_id = f"{target}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.target = target
+        self.mode = mode
+        self.started_at = time.time()
+        self.lag_events = []
+        self._sampler = None
+        self._profile = None
+        self.duration = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = _StackSampler(SAMPLE_INTERVAL)
+            self._sampler.start()
+
+    def stop(self):
+        """計測を止める（イベントループ上で呼ぶ。ファイルには書かない）"""
+        self.duration = time.time() - self.started_at
+        if self._profile:
+            self._profile.disable()
+        if self._sampler:
+            self._sampler.stop()
+
+    def save(self, profile_dir):
+        """結果をファイルに書く（ブロッキングなのでスレッドで呼ぶ）"""
+        os.makedirs(profile_dir, exist_ok=True)
+        base = os.path.join(profile_dir, self.request_id)
+        files = []
+
+        if self._profile:
+            self._profile.dump_stats(base + ".prof")
+            summary = io.StringIO()
+            pstats.Stats(self._profile, stream=summary).sort_stats("cumulative").print_stats(40)
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(summary.getvalue())
+            files += [base + ".prof", base + ".txt"]
+
+        if self._sampler:
+            self._sampler.join()
+            self._sampler.dump(base + ".collapsed")
+            files.append(base + ".collapsed")
+
+        info = {
+            "request_id": self.request_id,
+            "target": self.target,
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 1),
+            "samples": self._sampler.samples if self._sampler else None,
+            "loop_lag_events": self.lag_events,
+            "files": files,
+        }
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+        return info
+
+
+class RequestProfiler:
+    """「次のN件」を計測するための管理クラス"""
+
+    def __init__(self, profile_dir=PROFILE_DIR, mode=PROFILE_MODE):
+        self.profile_dir = profile_dir
+        self.mode = mode
+        self.remaining = {target: 0 for target in PROFILE_TARGETS.values()}
+        self.active = None  # 同時に計測するのは1件だけ（cProfile はスレッドに1つしか付けられない）
+        self.recent = deque(maxlen=20)
+
+    def arm(self, count, targets=None, mode=None):
+        """次の count 件を計測対象にする"""
+        if mode in ("sample", "cprofile"):
+            self.mode = mode
+        for target in targets or self.remaining.keys():
+            if target in self.remaining:
+                self.remaining[target] = max(0, count)
+        print(f"[Profile] Armed: {self.remaining} (mode={self.mode})")
+
+    def start(self, target):
+        if self.active or self.remaining.get(target, 0) <= 0:
+            return None
+        self.remaining[target] -= 1
+        session = ProfileSession(target, self.mode)
+        session.start()
+        self.active = session
+        print(f"[Profile] Start: {session.request_id}")
+        return session
+
+    async def stop(self, session):
+        if session is None or session is not self.active:
+            return
+        self.active = None
+        session.stop()
+        try:
+            # 書き込みをループ上でやると、計測している遅延そのものを増やしてしまう
+            info = await asyncio.to_thread(session.save, self.profile_dir)
+            self.recent.appendleft(info)
+            print(f"[Profile] Saved: {session.request_id} ({info['duration_ms']}ms)")
+        except Exception as e:
+            print(f"[Profile] Save error: {e}")
+
+    def record_lag(self, event):
+        if self.active:
+            self.active.lag_events.append(event)
+
+    def status(self):
+        return {
+            "mode": self.mode,
+            "remaining": dict(self.remaining),
+            "active": self.active.request_id if self.active else None,
+            "recent": list(self.recent),
+        }
+
+
+class ProfilingMiddleware:
+    """計測対象パスのリクエストをまるごと（ストリーミング終了まで）計測するASGIミドルウェア
+
+    未計測時はパス判定だけで素通しするので、普段のオーバーヘッドはほぼゼロ。
+    """
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        target = PROFILE_TARGETS.get(scope.get("path")) if scope["type"] == "http" else None
+        session = self.profiler.start(target) if target else None
+        if session is None:
+            return await self.app(scope, receive, send)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", session.request_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            await self.profiler.stop(session)
+
+
+class LoopLagMonitor:
+    """イベントループが閾値以上ブロックされた区間を記録する"""
+
+    def __init__(self, profiler, threshold_ms=LOOP_LAG_THRESHOLD_MS, interval=0.05):
+        self.profiler = profiler
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.events = deque(maxlen=100)
+        self.count = 0
+        self.max_lag_ms = 0.0
+        self._task = None
+
+    def start(self, threshold_ms=None):
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        if self.threshold_ms <= 0 or (self._task and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._run())
+        print(f"[Profile] Loop lag monitor started (threshold={self.threshold_ms}ms)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = (loop.time() - started - self.interval) * 1000
+            if lag_ms < self.threshold_ms:
+                continue
+            event = {"at": time.time(), "lag_ms": round(lag_ms, 1)}
+            self.count += 1
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            self.events.appendleft(event)
+            self.profiler.record_lag(event)
+            print(f"⚠ [Profile] Event loop blocked for {lag_ms:.0f}ms")
+
+    def status(self):
+        return {
+            "running": bool(self._task and not self._task.done()),
+            "threshold_ms": self.threshold_ms,
+            "blocked_count": self.count,
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "recent": list(self.events),
+        }
+
+
+# グローバルインスタンス
+profiler = RequestProfiler()
+if PROFILE_REQUESTS > 0:
+    profiler.arm(PROFILE_REQUESTS)
+lag_monitor = LoopLagMonitor(profiler)
@@ -0,0 +1,198 @@
+"""
+システムプロンプト（プロンプトの先頭部分）の管理と Gemini のコンテキストキャッシュ
+
+システムプロンプトは毎ターン同じなのに、毎回送られて課金される。
+- プロンプトを内容のハッシュで版管理し、変わったらモデル (ModelChain) を作り直す
+- 先頭のモデルについては、Gemini 側にキャッシュ (CachedContent) を作ってそこから参照させる
+  （キャッシュ分の入力トークンは割引になる）
+- キャッシュには TTL があるので、使われている間は期限が近づいたら延長する。使われなければそのまま切れる
+- キャッシュの作成・延長・削除は裏で行い、会話は待たせない（できるまでは普通に送る）
+- 作成に失敗したら（短すぎる・対応していないモデルなど）普通に送り、しばらくしてから再挑戦する
+
+Gemini の呼び出しは client にまとめてあるので、テストではスタブに差し替えられる。
+キャッシュはワーカーごとに作られる。
+
+デフォルトは無効。長期記憶を関係する分だけ発言の前に付けるようになってから (backend.memory_index)、
+システムプロンプトは IDENTITY.md と USER.md のタイトル直下だけの数百文字になり、
+CachedContent の最小トークン数に届かない。MIO_MEMORY_RETRIEVAL=0 で記憶ファイルを全部入れるときに使う。
+"""
+import os
+import time
+import asyncio
+import hashlib
+import datetime
+
+from backend import metrics
+from backend.model_chain import ModelChain
+
+PROMPT_CACHE_ENABLED = os.getenv("MIO_PROMPT_CACHE", "0") == "1"
+PROMPT_CACHE_TTL = float(os.getenv("MIO_PROMPT_CACHE_TTL", "3600"))            # 秒
+PROMPT_CACHE_MIN_CHARS = int(os.getenv("MIO_PROMPT_CACHE_MIN_CHARS", "2000"))   # これより短いプロンプトはキャッシュしない（API の最小 1024 トークンに届かない）
+PROMPT_CACHE_RETRY = 300.0       # 作成に失敗してから再挑戦するまでの秒数
+PROMPT_CACHE_REFRESH_AT = 0.25   # 残り時間が TTL のこの割合を切ったら延長する
+
+
+class GeminiCacheClient:
+    """google.generativeai を使う実装"""
+
+    def create(self, model, system_instruction, ttl):
+        from backend import gemini
+        return gemini.genai.caching.CachedContent.create(
+            model=model,
+            display_name="mio-system-prompt",
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=ttl)
+        )
+
+    def refresh(self, cache, ttl):
+        cache.update(ttl=datetime.timedelta(seconds=ttl))
+
+    def delete(self, cache):
+        cache.delete()
+
+    def model(self, name, system_instruction):
+        from backend import gemini
+        return gemini.genai.GenerativeModel(name, system_instruction=system_instruction)
+
+    def model_from_cache(self, cache):
+        from backend import gemini
+        return gemini.genai.GenerativeModel.from_cached_content(cache)
+
+
+class PromptPrefix:
+    """システムプロンプトの版とキャッシュを持ち、今使うべき ModelChain を返す"""
+
+    def __init__(self, names, client=None, ttl=PROMPT_CACHE_TTL, enabled=PROMPT_CACHE_ENABLED,
+                 min_chars=PROMPT_CACHE_MIN_CHARS, retry=PROMPT_CACHE_RETRY):
+        self.names = list(names)
+        self.client = client or GeminiCacheClient()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.min_chars = min_chars
+        self.retry = retry
+        self.text = None
+        self.version = None
+        self.chain = None
+        self.cache = None
+        self.expires_at = None   # キャッシュの期限 (time.time())
+        self.retry_at = 0.0      # 作成に失敗したときの次の挑戦時刻
+        self.last_error = None
+        self._task = None        # 作成/延長タスク（同時に1つだけ）
+        self._background = set()
+        metrics.register_gauge("mio_prompt_cache_active", lambda: int(self.cache is not None))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _build_chain(self):
+        cache, text, primary = self.cache, self.text, self.names[0]
+
+        def factory(name):
+            if cache is not None and name == primary:
+                return self.client.model_from_cache(cache)
+            return self.client.model(name, text)
+
+        # 先頭のモデルが遅い/混んでいるときは MIO_FIRST_TOKEN_DEADLINE_MS で次のモデルへ
+        self.chain = ModelChain(self.names, factory)
+
+    def update(self, text):
+        """システムプロンプトを渡して、今使う ModelChain を返す（変わっていれば作り直す）"""
+        version = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+        if version != self.version:
+            if self.version is not None:
+                print(f"★ [Prompt] System prompt updated ({self.version} -> {version}). Model rebuilt.")
+            self._drop_cache()
+            self.text, self.version, self.retry_at = text, version, 0.0
+            self._build_chain()
+            if self.enabled and len(text) < self.min_chars:
+                print(f"⚠ [Prompt] System prompt is {len(text)} chars (< {self.min_chars}). Context cache not used.")
+        self._maintain()
+        return self.chain
+
+    def _drop_cache(self):
+        if self.cache is not None:
+            self._spawn(self._delete(self.cache))
+        self.cache, self.expires_at = None, None
+
+    def _maintain(self):
+        """キャッシュが必要なら作る、期限が近ければ延長する（どちらも裏で）"""
+        if not self.enabled or len(self.text) < self.min_chars:
+            return
+        if self._task is not None and not self._task.done():
+            return
+        now = time.time()
+        if self.cache is not None and now >= self.expires_at:
+            # もう切れている（しばらく使われなかった）。普通に送りつつ作り直す
+            self.cache, self.expires_at = None, None
+            self._build_chain()
+        if self.cache is None:
+            if now >= self.retry_at:
+                self._task = self._spawn(self._create(self.version))
+        elif self.expires_at - now < self.ttl * PROMPT_CACHE_REFRESH_AT:
+            self._task = self._spawn(self._refresh(self.version))
+
+    async def _create(self, version):
+        text = self.text
+        try:
+            cache = await asyncio.to_thread(self.client.create, self.names[0], text, self.ttl)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            self.retry_at = time.time() + self.retry
+            print(f"⚠ [Prompt] Context cache unavailable ({self.last_error}). Sending the full prompt.")
+            return
+        if version != self.version:
+            # 作っている間にプロンプトが変わった
+            await self._delete(cache)
+            return
+        self.cache, self.expires_at, self.last_error = cache, time.time() + self.ttl, None
+        self._build_chain()
+        print(f"★ [Prompt] Context cache created for {self.names[0]} ({version}, ttl {self.ttl:.0f}s)")
+
+    async def _refresh(self, version):
+        cache = self.cache
+        try:
+            await asyncio.to_thread(self.client.refresh, cache, self.ttl)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"⚠ [Prompt] Context cache refresh failed ({self.last_error}). Recreating.")
+            if self.cache is cache:
+                self.cache, self.expires_at = None, None
+                self._build_chain()
+            return
+        if self.cache is cache and version == self.version:
+            self.expires_at = time.time() + self.ttl
+
+    async def _delete(self, cache):
+        try:
+            await asyncio.to_thread(self.client.delete, cache)
+        except Exception as e:
+            print(f"[Prompt] Context cache delete error: {e}")  # 消せなくても TTL で切れる
+
+    async def close(self):
+        """終了時にキャッシュを消す（残しておくと TTL まで保存料金がかかる）"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        cache, self.cache, self.expires_at = self.cache, None, None
+        if cache is not None:
+            await self._delete(cache)
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def status(self):
+        return {
+            "version": self.version,
+            "chars": len(self.text or ""),
+            "enabled": self.enabled,
+            "min_chars": self.min_chars,
+            "cached": self.cache is not None,
+            "cache_model": self.names[0] if self.cache is not None else None,
+            "expires_in": round(self.expires_at - time.time()) if self.expires_at else None,
+            "last_error": self.last_error,
+        }
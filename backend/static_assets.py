@@ -0,0 +1,191 @@
+"""
+フロントエンド配信（事前圧縮 + フィンガープリント + Service Worker）
+
+- style.css / app.js は内容ハッシュ付きURL (style.<hash>.css) で配信し、
+  Cache-Control: immutable で二度とダウンロードさせない
+- index.html はハッシュ付きURLを参照するように書き換え、no-cache + ETag で配信
+- 全て gzip / brotli で事前圧縮しておき、Accept-Encoding に合わせて返す
+- sw.js にはアセットのバージョンとアプリシェルの一覧を埋め込む
+- ファイルが更新されたら（mtimeで検知）自動で作り直すので、開発中も再起動不要
+- brotli q11 の圧縮は重いので、組み立ては起動時（lifespan）と更新時にスレッドで行う
+"""
+import os
+import re
+import gzip
+import json
+import asyncio
+import hashlib
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli # 任意（なければ gzip のみ）
+except ImportError:
+    brotli = None
+
+FINGERPRINTED = ("style.css", "app.js")
+SERVICE_WORKER = "sw.js"
+# sw.js の埋め込み先（埋め込む前でも正しい JS になる形）
+SW_VERSION_PLACEHOLDER = "__MIO_ASSET_VERSION__"
+SW_SHELL_PLACEHOLDER = '/*__MIO_APP_SHELL__*/["./"]'
+OPTIONAL_SHELL = ("manifest.json", "assets/icon.png", "assets/avatar.jpg")
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+CACHE_DEFAULT = "public, max-age=3600"
+
+MEDIA_TYPES = {
+    ".css": "text/css; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
+    ".html": "text/html; charset=utf-8",
+}
+
+
+def _accepts(accept_encoding, coding):
+    """Accept-Encoding で coding が使えるか（q=0 は拒否）"""
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() not in (coding, "*"):
+            continue
+        q = params.strip().lower()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class Asset:
+    """メモリ上に持っておく配信用ファイル（圧縮済みの版も一緒に持つ）"""
+
+    __slots__ = ("body", "gzip", "br", "etag", "media_type", "cache_control")
+
+    def __init__(self, name, body, cache_control):
+        self.body = body
+        self.gzip = gzip.compress(body, compresslevel=9, mtime=0)
+        self.br = brotli.compress(body, quality=11) if brotli else None
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.media_type = MEDIA_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        self.cache_control = cache_control
+
+    def response(self, request_headers):
+        accept = request_headers.get("accept-encoding", "")
+        if self.br is not None and _accepts(accept, "br"):
+            encoding, body = "br", self.br
+        elif _accepts(accept, "gzip"):
+            encoding, body = "gzip", self.gzip
+        else:
+            encoding, body = None, self.body
+
+        etag = f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"'
+        headers = {"Cache-Control": self.cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+        if etag in request_headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(body, headers=headers, media_type=self.media_type)
+
+
+class AssetStore:
+    """フロントエンドの配信用アセットを組み立てて保持する"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = {}  # パス -> Asset
+        self.urls = {}    # 元のファイル名 -> ハッシュ付きURL
+        self.version = ""
+        self._mtimes = None
+
+    def _read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def _current_mtimes(self):
+        mtimes = {}
+        for name in FINGERPRINTED + ("index.html", SERVICE_WORKER):
+            try:
+                mtimes[name] = os.stat(os.path.join(self.directory, name)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    def is_stale(self):
+        """まだ組み立てていない、またはファイルが変わっている"""
+        return self._current_mtimes() != self._mtimes
+
+    def refresh(self):
+        """ファイルが変わっていたら作り直す（重いのでスレッドから呼ぶ）"""
+        mtimes = self._current_mtimes()
+        if mtimes != self._mtimes:
+            self.build()
+            self._mtimes = mtimes
+
+    def build(self):
+        assets = {}
+        urls = {}
+
+        for name in FINGERPRINTED:
+            body = self._read(name)
+            stem, ext = os.path.splitext(name)
+            hashed = f"{stem}.{hashlib.sha256(body).hexdigest()[:10]}{ext}"
+            urls[name] = hashed
+            assets[hashed] = Asset(name, body, CACHE_IMMUTABLE)
+            assets[name] = Asset(name, body, CACHE_REVALIDATE)  # 古いURL向け
+
+        # index.html の参照をハッシュ付きURLに書き換え
+        html = self._read("index.html").decode("utf-8")
+        for name, hashed in urls.items():
+            html = re.sub(rf'(["\']){re.escape(name)}(\?v=[^"\']*)?(["\'])', rf"\g<1>{hashed}\g<3>", html)
+        index = Asset("index.html", html.encode("utf-8"), CACHE_REVALIDATE)
+        assets["index.html"] = index
+        assets["."] = index
+
+        self.version = hashlib.sha256("".join([index.etag, *urls.values()]).encode()).hexdigest()[:12]
+
+        # Service Worker にバージョンとアプリシェルを埋め込む
+        shell = ["./", *urls.values()]
+        shell += [p for p in OPTIONAL_SHELL if os.path.exists(os.path.join(self.directory, p))]
+        sw = self._read(SERVICE_WORKER).decode("utf-8")
+        sw = sw.replace(SW_VERSION_PLACEHOLDER, self.version)
+        sw = sw.replace(SW_SHELL_PLACEHOLDER, json.dumps(shell))
+        if SW_VERSION_PLACEHOLDER in sw or "__MIO_APP_SHELL__" in sw:
+            print(f"⚠ [Static] {SERVICE_WORKER}: placeholder not replaced (offline cache uses defaults)")
+        assets[SERVICE_WORKER] = Asset(SERVICE_WORKER, sw.encode("utf-8"), CACHE_REVALIDATE)
+
+        self.assets = assets
+        self.urls = urls
+        print(f"[Static] Assets built (version={self.version}, brotli={'on' if brotli else 'off'})")
+
+    def get(self, path):
+        return self.assets.get(path)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """アプリシェルはメモリ上の圧縮済みアセットから、それ以外は通常どおりファイルから配信する"""
+
+    def __init__(self, *, directory, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.store = AssetStore(directory)
+        self._lock = asyncio.Lock()
+
+    async def prepare(self):
+        """アセットを組み立てる（起動時に呼ぶ。圧縮はスレッドで行い、同時に走らせない）"""
+        async with self._lock:
+            await asyncio.to_thread(self.store.refresh)
+
+    async def get_response(self, path, scope):
+        if scope["method"] in ("GET", "HEAD"):
+            if self.store.is_stale():
+                await self.prepare()
+            asset = self.store.get(path)
+            if asset is not None:
+                return asset.response(Headers(scope=scope))
+
+        response = await super().get_response(path, scope)
+        if response.status_code == 200 and "cache-control" not in response.headers:
+            response.headers["Cache-Control"] = CACHE_DEFAULT
+        return response
@@ -0,0 +1,274 @@
+"""
+音声合成 (Aivis Speech ローカル / Aivis Cloud API)
+
+複数の合成先をプールして使う。
+- ローカルの Aivis は AIVIS_API_URLS にカンマ区切りで複数指定できる（なければ AIVIS_API_URL）
+- AIVIS_CLOUD_KEY があればクラウドもプールに入る
+- モードの合成先（LOCAL ならローカル群、API ならクラウド）の中で処理中の件数が一番少ないものを使う
+- 失敗が続いた合成先はサーキットブレーカーでしばらく外し、同じ種類の残りの合成先に回す
+  （MIO_TTS_FAILOVER=1 なら別の種類にも回す。声や課金が変わるので既定では回さない）
+- ローカルの合成先は定期的に /version を叩いてヘルスチェックする
+- どの合成先で合成したかを返す（SSE の audio イベントに載せる）
+
+httpx のクライアントは初回使用時に作る（import 時に作らない）。
+"""
+import os
+import time
+import base64
+import asyncio
+
+from backend import metrics
+from backend.admission import tts_limiter, QueueFull
+
+# --- TTS設定 ---
+TTS_MODE = os.getenv("TTS_MODE", "LOCAL") # LOCAL or API
+AIVIS_API_URL = os.getenv("AIVIS_API_URL", "http://127.0.0.1:10101")
+AIVIS_API_URLS = [u.strip().rstrip("/") for u in (os.getenv("AIVIS_API_URLS") or AIVIS_API_URL).split(",") if u.strip()]
+AIVIS_CLOUD_KEY = os.getenv("AIVIS_CLOUD_KEY", "")
+AIVIS_CLOUD_URL = "https://api.aivis-project.com/v1/tts/synthesize"
+AIVIS_MODEL_UUID = "22e8ed77-94fe-4ef2-871f-a86f94e9a579" # コハク (ノーマル)
+SPEAKER_ID = 1878365376 # ローカル用コハク ID
+
+# --- プール設定 ---
+TTS_TIMEOUT = float(os.getenv("MIO_TTS_TIMEOUT", "10"))                  # 1回の合成の待ち時間（秒）
+TTS_FAILOVER = os.getenv("MIO_TTS_FAILOVER", "0") == "1"                 # モード外の合成先にも回すか
+BREAKER_FAILURES = int(os.getenv("MIO_TTS_BREAKER_FAILURES", "3"))       # 連続何回失敗で外すか
+BREAKER_COOLDOWN = float(os.getenv("MIO_TTS_BREAKER_COOLDOWN", "30"))    # 外してから再挑戦までの秒数
+HEALTH_INTERVAL = float(os.getenv("MIO_TTS_HEALTH_INTERVAL", "15"))      # 0 = ヘルスチェックしない
+
+# グローバルなHTTPクライアント（コネクションプール用）
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.AsyncClient(timeout=TTS_TIMEOUT)
+    return _client
+
+
+class Backend:
+    """合成先ひとつ分（処理中の件数とサーキットブレーカーの状態を持つ）"""
+
+    kind = ""
+
+    def __init__(self, name):
+        self.name = name
+        self.outstanding = 0
+        self.failures = 0           # 連続失敗回数
+        self.opened_at = None       # ブレーカーが開いた時刻（None = 閉じている）
+        self.trial = False          # 半開状態で試しに1件流している
+        self.latency = metrics.summary("mio_tts_seconds", backend=name)
+        metrics.register_gauge("mio_tts_outstanding", lambda: self.outstanding, backend=name)
+        metrics.register_gauge("mio_tts_breaker_open", lambda: int(self.opened_at is not None), backend=name)
+
+    def available(self):
+        """使えるか（ブレーカーが閉じている、またはクールダウン明けで試行枠が空いている）"""
+        if self.opened_at is None:
+            return True
+        return not self.trial and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    def record_success(self):
+        if self.opened_at is not None:
+            print(f"[TTS] {self.name} recovered.")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self, reason):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= BREAKER_FAILURES:
+            if self.opened_at is None:
+                print(f"⚠ [TTS] {self.name} disabled for {BREAKER_COOLDOWN:.0f}s ({reason})")
+            self.opened_at = time.monotonic() # 半開中の失敗はクールダウンをやり直す
+
+    async def synthesize(self, text):
+        raise NotImplementedError
+
+    async def health_check(self):
+        """True/False を返す。チェックしない合成先は None"""
+        return None
+
+
+class LocalAivisBackend(Backend):
+    kind = "LOCAL"
+
+    def __init__(self, url):
+        super().__init__(f"local:{url}")
+        self.url = url
+
+    async def synthesize(self, text):
+        q_res = await get_client().post(
+            f"{self.url}/audio_query",
+            params={"text": text, "speaker": SPEAKER_ID}
+        )
+        q_res.raise_for_status()
+        query_data = q_res.json()
+
+        s_res = await get_client().post(
+            f"{self.url}/synthesis",
+            params={"speaker": SPEAKER_ID},
+            json=query_data
+        )
+        s_res.raise_for_status()
+        return s_res.content
+
+    async def health_check(self):
+        try:
+            res = await get_client().get(f"{self.url}/version", timeout=3.0)
+            return res.status_code == 200
+        except Exception:
+            return False
+
+
+class CloudAivisBackend(Backend):
+    kind = "API"
+
+    def __init__(self, url, key):
+        super().__init__("cloud")
+        self.url = url
+        self.key = key
+
+    async def synthesize(self, text):
+        # Aivis Cloud API 実装（従量課金なのでヘルスチェックはしない）
+        headers = {
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model_uuid": AIVIS_MODEL_UUID,
+            "text": text,
+            "style_id": 0,
+            "output_format": "mp3"
+        }
+        res = await get_client().post(self.url, headers=headers, json=payload)
+        res.raise_for_status()
+        return res.content
+
+
+class TTSPool:
+    """合成先のプール（最少処理中で振り分け + フェイルオーバー）"""
+
+    def __init__(self, backends, failover=TTS_FAILOVER):
+        self.backends = list(backends)
+        self.failover = failover
+        self._health_task = None
+
+    def candidates(self, mode):
+        """試す順番に並べた合成先"""
+        preferred = [b for b in self.backends if b.kind == mode]
+        others = [b for b in self.backends if b.kind != mode] if self.failover or not preferred else []
+        ordered = []
+        for group in (preferred, others):
+            # 処理中が少ない順（同数ならリストの順）
+            ordered += sorted(group, key=lambda b: b.outstanding)
+        return ordered
+
+    async def synthesize(self, text, mode):
+        """(音声バイト列, 合成先の名前) を返す。全滅なら (None, None)"""
+        for backend in self.candidates(mode):
+            if not backend.available():
+                continue
+            half_open = backend.opened_at is not None
+            if half_open:
+                backend.trial = True
+            backend.outstanding += 1
+            started = time.perf_counter()
+            try:
+                audio = await backend.synthesize(text)
+                backend.latency.observe(time.perf_counter() - started)
+                backend.record_success()
+                return audio, backend.name
+            except Exception as e:
+                reason = f"{type(e).__name__}: {e}"
+                print(f"Audio synth error ({backend.name}): {reason}")
+                backend.record_failure(reason)
+            finally:
+                backend.outstanding -= 1
+                if half_open:
+                    backend.trial = False
+        return None, None
+
+    async def check_health(self):
+        for backend, ok in zip(self.backends, await asyncio.gather(*(b.health_check() for b in self.backends))):
+            if ok is True and backend.opened_at is not None:
+                backend.record_success()
+            elif ok is False and backend.opened_at is None:
+                # ヘルスチェックで落ちていたら、実際のリクエストを待たずにすぐ外す
+                backend.failures = BREAKER_FAILURES
+                backend.record_failure("health check failed")
+
+    async def _health_loop(self, interval):
+        while True:
+            try:
+                await self.check_health()
+            except Exception as e:
+                print(f"[TTS] Health check error: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval=HEALTH_INTERVAL):
+        if interval > 0 and self._health_task is None and any(b.kind == "LOCAL" for b in self.backends):
+            self._health_task = asyncio.create_task(self._health_loop(interval))
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def status(self):
+        return [
+            {"name": b.name, "kind": b.kind, "outstanding": b.outstanding,
+             "failures": b.failures, "open": b.opened_at is not None}
+            for b in self.backends
+        ]
+
+
+def _build_pool():
+    backends = [LocalAivisBackend(url) for url in AIVIS_API_URLS]
+    if AIVIS_CLOUD_KEY:
+        backends.append(CloudAivisBackend(AIVIS_CLOUD_URL, AIVIS_CLOUD_KEY))
+    return TTSPool(backends)
+
+
+pool = _build_pool()
+
+
+def start():
+    pool.start()
+
+
+async def close():
+    global _client
+    await pool.stop()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Aivisで音声を合成する関数（非同期版・コネクション再利用）
+async def synthesize_clip(text, mode=None, session="default"):
+    """(Base64音声, 合成先の名前) を返す。合成しない/できないときは (None, None)"""
+    if not text: return None, None
+
+    current_mode = mode if mode else TTS_MODE
+
+    if current_mode == "SILENT":
+        return None, None # 無言モード
+
+    # 同時合成数を制限（満杯なら音声なしで返す）
+    try:
+        async with tts_limiter.slot(session):
+            print(f"Synthesizing Async ({current_mode}): {text[:10]}...") # デバッグログ
+            audio, backend = await pool.synthesize(text, "API" if current_mode == "API" else "LOCAL")
+    except QueueFull:
+        print("Audio synth skipped: queue is full")
+        return None, None
+
+    if audio is None:
+        return None, None
+    print(f"★ Audio generated: {len(audio)} bytes ({backend})") # サイズ確認
+    return base64.b64encode(audio).decode('utf-8'), backend
@@ -0,0 +1,103 @@
+"""
+カメラ画像の重複判定と説明文キャッシュ
+
+部屋をほぼ同じ構図で何度も撮ると、毎回フル解像度の画像が Gemini に送られてしまう。
+- カメラ画像（/api/camera/snapshot）だけが対象。アップロードされた写真はハッシュを付けないのでキャッシュしない
+- 画像を縮小グレースケール (9x8) にして隣の画素との大小で 64bit の dHash を作る
+- 直近 MIO_VISION_CACHE_TTL 秒以内の画像とハミング距離 MIO_VISION_CACHE_DISTANCE 以内なら「ほぼ同じ」
+- ほぼ同じなら画像は送らず、キャッシュした説明文をテキストとして渡す
+- キャッシュになかった画像は、チャットに画像を送るのと並行して裏で1回だけ説明文を作る
+  （作っている途中に届いたほぼ同じ画像では作らない。2枚目以降は説明文で済む）
+
+cv2 はハッシュを計算するとき（スレッド内）に初めて import する。
+"""
+import os
+import asyncio
+
+import numpy as np
+
+from backend.database import db
+from backend.lazy import load_module
+
+VISION_CACHE_ENABLED = os.getenv("MIO_VISION_CACHE", "1") == "1"
+VISION_CACHE_DISTANCE = int(os.getenv("MIO_VISION_CACHE_DISTANCE", "3"))  # 64bit 中何ビット違いまで同じとみなすか
+VISION_CACHE_TTL = float(os.getenv("MIO_VISION_CACHE_TTL", "600"))        # 秒
+
+DESCRIBE_PROMPT = """
+この画像に写っているものを、後で画像を見ずに会話できるように日本語で簡潔に説明してください。
+場所・写っている人や物・その状態・明るさなどを、箇条書きで5行以内にまとめてください。
+"""
+
+_background_tasks = set()  # 説明文作成タスク（GCで消えないように参照を持つ）
+
+
+def image_hash(image_bytes):
+    """JPEG/PNG のバイト列から 64bit dHash を作る（符号付き int。デコードできなければ None）
+
+    ブロッキング処理なのでスレッドで呼ぶこと。
+    """
+    import cv2
+
+    # 1/8 に縮小しながらデコードすると、フルHDでも数ミリ秒で済む
+    gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    # SQLite の INTEGER は符号付き 64bit なので合わせる
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+async def hash_image(image_bytes):
+    if not VISION_CACHE_ENABLED:
+        return None
+    try:
+        return await asyncio.to_thread(image_hash, image_bytes)
+    except Exception as e:
+        print(f"[Vision] Hash error: {e}")
+        return None
+
+
+async def lookup(phash):
+    """ほぼ同じ画像の説明文があれば返す"""
+    if phash is None or not VISION_CACHE_ENABLED:
+        return None
+    description, distance = await db.find_vision_cache(phash, VISION_CACHE_DISTANCE, VISION_CACHE_TTL)
+    if description:
+        print(f"★ [Vision] Cache hit (distance={distance}). Skipping image upload to Gemini.")
+    return description
+
+
+async def describe_image(image_bytes, mime_type="image/jpeg"):
+    """Gemini に画像の説明文を作らせる"""
+    from backend.model_chain import ModelChain, CHAT_MODELS
+    gemini = await load_module("backend.gemini")
+    chain = ModelChain(CHAT_MODELS, lambda name: gemini.genai.GenerativeModel(name))
+    resp, _ = await chain.generate([DESCRIBE_PROMPT, {"mime_type": mime_type, "data": image_bytes}])
+    return resp.text.strip()
+
+
+async def _describe_and_store(row_id, image_bytes, mime_type):
+    description = ""
+    try:
+        description = await describe_image(image_bytes, mime_type)
+        if description:
+            print(f"[Vision] Cached description: {description[:30]}...")
+    except Exception as e:
+        print(f"[Vision] Describe error: {e}")
+    finally:
+        # 失敗したら作成中の印を消す（次のほぼ同じ画像でまた作る）
+        await db.set_vision_description(row_id, description)
+
+
+async def remember(phash, image_bytes, mime_type="image/jpeg"):
+    """キャッシュになかったカメラ画像の説明文を裏で作る（ほぼ同じ画像の説明文を作っている途中なら何もしない）"""
+    if phash is None or not VISION_CACHE_ENABLED or not os.getenv("GEMINI_API_KEY"):
+        return
+    row_id = await db.claim_vision_description(phash, VISION_CACHE_DISTANCE, VISION_CACHE_TTL)
+    if row_id is None:
+        return
+    task = asyncio.create_task(_describe_and_store(row_id, image_bytes, mime_type))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
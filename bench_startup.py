@@ -0,0 +1,81 @@
+"""
+MIO 起動ベンチマーク
+
+モジュールごとの import 時間（毎回まっさらなプロセスで計測）と、
+backend.main の import から lifespan 完了（リクエスト受付可能）までの時間を表示する。
+
+使い方: python bench_startup.py [回数]  (例: python bench_startup.py 3 | tee bench_output.txt)
+"""
+import os
+import sys
+import json
+import subprocess
+
+MODULES = [
+    "fastapi",
+    "aiosqlite",
+    "httpx",
+    "cv2",
+    "google.generativeai",
+    "backend.database",
+    "backend.tts",
+    "backend.camera",
+    "backend.gemini",
+    "backend.compaction",
+    "backend.main",
+]
+
+IMPORT_SNIPPET = """
+import time, json
+t = time.perf_counter()
+import {name}
+print(json.dumps((time.perf_counter() - t) * 1000))
+"""
+
+READY_SNIPPET = """
+import time, json, asyncio
+t = time.perf_counter()
+import backend.main as main
+imported = (time.perf_counter() - t) * 1000
+
+async def boot():
+    async with main.app.router.lifespan_context(main.app):
+        return (time.perf_counter() - t) * 1000
+
+ready = asyncio.run(boot())
+print(json.dumps({"import_ms": imported, "ready_ms": ready, "lazy_imports": main.import_times}))
+"""
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(code):
+    res = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if res.returncode != 0:
+        return None
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    print("--- MIO STARTUP BENCHMARK ---")
+    print(f"{'module':<24}{'import (ms)':>14}")
+    for name in MODULES:
+        times = [run(IMPORT_SNIPPET.format(name=name)) for _ in range(rounds)]
+        times = [t for t in times if t is not None]
+        result = f"{min(times):>14.1f}" if times else f"{'FAILED':>14}"
+        print(f"{name:<24}{result}")
+
+    print()
+    for i in range(rounds):
+        ready = run(READY_SNIPPET)
+        if ready is None:
+            print("[FAIL] backend.main could not start.")
+            return
+        print(f"[{i + 1}] import backend.main: {ready['import_ms']:.1f}ms / "
+              f"time-to-first-ready: {ready['ready_ms']:.1f}ms")
+        print(f"    lazy imports during startup: {ready['lazy_imports']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,17 @@ MIO Discord Bot - Phase 1: Chat Mirroring (Real-time Streaming)
 ブラウザ版MIOとDiscordを双方向で繋ぐBot
 """
 import os
+import re
 import asyncio
 import aiohttp
 import discord
 import time
+import unicodedata
+from collections import defaultdict
 from discord.ext import commands
 from dotenv import load_dotenv
 from datetime import datetime
+from sse_client import iter_sse
 
 load_dotenv()
 
@@ -18,13 +22,188 @@ DISCORD_TOKEN = os.getenv("DISCORD_BOT_TOKEN", "")
 MIO_CHANNEL_ID = int(os.getenv("MIO_CHANNEL_ID", "0"))
 MIO_API_BASE = os.getenv("MIO_API_BASE", "http://127.0.0.1:8000")
 
+# ストリーミング表示の設定
+DISCORD_MESSAGE_LIMIT = 2000
+EDIT_INTERVAL_MIN = 0.8  # 秒
+EDIT_INTERVAL_MAX = 5.0
+SENTENCE_ENDINGS = ("。", "！", "？", "!", "?", "\n")
+CODE_FENCE = "```"
+_JOINERS = ("\u200d", "\ufe0e", "\ufe0f")  # ZWJ と異体字セレクタ（前の文字とくっついて1文字に見える）
+
+
+class RateLimitTracker:
+    """DiscordのレスポンスヘッダーからチャンネルごとのX-RateLimit情報を覚えておく"""
+
+    _CHANNEL_MESSAGES = re.compile(r"/channels/(\d+)/messages")
+
+    def __init__(self):
+        self.buckets = {}  # channel_id -> (remaining, reset_at)
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_end.append(self._on_request_end)
+
+    async def _on_request_end(self, session, ctx, params):
+        match = self._CHANNEL_MESSAGES.search(params.url.path)
+        if not match:
+            return
+        headers = params.response.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After") or headers.get("Retry-After")
+        if remaining is None or reset_after is None:
+            return
+        self.buckets[int(match.group(1))] = (int(remaining), time.monotonic() + float(reset_after))
+
+    def edit_interval(self, channel_id):
+        """残り枠をリセットまでに均等に使う間隔（最終確定用に1枠残す）"""
+        info = self.buckets.get(channel_id)
+        if not info:
+            return EDIT_INTERVAL_MIN
+        remaining, reset_at = info
+        left = reset_at - time.monotonic()
+        if left <= 0:
+            return EDIT_INTERVAL_MIN
+        interval = left / (remaining - 1) if remaining > 1 else left
+        return min(EDIT_INTERVAL_MAX, max(EDIT_INTERVAL_MIN, interval))
+
+
+def _joins_previous(text, i):
+    """text[i] が前の文字とくっついて表示される（そこで切ると絵文字や濁点が壊れる）"""
+    ch = text[i]
+    return (unicodedata.combining(ch) or ch in _JOINERS or text[i - 1] == "\u200d"
+            or "\U0001F3FB" <= ch <= "\U0001F3FF")  # 肌の色
+
+
+def find_split_point(text, limit):
+    """limit 以内で、なるべく文の区切りで切れる位置を返す"""
+    if len(text) <= limit:
+        return len(text)
+    head = text[:limit]
+    cut = max(head.rfind(p) for p in SENTENCE_ENDINGS)
+    if cut < limit // 2:
+        cut = head.rfind(" ")
+    if cut < limit // 2:
+        # 区切りがなければ文字数で切る（結合文字や ZWJ でつながった絵文字の途中は避ける）
+        cut = limit
+        while cut > 1 and _joins_previous(text, cut):
+            cut -= 1
+        return cut
+    return cut + 1
+
+
+def _open_fence(text):
+    """text の最後でコードブロックが開いたままなら、その開始行（```python など）を返す"""
+    fence = None
+    for line in text.split("\n"):
+        if line.lstrip().startswith(CODE_FENCE):
+            fence = None if fence else line.strip()
+    return fence
+
+
+def split_message(text, limit):
+    """limit 以内の先頭と残りに分ける
+
+    コードブロックの途中で切るときは、先頭を ``` で閉じて残りの頭で同じ言語で開き直す。
+    """
+    cut = find_split_point(text, limit)
+    if _open_fence(text[:cut]) is None:
+        return text[:cut], text[cut:]
+    cut = find_split_point(text, limit - len(CODE_FENCE) - 1)  # 閉じる分を空けておく
+    head, rest = text[:cut], text[cut:]
+    fence = _open_fence(head)
+    if fence is None:
+        return head, rest
+    return head.rstrip("\n") + "\n" + CODE_FENCE, fence + "\n" + rest
+
+
+class StreamingReply:
+    """ストリーミング中の返答をDiscordメッセージへ反映する編集スケジューラー
+
+    - 編集間隔はレート制限ヘッダーに合わせて自動調整
+    - メッセージが埋まったら文の区切りで次のメッセージへ繰り越し（コードブロックは閉じて開き直す）
+    - 確定済みのメッセージは二度と編集しない
+    """
+
+    def __init__(self, channel, rate_limits, limit=DISCORD_MESSAGE_LIMIT):
+        self.channel = channel
+        self.rate_limits = rate_limits
+        self.limit = limit
+        self.text = ""       # 現在のメッセージに載せる内容（未確定）
+        self.message = None  # 現在編集中のメッセージ
+        self.sent_text = ""  # 現在のメッセージに反映済みの内容
+        self._dirty = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def append(self, chunk):
+        self.text += chunk
+        self._dirty.set()
+
+    async def finish(self, suffix=""):
+        """残りを全て送り切って終了する"""
+        self.text += suffix
+        self._closed.set()
+        self._dirty.set()
+        await self._task
+
+    def cancel(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self):
+        while not self._closed.is_set():
+            await self._dirty.wait()
+            self._dirty.clear()
+            await self._flush()
+            try:
+                await asyncio.wait_for(
+                    self._closed.wait(),
+                    timeout=self.rate_limits.edit_interval(self.channel.id)
+                )
+            except asyncio.TimeoutError:
+                pass
+        await self._flush(final=True)
+
+    async def _flush(self, final=False):
+        # 上限を超えた分は文の区切りで確定させ、新しいメッセージへ繰り越す
+        while len(self.text) > self.limit:
+            head, rest = split_message(self.text, self.limit)
+            if not await self._publish(head, final=final):
+                return
+            self.text = rest
+            self.message = None
+            self.sent_text = ""
+
+        if self.text.strip() and self.text != self.sent_text:
+            await self._publish(self.text, final=final)
+
+    async def _publish(self, content, final=False):
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(content)
+            elif content != self.sent_text:
+                await self.message.edit(content=content)
+            self.sent_text = content
+            return True
+        except discord.errors.HTTPException as e:
+            if final:
+                raise
+            print(f"⚠️ Edit skipped: {e}")  # 次の周期でまとめて再送
+            return False
+
+
 # Bot設定
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+rate_limits = RateLimitTracker()
+bot = commands.Bot(command_prefix="!", intents=intents, http_trace=rate_limits.trace)
 http_session: aiohttp.ClientSession = None
 
+# チャンネルごとに1件ずつ順番に応答する（同時に来た発言を混ぜない）
+channel_locks = defaultdict(asyncio.Lock)
+
 @bot.event
 async def on_ready():
     global http_session
@@ -48,39 +227,20 @@ async def on_message(message: discord.Message):
     
     print(f"📩受信: {user_text}")
 
-    async with message.channel.typing():
-        bot_message = None
-        full_text = ""
+    lock = channel_locks[message.channel.id]
+    if lock.locked():
+        print("⏳ 前の応答が終わるまで待機中...")
+
+    async with lock, message.channel.typing():
+        reply = StreamingReply(message.channel, rate_limits)
+        reply.start()
         token_info_str = ""
-        last_edit_time = 0
-        message_chunks = []  # 2000文字超え対応用のリスト
 
         try:
             # ジェネレーターから逐次受け取る
-            async for item in call_mio_streaming_generator(user_text):
+            async for item in call_mio_streaming_generator(user_text, session=f"discord-{message.channel.id}"):
                 if item["type"] == "content":
-                    content_chunk = item["data"]
-                    full_text += content_chunk
-                    
-                    # 現在の表示用テキストを作成
-                    current_display_text = full_text
-                    
-                    # 2000文字制限の簡易対応（表示用）
-                    if len(current_display_text) > 1950:
-                        current_display_text = current_display_text[:1950] + "..."
-
-                    now = time.time()
-                    # 初回送信
-                    if bot_message is None:
-                        bot_message = await message.channel.send(current_display_text)
-                        last_edit_time = now
-                    # 更新（レート制限考慮: 1.0秒間隔）
-                    elif now - last_edit_time > 1.0:
-                        try:
-                            await bot_message.edit(content=current_display_text)
-                            last_edit_time = now
-                        except discord.errors.HTTPException:
-                            pass # 編集失敗は無視して次へ
+                    reply.append(item["data"])
 
                 elif item["type"] == "usage":
                     token_usage = item["data"]
@@ -99,94 +259,58 @@ async def on_message(message: discord.Message):
                     token_info_str = f"\n`入力: {input_tokens} / 出力: {output_tokens} (¥{total_cost:.4f})`"
 
             # === 最終確定 ===
-            final_text = full_text + token_info_str
-            
-            if not final_text:
+            if not reply.text and reply.message is None and not token_info_str:
                 print("⚠️ Warning: Final text is empty. Nothing to send.")
-                return
-
-            # 2000文字を超える場合の分割送信
-            if len(final_text) > 2000:
-                # 最初のメッセージを上限まで埋める
-                chunk1 = final_text[:2000]
-                if bot_message:
-                    await bot_message.edit(content=chunk1)
-                else:
-                    await message.channel.send(chunk1)
-                
-                # 残りを新規メッセージで送る
-                remaining = final_text[2000:]
-                while remaining:
-                    chunk = remaining[:2000]
-                    await message.channel.send(chunk)
-                    remaining = remaining[2000:]
-            else:
-                if bot_message:
-                    await bot_message.edit(content=final_text)
-                else:
-                    await message.channel.send(final_text)
+            await reply.finish(token_info_str)
 
         except Exception as e:
             print(f"❌ Error: {e}")
+            reply.cancel()
             await message.channel.send(f"⚠️ エラー: {str(e)[:100]}")
 
-async def call_mio_streaming_generator(text: str):
+async def call_mio_streaming_generator(text: str, session: str = "discord"):
     """MIOからの応答を逐次yieldするジェネレーター"""
     import json
     from urllib.parse import quote
     
-    url = f"{MIO_API_BASE}/api/stream_chat?text={quote(text)}&mode=NONE"
-    buffer = ""
+    # session はサーバー側の順番待ちの単位（チャンネルごと）
+    url = f"{MIO_API_BASE}/api/stream_chat?text={quote(text)}&mode=NONE&session={quote(session)}"
     
     try:
         print(f"Connecting to MIO API: {url}")
-        async with http_session.get(url) as response:
-            print(f"API Response: {response.status}")
+        async for event in iter_sse(http_session, url):
+            try:
+                data = json.loads(event.data)
+            except json.JSONDecodeError as e:
+                print(f"JSON Error: {e} in {event.data}")
+                continue
+
+            if data.get("type") == "chunk":
+                content = data.get("content", "")
+                if content:
+                    yield {"type": "content", "data": content}
             
-            # チャンク読み込み
-            async for chunk in response.content.iter_any():
-                chunk_str = chunk.decode('utf-8', errors='ignore')
-                buffer += chunk_str
+            # 新しい形式 {'type': 'usage', 'data': {...}} に対応
+            elif data.get("type") == "usage":
+                token_usage = data.get("data")
+                yield {"type": "usage", "data": token_usage}
+            
+            # 古い形式互換（念のため）
+            elif data.get("usage"):
+                yield {"type": "usage", "data": data.get("usage")}
                 
-                # バッファ内の改行ごとに処理
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    line = line.strip()
-                    if not line:
-                        continue # 空行スキップ
-
-                    if line.startswith("data: "):
-                        data_str = line[6:]
-                        try:
-                            data = json.loads(data_str)
-
-                            if data.get("type") == "chunk":
-                                content = data.get("content", "")
-                                if content:
-                                    yield {"type": "content", "data": content}
-                            
-                            # 新しい形式 {'type': 'usage', 'data': {...}} に対応
-                            elif data.get("type") == "usage":
-                                token_usage = data.get("data")
-                                yield {"type": "usage", "data": token_usage}
-                            
-                            # 古い形式互換（念のため）
-                            elif data.get("usage"):
-                                yield {"type": "usage", "data": data.get("usage")}
-                                
-                            elif data.get("type") == "end":
-                                return
-                            
-                            elif data.get("error"):
-                                print(f"API Error: {data.get('error')}")
-                                yield {"type": "content", "data": f"\n[Error: {data.get('error')}]"}
-                                
-                        except json.JSONDecodeError as e:
-                            print(f"JSON Error: {e} in {data_str}")
-                            continue
-                            
-            # ループ終了後
-            print("Stream finished.")
+            elif data.get("type") == "queued":
+                print(f"Queued at MIO API (position {data.get('position')})")
+
+            elif data.get("type") == "end":
+                return
+            
+            elif data.get("error"):
+                print(f"API Error: {data.get('error')}")
+                yield {"type": "content", "data": f"\n[Error: {data.get('error')}]"}
+
+        # ループ終了後
+        print("Stream finished.")
 
     except Exception as e:
         print(f"Streaming Error: {e}")
@@ -3,12 +3,21 @@ const state = {
     isSpeaking: false,
     isListening: false,
     isMicEnabled: false,  // デフォルトでマイクOFF
-    lastAudios: [],
-    currentAudio: null,
     pendingImageId: null,
-    ttsMode: "LOCAL"
+    ttsMode: "LOCAL",
+    sessionId: getSessionId()
 };
 
+// タブごとのセッションID（サーバー側の順番待ちをセッション単位で公平にするため）
+function getSessionId() {
+    let id = sessionStorage.getItem('mio-session');
+    if (!id) {
+        id = (crypto.randomUUID ? crypto.randomUUID() : String(Date.now()) + Math.random().toString(16).slice(2));
+        sessionStorage.setItem('mio-session', id);
+    }
+    return id;
+}
+
 // --- SVG Icons ---
 const ICON_SEND = '<svg width="18" height="18" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2.5" stroke-linecap="round" stroke-linejoin="round"><path d="M22 2L11 13"></path><path d="M22 2L15 22L11 13L2 9L22 2Z"></path></svg>';
 const ICON_STOP = '<svg width="18" height="18" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2.5" stroke-linecap="round" stroke-linejoin="round"><rect x="6" y="6" width="12" height="12" rx="2" fill="currentColor"></rect></svg>';
@@ -47,46 +56,141 @@ window.showFullImage = (src) => {
     }
 };
 
-// --- Audio Queue Helper ---
-const audioQueue = [];
-let isPlayingAudio = false;
-
-function playNextAudio() {
-    if (isPlayingAudio || audioQueue.length === 0) {
-        if (audioQueue.length === 0 && elements.visualCore) {
-            elements.visualCore.classList.remove('talking');
+// --- Audio Player (Web Audio) ---
+// 文ごとの音声を届いた時点でデコードしておき、AudioContext の時間軸上で前の音声の終わりにぴったり続けて鳴らす。
+// 送信から最初の音が鳴るまでの時間と、音声と音声の間の隙間を測って /api/metrics/client に送る。
+const audioPlayer = {
+    ctx: null,
+    gain: null,
+    nextStartTime: 0,         // 次の音声を鳴らし始める時刻 (ctx.currentTime 基準)
+    chain: Promise.resolve(), // デコードは並列、鳴らす順番は届いた順
+    sources: new Set(),       // 再生中/予約済みの音声
+    generation: 0,            // reset() で進める（古いデコード結果は鳴らさない）
+    turn: null,               // { sentAt, firstSoundMs, gapsMs, lastEndTime, clips }
+
+    ensureContext() {
+        if (!this.ctx) {
+            const Ctx = window.AudioContext || window.webkitAudioContext;
+            this.ctx = new Ctx();
+            this.gain = this.ctx.createGain();
+            this.gain.connect(this.ctx.destination);
+            const volSlider = document.getElementById('volume-slider');
+            if (volSlider) this.gain.gain.value = parseFloat(volSlider.value);
+        }
+        if (this.ctx.state === 'suspended') this.ctx.resume().catch(() => { });
+        return this.ctx;
+    },
+
+    setVolume(value) {
+        if (this.gain) this.gain.gain.value = parseFloat(value);
+    },
+
+    // 送信時に呼ぶ（最初の音が鳴るまでの時間を測り始める）
+    startTurn() {
+        this.reportTurn();
+        this.turn = { sentAt: performance.now(), firstSoundMs: null, gapsMs: [], lastEndTime: null, clips: 0 };
+    },
+
+    async decode(base64) {
+        const ctx = this.ensureContext();
+        // data: URL を fetch すると base64 の展開がメインスレッドの外で行われる
+        const res = await fetch("data:application/octet-stream;base64," + base64);
+        return ctx.decodeAudioData(await res.arrayBuffer());
+    },
+
+    enqueue(base64) {
+        const generation = this.generation;
+        const decoded = this.decode(base64); // 前の音声の再生を待たずにデコードを始める
+        decoded.catch(() => { });
+        this.chain = this.chain.then(async () => {
+            let buffer;
+            try {
+                buffer = await decoded;
+            } catch (e) {
+                console.error("Audio Decode Error:", e);
+                if (this.sources.size === 0) this.onIdle();
+                return;
+            }
+            if (generation === this.generation) this.schedule(buffer);
+        });
+    },
+
+    schedule(buffer) {
+        const ctx = this.ctx;
+        const now = ctx.currentTime;
+        const startAt = Math.max(now + 0.005, this.nextStartTime);
+        const turn = this.turn;
+
+        if (turn) {
+            if (turn.firstSoundMs === null) {
+                turn.firstSoundMs = performance.now() - turn.sentAt + (startAt - now) * 1000;
+            } else if (turn.lastEndTime !== null) {
+                // 前の音声が終わってから次が鳴るまで（デコードが間に合っていれば 0）
+                turn.gapsMs.push(Math.max(0, (startAt - turn.lastEndTime) * 1000));
+            }
+            turn.lastEndTime = startAt + buffer.duration;
+            turn.clips += 1;
         }
-        return;
-    }
-
-    isPlayingAudio = true;
-    if (elements.visualCore) elements.visualCore.classList.add('talking');
 
-    const base64 = audioQueue.shift();
-    const audio = new Audio("data:audio/wav;base64," + base64);
+        const source = ctx.createBufferSource();
+        source.buffer = buffer;
+        source.connect(this.gain);
+        source.onended = () => {
+            // 鳴り終わったら参照を外してバッファを解放させる
+            source.disconnect();
+            source.buffer = null;
+            this.sources.delete(source);
+            if (this.sources.size === 0) this.onIdle();
+        };
+        this.sources.add(source);
+        source.start(startAt);
+        this.nextStartTime = startAt + buffer.duration;
+
+        state.isSpeaking = true;
+        if (elements.visualCore) elements.visualCore.classList.add('talking');
+    },
+
+    // 再生中・予約済みの音声を全部止める（新しい応答が始まったとき）
+    reset() {
+        this.generation += 1;
+        this.chain = Promise.resolve();
+        for (const source of this.sources) {
+            source.onended = null;
+            try { source.stop(); } catch (e) { }
+            source.disconnect();
+        }
+        this.sources.clear();
+        this.nextStartTime = 0;
+        if (this.turn) this.turn.lastEndTime = null;
+    },
 
-    const volSlider = document.getElementById('volume-slider');
-    if (volSlider) audio.volume = volSlider.value;
-    state.currentAudio = audio;
-
-    audio.onended = () => {
-        isPlayingAudio = false;
-        state.currentAudio = null;
-        if (audioQueue.length > 0) {
-            playNextAudio();
-        } else {
-            if (elements.visualCore) elements.visualCore.classList.remove('talking');
-            if (state.isMicEnabled && recognition && !state.isProcessing) {
-                try { recognition.start(); } catch (e) { }
-            }
+    onIdle() {
+        state.isSpeaking = false;
+        if (elements.visualCore) elements.visualCore.classList.remove('talking');
+        if (!state.isProcessing) this.reportTurn();
+        if (state.isMicEnabled && recognition && !state.isProcessing) {
+            try { recognition.start(); } catch (e) { }
         }
-    };
-    audio.play().catch(e => {
-        console.error("Audio Play Error:", e);
-        isPlayingAudio = false;
-        playNextAudio();
-    });
-}
+    },
+
+    // 計測結果をサーバーに送る（1ターンにつき1回。音声がなかったターンは送らない）
+    reportTurn() {
+        const turn = this.turn;
+        this.turn = null;
+        if (!turn || turn.clips === 0) return;
+        fetch('/api/metrics/client', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                first_sound_ms: turn.firstSoundMs,
+                gaps_ms: turn.gapsMs,
+                clips: turn.clips,
+                mode: state.ttsMode
+            }),
+            keepalive: true
+        }).catch(() => { });
+    }
+};
 
 // --- TTS Logic ---
 async function speakText(text) {
@@ -95,9 +199,6 @@ async function speakText(text) {
     state.isSpeaking = true;
     if (elements.visualCore) elements.visualCore.classList.add('talking');
 
-    const volSlider = document.getElementById('volume-slider');
-    const volume = volSlider ? parseFloat(volSlider.value) : 0.5;
-
     try {
         const res = await fetch('/api/speak', {
             method: 'POST',
@@ -107,19 +208,10 @@ async function speakText(text) {
         const data = await res.json();
 
         if (data.status === 'ok' && data.audio) {
-            const audio = new Audio("data:audio/wav;base64," + data.audio);
-            audio.volume = volume;
-            state.currentAudio = audio;
-
-            audio.onended = () => {
-                state.isSpeaking = false;
-                if (elements.visualCore) elements.visualCore.classList.remove('talking');
-                state.currentAudio = null;
-                if (state.isMicEnabled && recognition && !state.isProcessing) {
-                    try { recognition.start(); } catch (e) { }
-                }
-            };
-            await audio.play();
+            audioPlayer.enqueue(data.audio);
+        } else {
+            state.isSpeaking = false;
+            if (elements.visualCore) elements.visualCore.classList.remove('talking');
         }
     } catch (e) {
         console.error("TTS Error:", e);
@@ -131,6 +223,24 @@ async function speakText(text) {
 // Make speakText globally accessible for history playback
 window.speakText = speakText;
 
+// --- Prefetch (入力中に記憶検索を先読み) ---
+let prefetchTimer = null;
+let lastPrefetched = "";
+
+function schedulePrefetch(text) {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = setTimeout(() => {
+        const draft = (text || "").trim();
+        if (draft.length < 4 || draft === lastPrefetched || state.isProcessing) return;
+        lastPrefetched = draft;
+        fetch('/api/prefetch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text: draft, session: state.sessionId })
+        }).catch(() => { }); // 先読みなので失敗しても無視
+    }, 400);
+}
+
 // --- STT ---
 const SpeechRecognition = window.SpeechRecognition || window.webkitSpeechRecognition;
 let recognition;
@@ -144,12 +254,17 @@ if (SpeechRecognition) {
     recognition.onresult = (event) => {
         if (state.isProcessing || state.isSpeaking) return;
         let finalTranscript = '';
+        let interimTranscript = '';
         for (let i = event.resultIndex; i < event.results.length; ++i) {
             if (event.results[i].isFinal) {
                 finalTranscript += event.results[i][0].transcript;
+            } else {
+                interimTranscript += event.results[i][0].transcript;
             }
         }
+        if (!finalTranscript && interimTranscript) schedulePrefetch(interimTranscript);
         if (finalTranscript) {
+            clearTimeout(prefetchTimer);
             if (elements.userInput) elements.userInput.value = finalTranscript;
             processMessage(finalTranscript, state.pendingImageId);
             updateImagePreview(null);
@@ -227,27 +342,34 @@ function processMessage(text, imageId = null) {
         const mode = state.ttsMode;
         let url = `/api/stream_chat?text=${encodeURIComponent(text)}&mode=${mode}`;
         if (imageId) url += `&image_id=${imageId}`;
+        url += `&session=${encodeURIComponent(state.sessionId)}`;
 
         const eventSource = new EventSource(url);
         state.currentEventSource = eventSource; // 参照を保持して中断可能に
+        audioPlayer.startTurn();
 
         let fullResponse = "";
+        let gotAudio = false;
         const messageContent = elements.mioMessage.querySelector('.message-content') || elements.mioMessage;
 
         eventSource.onmessage = (event) => {
             try {
                 const data = JSON.parse(event.data);
 
-                if (data.type === "start") {
+                if (data.type === "queued") {
+                    updateStatus(`順番待ち... (${data.position}番目)`);
+                } else if (data.type === "start") {
+                    updateStatus("考え中...");
                     fullResponse = "";
                     messageContent.textContent = "";
-                    audioQueue.length = 0;
+                    gotAudio = false;
+                    audioPlayer.reset();
                 } else if (data.type === "chunk") {
                     fullResponse += data.content;
                     messageContent.textContent = fullResponse;
                 } else if (data.type === "audio") {
-                    audioQueue.push(data.content);
-                    playNextAudio();
+                    gotAudio = true;
+                    audioPlayer.enqueue(data.content);
                 } else if (data.type === "usage" && data.data) {
                     const usage = data.data;
                     const tokenEl = document.getElementById('token-usage');
@@ -273,8 +395,10 @@ function processMessage(text, imageId = null) {
                     if (elements.visualCore) elements.visualCore.classList.remove('thinking');
                     updateStatus("Online");
 
-                    if (mode !== "SILENT" && mode === "LOCAL" && fullResponse && audioQueue.length === 0) {
+                    if (mode !== "SILENT" && mode === "LOCAL" && fullResponse && !gotAudio) {
                         speakText(fullResponse);
+                    } else if (!state.isSpeaking) {
+                        audioPlayer.reportTurn(); // 音声が先に鳴り終わっていた
                     }
                 }
             } catch (e) {
@@ -416,6 +540,11 @@ async function showCompactionLogs() {
 
 // --- Init Listeners ---
 window.onload = () => {
+    // Service Worker (アプリシェルのキャッシュ。2回目以降はほぼ通信なしで起動)
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('sw.js').catch(e => console.warn("SW registration failed:", e));
+    }
+
     // Volume
     const volSlider = document.getElementById('volume-slider');
     if (volSlider) {
@@ -423,7 +552,7 @@ window.onload = () => {
         if (savedVol) volSlider.value = savedVol;
         volSlider.oninput = () => {
             localStorage.setItem('mio_volume', volSlider.value);
-            if (state.currentAudio) state.currentAudio.volume = volSlider.value;
+            audioPlayer.setVolume(volSlider.value);
         };
     }
 
@@ -536,17 +665,21 @@ window.onload = () => {
                 if (snapData.status !== "ok") throw new Error(snapData.message);
 
                 const base64Img = snapData.image;
+                let imageId = snapData.image_id; // サーバー側で保存済みならアップロード不要
 
-                updateStatus("アップロード中...");
-                const upRes = await fetch('/api/upload_image', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ image: base64Img })
-                });
-                const upData = await upRes.json();
-                if (upData.status !== "ok") throw new Error("Upload failed");
+                if (!imageId) {
+                    updateStatus("アップロード中...");
+                    const upRes = await fetch('/api/upload_image', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ image: base64Img })
+                    });
+                    const upData = await upRes.json();
+                    if (upData.status !== "ok") throw new Error("Upload failed");
+                    imageId = upData.image_id;
+                }
 
-                state.pendingImageId = upData.image_id;
+                state.pendingImageId = imageId;
                 updateImagePreview(base64Img);
                 updateStatus("画像準備OK");
 
@@ -560,6 +693,7 @@ window.onload = () => {
 
     // Input
     if (elements.userInput) {
+        elements.userInput.oninput = () => schedulePrefetch(elements.userInput.value);
         elements.userInput.onkeydown = (e) => {
             if (e.key === 'Enter') {
                 const text = elements.userInput.value.trim();
@@ -614,9 +748,8 @@ window.onload = () => {
     if (overlay) {
         overlay.onclick = () => {
             overlay.style.display = 'none';
-            // Unlock audio context
-            const audio = new Audio();
-            audio.play().catch(() => { });
+            // Unlock audio context (ユーザー操作の中で作らないと鳴らせないブラウザがある)
+            audioPlayer.ensureContext();
         };
     }
 
@@ -0,0 +1,72 @@
+// MIO Service Worker - アプリシェルをキャッシュして2回目以降の読み込みをほぼゼロ通信にする
+// CACHE_VERSION と APP_SHELL の中身はサーバー (backend/static_assets.py) が配信時に埋め込む
+// （埋め込まれずに配信されても壊れた JS にならないよう、どちらも仮の値を書いておく）
+const CACHE_VERSION = "__MIO_ASSET_VERSION__";
+const APP_SHELL = /*__MIO_APP_SHELL__*/["./"];
+const CACHE_NAME = `mio-shell-${CACHE_VERSION}`;
+
+// ハッシュ付きURL (style.<hash>.css など) は中身が変わらないのでキャッシュ優先
+const IMMUTABLE_ASSET = /\.[0-9a-f]{10}\.(css|js)$/;
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => Promise.all(APP_SHELL.map(url => cache.add(url).catch(() => { }))))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    // 古いバージョンのキャッシュを削除
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys
+                .filter(key => key.startsWith('mio-shell-') && key !== CACHE_NAME)
+                .map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+    if (url.pathname.startsWith('/api/')) return; // APIは常にネットワーク
+
+    if (IMMUTABLE_ASSET.test(url.pathname)) {
+        event.respondWith(cacheFirst(request));
+    } else {
+        event.respondWith(staleWhileRevalidate(request, event));
+    }
+});
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) return cached;
+    const response = await fetch(request);
+    if (response.ok) {
+        const cache = await caches.open(CACHE_NAME);
+        cache.put(request, response.clone());
+    }
+    return response;
+}
+
+// キャッシュを即返しつつ、裏で最新版に更新する（オフラインでもキャッシュで起動できる）
+async function staleWhileRevalidate(request, event) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request, { ignoreSearch: request.mode === 'navigate' });
+    const update = fetch(request)
+        .then(response => {
+            if (response.ok) cache.put(request, response.clone());
+            return response;
+        })
+        .catch(() => cached || Response.error());
+
+    if (cached) {
+        event.waitUntil(update);
+        return cached;
+    }
+    return update;
+}
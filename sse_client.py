@@ -0,0 +1,186 @@
+"""
+非同期 SSE (Server-Sent Events) クライアント
+
+- UTF-8 はインクリメンタルデコーダーで復号（チャンク境界で割れた日本語も欠けない）
+- 行の切り出しは受信済みの未完了行だけを保持する線形時間処理
+- 複数行 data:、event:、id:、retry:、コメント行に対応
+- 通信が切れたら Last-Event-ID 付きでバックオフ再接続
+- id: がないのに最初からやり直すのは、サーバーが何も受け付けていないと分かるときだけ
+  （stream_chat は接続するだけで発言がログされ応答が始まるので、送り直すと二重に答える）
+"""
+import re
+import codecs
+import random
+import asyncio
+
+import aiohttp
+
+_LINE_END = re.compile(r"\r\n|\r|\n")
+_REFUSED_STATUS = (429, 503)  # サーバーが処理せずに断ったと分かるステータス
+
+
+class SSEError(Exception):
+    """再接続できない/しても無駄なストリームエラー"""
+
+
+class SSEEvent:
+    """1件分のイベント"""
+
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event="message", data="", id=""):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, SSEEvent) and (self.event, self.data, self.id) == (other.event, other.data, other.id)
+
+
+class SSEParser:
+    """受信したバイト列を順に渡すと、完成したイベントを返すパーサー"""
+
+    def __init__(self, last_event_id=""):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._line_parts = []   # 未完了の行（チャンクをまたぐ分）
+        self._skip_lf = False   # 直前のチャンクが \r で終わった（\r\n が割れた可能性）
+        self._started = False
+        self._data = []
+        self._event = ""
+        self._id_buffer = last_event_id
+        self.last_event_id = last_event_id  # 最後にディスパッチした時点のID（再接続で使う）
+        self.retry = None       # サーバー指定の再接続待ち時間 (ms)
+
+    def feed(self, chunk):
+        return self._feed_text(self._decoder.decode(chunk))
+
+    def close(self):
+        """ストリーム終了時に呼ぶ。未完了のイベントは仕様どおり破棄される"""
+        self._feed_text(self._decoder.decode(b"", final=True))
+        self._line_parts.clear()
+        self._data.clear()
+        self._event = ""
+
+    def _feed_text(self, text):
+        if not text:
+            return []
+        if not self._started:
+            self._started = True
+            if text.startswith("\ufeff"):
+                text = text[1:]
+        if self._skip_lf and text.startswith("\n"):
+            text = text[1:]
+        self._skip_lf = text.endswith("\r")
+
+        events = []
+        pos = 0
+        for match in _LINE_END.finditer(text):
+            self._line_parts.append(text[pos:match.start()])
+            line = "".join(self._line_parts)
+            self._line_parts.clear()
+            event = self._process_line(line)
+            if event:
+                events.append(event)
+            pos = match.end()
+        if pos < len(text):
+            self._line_parts.append(text[pos:])
+        return events
+
+    def _process_line(self, line):
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return None  # コメント（keep-alive など）
+
+        field, sep, value = line.partition(":")
+        if sep and value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self._id_buffer = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+
+    def _dispatch(self):
+        self.last_event_id = self._id_buffer
+        if not self._data:
+            self._event = ""
+            return None
+        event = SSEEvent(self._event or "message", "\n".join(self._data), self.last_event_id)
+        self._data.clear()
+        self._event = ""
+        return event
+
+
+def _refused(error):
+    """サーバーが何も受け付けていないと分かるエラーか（最初から送り直してよいか）"""
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True  # 接続自体ができていない
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in _REFUSED_STATUS
+    return False
+
+
+async def iter_sse(session, url, *, method="GET", headers=None, max_retries=3,
+                   backoff=0.5, max_backoff=10.0, timeout=None):
+    """SSEイベントを順に yield する。接続が切れたらバックオフ付きで再接続する
+
+    id: を受け取っていれば Last-Event-ID 付きで再開する。
+    id: がない場合に最初からやり直すのは、接続できなかったときと 429/503 で断られたときだけ。
+    それ以外（200 を受け取ったあと・応答ヘッダーの前に切れた・500 など）はサーバーが
+    発言を受け付けた可能性があり、送り直すと同じ発言が二重に処理されるので SSEError を投げる。
+    サーバーが正常にストリームを閉じた場合は再接続せずに終了する。
+    """
+    last_event_id = ""
+    retry_ms = None
+    attempt = 0
+
+    while True:
+        parser = SSEParser(last_event_id)
+        request_headers = {"Accept": "text/event-stream", "Cache-Control": "no-cache", **(headers or {})}
+        if last_event_id:
+            request_headers["Last-Event-ID"] = last_event_id
+
+        try:
+            async with session.request(method, url, headers=request_headers, timeout=timeout) as response:
+                if response.status in _REFUSED_STATUS or response.status >= 500:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history,
+                        status=response.status, message="retryable status"
+                    )
+                if response.status != 200:
+                    raise SSEError(f"HTTP {response.status}")
+
+                async for chunk in response.content.iter_any():
+                    for event in parser.feed(chunk):
+                        attempt = 0
+                        yield event
+                parser.close()
+                return
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+            last_event_id = parser.last_event_id
+            retry_ms = parser.retry if parser.retry is not None else retry_ms
+            if not last_event_id and not _refused(e):
+                raise SSEError(f"Stream dropped and cannot be resumed: {e}") from e
+            if attempt >= max_retries:
+                raise SSEError(f"Gave up after {attempt} retries: {e}") from e
+
+            if retry_ms is not None:
+                delay = retry_ms / 1000
+            else:
+                delay = min(max_backoff, backoff * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.0)  # ジッターで同時再接続をばらす
+            attempt += 1
+            print(f"[SSE] Connection lost ({type(e).__name__}). Reconnecting in {delay:.1f}s ({attempt}/{max_retries})")
+            await asyncio.sleep(delay)
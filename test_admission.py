@@ -0,0 +1,106 @@
+import asyncio
+
+from backend.admission import FairLimiter, QueueFull
+
+
+def test_round_robin_between_sessions():
+    async def run():
+        limiter = FairLimiter("test_rr", limit=1, max_queue=8)
+        order = []
+
+        async def job(session, name):
+            async with limiter.slot(session):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        # discord が3件連投しても、web の1件は2番目に呼ばれる
+        tasks = [asyncio.create_task(job(s, n)) for s, n in
+                 [("discord", "d1"), ("discord", "d2"), ("discord", "d3"), ("web", "w1")]]
+        await asyncio.gather(*tasks)
+        assert order == ["d1", "d2", "w1", "d3"]
+        assert limiter.active == 0 and limiter.waiting == 0
+    asyncio.run(run())
+
+
+def test_position_and_queue_full():
+    async def run():
+        limiter = FairLimiter("test_full", limit=1, max_queue=2)
+        running = limiter.enqueue("a")
+        assert running.granted
+        first, second = limiter.enqueue("a"), limiter.enqueue("b")
+        assert (first.position(), second.position()) == (0, 1)
+        try:
+            limiter.enqueue("c")
+        except QueueFull as e:
+            assert e.retry_after >= 1
+        else:
+            raise AssertionError("QueueFull expected")
+        assert limiter.rejected == 1
+        for ticket in (running, first, second):
+            ticket.release()
+        assert limiter.active == 0 and limiter.waiting == 0
+    asyncio.run(run())
+
+
+def test_rejections_are_exported_as_counter():
+    from backend import metrics
+
+    async def run():
+        limiter = FairLimiter("test_counter", limit=1, max_queue=0)
+        running = limiter.enqueue("a")
+        for _ in range(2):
+            try:
+                limiter.enqueue("b")
+            except QueueFull:
+                pass
+        running.release()
+    asyncio.run(run())
+
+    assert metrics.snapshot()["counters"]['mio_admission_rejected_total{dependency="test_counter"}'] == 2
+    text = metrics.render_prometheus()
+    assert "# TYPE mio_admission_rejected_total counter" in text
+    assert "# TYPE mio_admission_active gauge" in text
+    assert 'mio_admission_rejected_total{dependency="test_counter"} 2' in text
+    assert text.count("# TYPE mio_admission_rejected_total ") == 1  # ラベル違いでも TYPE は1回
+
+
+def test_release_on_error_and_while_waiting():
+    async def run():
+        limiter = FairLimiter("test_release", limit=1, max_queue=8)
+        try:
+            async with limiter.slot("a"):
+                raise RuntimeError("boom")
+        except RuntimeError:
+            pass
+        assert limiter.active == 0
+
+        running = limiter.enqueue("a")
+        waiting = limiter.enqueue("b")
+        waiting.release()  # 並んでいる間に諦めた
+        waiting.release()  # 二重に返しても数はずれない
+        assert limiter.waiting == 0 and not waiting.granted
+        running.release()
+        running.release()
+        assert limiter.active == 0
+    asyncio.run(run())
+
+
+def test_stream_chat_releases_ticket_when_setup_fails(monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend import main
+    from backend.admission import chat_limiter
+
+    async def broken_pop_image(image_id):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(main.db, "pop_image", broken_pop_image)
+    client = TestClient(main.app, raise_server_exceptions=False)
+    response = client.get("/api/stream_chat", params={"text": "こんにちは", "image_id": "missing"})
+    assert response.status_code == 500
+    assert chat_limiter.active == 0 and chat_limiter.waiting == 0
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
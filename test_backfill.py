@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from backend import backfill, embeddings
+from backend.database import ConversationDB
+
+
+class FlakyProvider(embeddings.EmbeddingProvider):
+    """最初の failures 回は失敗する API の代わり"""
+
+    model = "remote/test"
+    remote = True
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+
+    async def embed_texts(self, texts):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("503 Service Unavailable")
+        return [[float(len(t)), 1.0] for t in texts]
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    async def make(rows=3):
+        db = ConversationDB(str(tmp_path / "backfill.db"))
+        await db.init_db()
+        for i in range(rows):
+            await db.log_message("user", f"ベクトルなし{i}")
+        monkeypatch.setattr(backfill, "db", db)
+        return db
+
+    monkeypatch.setattr("backend.locks.LOCK_DIR", str(tmp_path / "locks"))
+    # 待ち時間は記録するだけにする
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(backfill.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(backfill.random, "uniform", lambda a, b: 1.0)
+    return make, sleeps
+
+
+def test_retry_with_exponential_backoff(setup):
+    make, sleeps = setup
+
+    async def run():
+        db = await make()
+        provider = FlakyProvider(failures=2)
+        worker = backfill.BackfillWorker(provider, interval=0, retry_base=1.5)
+        assert await worker.run_once()
+        assert provider.calls == 3
+        assert sleeps[:2] == [1.5, 3.0]  # 失敗するたびに倍
+        assert worker.progress["conversation_logs"] == {"done": 3, "failed": 0, "total": 3}
+        assert "503" in worker.last_error
+        assert (await db.count_missing_embeddings(provider.model))["conversation_logs"] == 0
+    asyncio.run(run())
+
+
+def test_gives_up_after_retries_and_picks_up_next_run(setup, monkeypatch):
+    make, sleeps = setup
+    monkeypatch.setattr(backfill, "BACKFILL_RETRIES", 2)
+
+    async def run():
+        db = await make()
+        provider = FlakyProvider(failures=3)
+        worker = backfill.BackfillWorker(provider, interval=0, retry_base=1.0)
+        await worker.run_once()
+        assert provider.calls == 3
+        assert worker.progress["conversation_logs"]["failed"] == 3
+        assert (await db.count_missing_embeddings(provider.model))["conversation_logs"] == 3
+
+        # 次の実行でまた拾われる
+        await worker.run_once()
+        assert worker.progress["conversation_logs"]["done"] == 3
+        assert (await db.count_missing_embeddings(provider.model))["conversation_logs"] == 0
+    asyncio.run(run())
+
+
+def test_backoff_is_capped(setup, monkeypatch):
+    make, sleeps = setup
+    monkeypatch.setattr(backfill, "BACKFILL_RETRIES", 4)
+    monkeypatch.setattr(backfill, "BACKFILL_MAX_BACKOFF", 5.0)
+
+    async def run():
+        await make(rows=1)
+        worker = backfill.BackfillWorker(FlakyProvider(failures=4), interval=0, retry_base=2.0)
+        await worker.run_once()
+        assert sleeps[:4] == [2.0, 4.0, 5.0, 5.0]
+    asyncio.run(run())
+
+
+def test_interval_only_for_remote_providers(setup, monkeypatch):
+    make, sleeps = setup
+    monkeypatch.setattr(backfill, "BACKFILL_BATCH", 2)
+
+    async def run():
+        await make(rows=5)
+        local = embeddings.LocalNgramProvider(dims=16)
+        worker = backfill.BackfillWorker(local)
+        assert worker.interval == 0
+        await worker.run_once()
+        assert worker.progress["conversation_logs"]["done"] == 5
+        assert sleeps and set(sleeps) == {0}  # ローカルは待たない（順番を回すだけ）
+
+        sleeps.clear()
+        remote = backfill.BackfillWorker(FlakyProvider())
+        assert remote.interval == backfill.BACKFILL_INTERVAL
+        await remote.run_once()
+        assert sleeps == [backfill.BACKFILL_INTERVAL] * 3  # 5件を2件ずつ
+    asyncio.run(run())
+
+
+def test_only_one_run_at_a_time(setup):
+    make, _ = setup
+
+    async def run():
+        await make(rows=1)
+        from backend.locks import file_lock
+        worker = backfill.BackfillWorker(FlakyProvider(), interval=0)
+        async with file_lock("embedding_backfill"):
+            assert await worker.run_once() is False  # 別のワーカーが実行中
+        assert await worker.run_once() is True
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    raise SystemExit(pytest.main([__file__, "-q"]))
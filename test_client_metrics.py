@@ -0,0 +1,68 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import main, metrics
+
+
+def counts(mode):
+    first = metrics.summary("mio_client_first_sound_seconds", mode=mode)
+    gaps = metrics.summary("mio_client_audio_gap_seconds", mode=mode)
+    return first.count, first.total, gaps.count, gaps.total
+
+
+def post(client, body):
+    response = client.post("/api/metrics/client", json=body)
+    assert response.status_code == 200 and response.json() == {"status": "ok"}
+
+
+def test_valid_values_are_recorded():
+    client = TestClient(main.app)
+    before = counts("API")
+    post(client, {"first_sound_ms": 850, "gaps_ms": [120, 40.5, 0], "clips": 4, "mode": "API"})
+    post(client, {"first_sound_ms": main.CLIENT_METRIC_MAX_MS, "mode": "API"})  # 上限ちょうどは入る
+    post(client, {"first_sound_ms": None, "gaps_ms": [15], "mode": "API"})       # 音が鳴らなかったターン
+
+    after = counts("API")
+    assert after[0] - before[0] == 2
+    assert after[1] - before[1] == pytest.approx(0.85 + main.CLIENT_METRIC_MAX_MS / 1000)
+    assert after[2] - before[2] == 4
+    assert after[3] - before[3] == pytest.approx(0.1755)
+
+    # ミリ秒ではなく秒で出る
+    snapshot = metrics.snapshot()["summaries"]
+    assert snapshot['mio_client_audio_gap_seconds{mode="API"}']["max"] >= 0.12
+    text = client.get("/api/metrics", params={"format": "prometheus"}).text
+    assert "# TYPE mio_client_first_sound_seconds summary" in text
+    assert f'mio_client_first_sound_seconds_count{{mode="API"}} {after[0]}' in text
+
+
+def test_drop_bad_values_and_unknown_modes():
+    client = TestClient(main.app)
+    before = {mode: counts(mode) for mode in ("LOCAL", "other")}
+    too_long = main.CLIENT_METRIC_MAX_MS + 1
+    for body in (
+        {"first_sound_ms": 850, "gaps_ms": [0, 12.5, -1, too_long], "clips": 3, "mode": "LOCAL"},
+        {"first_sound_ms": too_long, "gaps_ms": [], "mode": "LOCAL"},  # 範囲外は捨てる
+        {"first_sound_ms": -5, "gaps_ms": [3], "mode": "mystery"},     # 知らないモードは other にまとめる
+        {"first_sound_ms": 400, "mode": None},
+    ):
+        post(client, body)
+
+    local, other = counts("LOCAL"), counts("other")
+    assert (local[0] - before["LOCAL"][0], local[2] - before["LOCAL"][2]) == (1, 2)
+    assert (other[0] - before["other"][0], other[2] - before["other"][2]) == (1, 1)
+    assert "mio_client_first_sound_seconds{mode=\"mystery\"}" not in metrics.snapshot()["summaries"]
+
+    # 型が違うものは 422
+    assert client.post("/api/metrics/client", json={"gaps_ms": "fast"}).status_code == 422
+
+
+def test_gaps_are_capped_per_report():
+    client = TestClient(main.app)
+    before = counts("LOCAL")
+    post(client, {"gaps_ms": [1] * 500, "mode": "LOCAL"})
+    assert counts("LOCAL")[2] - before[2] == 200
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,291 @@
+import zlib
+import asyncio
+
+from backend import database
+from backend.database import ConversationDB
+
+MODEL = "local/test"
+
+
+def vec(*values):
+    return [float(v) for v in values]
+
+
+async def open_db(tmp_path):
+    db = ConversationDB(str(tmp_path / "mio_test.db"))
+    await db.init_db()
+    return db
+
+
+async def count(db, table):
+    async with db._connect() as conn:
+        async with conn.execute(f"SELECT COUNT(*) FROM {table}") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+# --- アーカイブ ---
+
+def test_archive_round_trip(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        await db.log_message("user", "京都に旅行したい", embedding=vec(1, 0, 0), embedding_model=MODEL)
+        await db.log_message("assistant", "いいね！紅葉の季節に行こう", embedding=vec(0, 1, 0), embedding_model=MODEL)
+        await db.log_message("user", "ベクトルなし")
+
+        assert await db.archive_logs() == 3
+        assert await count(db, "conversation_logs") == 0
+        assert (await db.get_archive_stats())["count"] == 3
+
+        found = await db.search_archive(vec(1, 0.1, 0), limit=1, model=MODEL)
+        assert [r["content"] for r in found] == ["京都に旅行したい"]
+        assert found[0]["similarity"] > 0.99
+        # int8 のまま計算しても、復元したベクトルとのコサイン類似度と同じ
+        stored = (await db.export_page("conversation_archive"))[0]["embeddings"][MODEL]
+        query = vec(1, 0.1, 0)
+        expected = sum(q * v for q, v in zip(query, stored)) / (
+            sum(q * q for q in query) ** 0.5 * sum(v * v for v in stored) ** 0.5)
+        assert abs(found[0]["similarity"] - expected) < 1e-5
+        assert await db.search_archive(vec(1, 0, 0), model="other/model") == []
+
+        rows = await db.export_page("conversation_archive")
+        assert [r["content"] for r in rows] == ["京都に旅行したい", "いいね！紅葉の季節に行こう", "ベクトルなし"]
+        assert rows[0]["embeddings"].keys() == {MODEL}
+        assert rows[2]["embeddings"] == {}
+    asyncio.run(run())
+
+
+def test_archive_up_to_id_keeps_newer_logs(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        for text in ("一", "二", "三"):
+            await db.log_message("user", text)
+        logs = await db.get_recent_context(limit=2)
+        assert await db.archive_logs(up_to_id=logs[0]["id"]) == 2
+        assert [log["content"] for log in await db.get_recent_context()] == ["三"]
+        await db.log_message("user", "四")
+        assert [log["content"] for log in await db.get_recent_context()] == ["三", "四"]
+        assert await db.archive_logs() == 2
+        assert await db.archive_logs() == 0
+    asyncio.run(run())
+
+
+def test_insert_during_archive_is_not_lost(tmp_path, monkeypatch):
+    async def run():
+        db = await open_db(tmp_path)
+        for i in range(5):
+            await db.log_message("user", f"発言{i}", embedding=vec(i, 1, 0), embedding_model=MODEL)
+
+        convert = database._to_archive_rows
+
+        def slow_convert(*args):
+            import time
+            time.sleep(0.3)  # 圧縮中に別の発言が届く
+            return convert(*args)
+
+        monkeypatch.setattr(database, "_to_archive_rows", slow_convert)
+
+        async def late_message():
+            await asyncio.sleep(0.1)
+            await db.log_message("user", "アーカイブ中の発言")
+
+        archived, _ = await asyncio.gather(db.archive_logs(), late_message())
+        assert archived == 5
+        assert [log["content"] for log in await db.get_recent_context()] == ["アーカイブ中の発言"]
+        assert (await db.get_archive_stats())["count"] == 5
+    asyncio.run(run())
+
+
+# --- 全文検索 / ハイブリッド検索 ---
+
+def test_lexical_and_hybrid_search(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        if not db.fts_enabled:
+            return  # FTS5 trigram のない SQLite
+        await db.log_message("user", "金閣寺の写真を撮った", embedding=vec(0, 0, 1), embedding_model=MODEL)
+        await db.log_message("user", "今日は晴れだね", embedding=vec(1, 0, 0), embedding_model=MODEL)
+
+        lexical = await db.search_lexical("金閣寺どうだった？")
+        assert [r["content"] for r in lexical] == ["金閣寺の写真を撮った"]
+
+        # ベクトルがなくても全文検索だけで見つかる
+        hybrid = await db.hybrid_search("金閣寺", None, limit=3)
+        assert hybrid[0]["content"] == "金閣寺の写真を撮った"
+        hybrid = await db.hybrid_search("晴れ", vec(1, 0, 0), limit=1, model=MODEL)
+        assert hybrid[0]["content"] == "今日は晴れだね"
+    asyncio.run(run())
+
+
+def test_archived_logs_are_searchable_by_text(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        if not db.fts_enabled:
+            return
+        await db.log_message("user", "金閣寺の写真を撮った")
+        await db.archive_logs()
+        await db.log_message("user", "今日は晴れだね")
+
+        found = await db.search_archive_lexical("金閣寺どうだった？")
+        assert [r["content"] for r in found] == ["金閣寺の写真を撮った"]
+        hybrid = await db.hybrid_search("金閣寺", None, limit=3)
+        assert [r["content"] for r in hybrid] == ["金閣寺の写真を撮った"]
+
+        # 保持件数を超えて消したら全文検索からも消える
+        await db.clear_logs()
+        await db.log_message("user", "清水寺にも行った")
+        await db.archive_logs()
+        assert await db.apply_archive_retention(retention_days=0, max_rows=1) == 1
+        assert await db.search_archive_lexical("金閣寺") == []
+        assert [r["content"] for r in await db.search_archive_lexical("清水寺")] == ["清水寺にも行った"]
+    asyncio.run(run())
+
+
+def test_archive_fts_is_built_for_existing_archive(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        if not db.fts_enabled:
+            return
+        await db.log_message("user", "金閣寺の写真を撮った")
+        await db.archive_logs()
+        async with db._connect() as conn:
+            await conn.execute("DROP TABLE archive_fts")  # 索引がなかった頃のDB
+            await conn.commit()
+
+        reopened = await open_db(tmp_path)
+        assert [r["content"] for r in await reopened.search_archive_lexical("金閣寺")] == ["金閣寺の写真を撮った"]
+    asyncio.run(run())
+
+
+# --- エクスポート / インポート ---
+
+def test_export_import_round_trip(tmp_path):
+    async def run():
+        src = ConversationDB(str(tmp_path / "src.db"))
+        await src.init_db()
+        await src.log_message("user", "アーカイブされる発言", embedding=vec(0.5, -0.5, 0), embedding_model=MODEL)
+        await src.archive_logs()
+        await src.log_message("user", "短期記憶の発言", metadata={"image": True}, embedding=vec(1, 2, 3), embedding_model=MODEL)
+        await src.log_compaction("要約", 0, 0, token_usage=10)
+
+        dst = ConversationDB(str(tmp_path / "dst.db"))
+        await dst.init_db()
+        for table in ("conversation_logs", "conversation_archive", "memory_summaries"):
+            assert await dst.import_rows(table, await src.export_page(table)) == 1
+
+        logs = await dst.export_page("conversation_logs")
+        assert logs[0]["content"] == "短期記憶の発言"
+        assert logs[0]["embeddings"] == {MODEL: vec(1, 2, 3)}
+        archive = await dst.export_page("conversation_archive")
+        assert archive[0]["content"] == "アーカイブされる発言"
+        assert abs(archive[0]["embeddings"][MODEL][0] - 0.5) < 0.01
+        assert (await dst.get_compaction_history())[0]["summary"] == "要約"
+        if dst.fts_enabled:
+            assert [r["content"] for r in await dst.search_archive_lexical("アーカイブされる")] == ["アーカイブされる発言"]
+    asyncio.run(run())
+
+
+# --- ベクトルの後埋め ---
+
+def test_backfill_missing_embeddings(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        await db.log_message("user", "古いモデルのベクトル", embedding=vec(1, 0), embedding_model="old/model")
+        await db.archive_logs()
+        await db.log_message("user", "ベクトルなし")
+        await db.log_message("user", "今のモデルのベクトル", embedding=vec(0, 1), embedding_model=MODEL)
+
+        assert await db.count_missing_embeddings(MODEL) == {"conversation_logs": 1, "conversation_archive": 1}
+        missing = await db.find_missing_embeddings("conversation_logs", MODEL)
+        assert [text for _, text in missing] == ["ベクトルなし"]
+        archived = await db.find_missing_embeddings("conversation_archive", MODEL)
+        assert [text for _, text in archived] == ["古いモデルのベクトル"]
+
+        await db.update_embeddings("conversation_logs", [(missing[0][0], vec(1, 1))], MODEL)
+        await db.update_embeddings("conversation_archive", [(archived[0][0], vec(1, 1))], MODEL)
+        assert await db.count_missing_embeddings(MODEL) == {"conversation_logs": 0, "conversation_archive": 0}
+        assert (await db.search_archive(vec(1, 1), model=MODEL))[0]["content"] == "古いモデルのベクトル"
+
+        # 前のモデルのベクトルは上書きされず、そのまま検索できる（戻しても埋め直し不要）
+        assert (await db.search_archive(vec(1, 0), model="old/model"))[0]["content"] == "古いモデルのベクトル"
+        assert await db.count_missing_embeddings("old/model") == {"conversation_logs": 2, "conversation_archive": 0}
+    asyncio.run(run())
+
+
+def test_vectors_of_several_models_coexist(tmp_path):
+    async def run():
+        db = await open_db(tmp_path)
+        await db.log_message("user", "京都に旅行したい", embedding=vec(1, 0), embedding_model="old/model")
+        row_id = (await db.get_recent_context())[0]["id"]
+        await db.update_embeddings("conversation_logs", [(row_id, vec(0, 1, 0))], MODEL)
+
+        # モデルごとに別のベクトル空間で見つかる（次元が違ってもよい）
+        assert (await db.search_similar_context(vec(1, 0), model="old/model"))[0]["content"] == "京都に旅行したい"
+        assert (await db.search_similar_context(vec(0, 1, 0), model=MODEL))[0]["content"] == "京都に旅行したい"
+
+        # アーカイブしても両方のベクトルを持っていく
+        await db.archive_logs()
+        assert await count(db, "log_vectors") == 0
+        rows = await db.export_page("conversation_archive")
+        assert rows[0]["embeddings"].keys() == {"old/model", MODEL}
+        assert (await db.search_archive(vec(0, 1, 0), model=MODEL))[0]["content"] == "京都に旅行したい"
+        assert (await db.search_archive(vec(1, 0), model="old/model"))[0]["content"] == "京都に旅行したい"
+
+        # 保持件数を超えて消したらベクトルも消える
+        await db.log_message("user", "ベクトルなし")
+        await db.archive_logs()
+        assert await db.apply_archive_retention(retention_days=0, max_rows=1) == 1
+        assert await count(db, "archive_vectors") == 0
+    asyncio.run(run())
+
+
+def test_legacy_embedding_columns_are_migrated(tmp_path):
+    import sqlite3
+    path = tmp_path / "mio_test.db"
+    # ベクトルを行のカラムに持っていた頃のDB
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE conversation_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT NOT NULL, content TEXT NOT NULL,
+            timestamp REAL NOT NULL, metadata TEXT, embedding TEXT, embedding_model TEXT
+        );
+        CREATE INDEX idx_conversation_logs_embedding_model ON conversation_logs(embedding_model, id);
+        CREATE TABLE conversation_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT NOT NULL, content BLOB NOT NULL,
+            timestamp REAL NOT NULL, metadata TEXT, embedding BLOB, embedding_scale REAL,
+            archived_at REAL NOT NULL, embedding_model TEXT
+        );
+    """)
+    conn.execute(
+        "INSERT INTO conversation_logs (role, content, timestamp, embedding, embedding_model) VALUES (?, ?, ?, ?, ?)",
+        ("user", "旧形式の発言", 0.0, "[1.0, 0.0]", None)
+    )
+    blob, scale = database.quantize_embedding(vec(0, 1))
+    conn.execute(
+        "INSERT INTO conversation_archive (role, content, timestamp, embedding, embedding_scale, embedding_model, archived_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ("user", zlib.compress("旧形式のアーカイブ".encode("utf-8")), 0.0, blob, scale, MODEL, 0.0)
+    )
+    conn.commit()
+    conn.close()
+
+    async def run():
+        db = await open_db(tmp_path)
+        found = await db.search_similar_context(vec(1, 0), model=database.LEGACY_EMBEDDING_MODEL)
+        assert [r["content"] for r in found] == ["旧形式の発言"]
+        found = await db.search_archive(vec(0, 1), model=MODEL)
+        assert [r["content"] for r in found] == ["旧形式のアーカイブ"]
+
+        # 旧カラムは消えている
+        async with db._connect() as conn:
+            for table in ("conversation_logs", "conversation_archive"):
+                async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+                    assert not {r[1] for r in await cursor.fetchall()} & {"embedding", "embedding_scale", "embedding_model"}
+        await db.log_message("user", "新しい発言", embedding=vec(1, 0), embedding_model=MODEL)
+        assert await count(db, "log_vectors") == 2
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,190 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import yarl
+
+discord_bot = pytest.importorskip("discord_bot")
+from discord_bot import (
+    RateLimitTracker, StreamingReply, find_split_point, split_message,
+    DISCORD_MESSAGE_LIMIT, EDIT_INTERVAL_MIN, EDIT_INTERVAL_MAX,
+)
+
+
+# --- メッセージの分割 ---
+
+def test_short_text_is_not_split():
+    assert find_split_point("こんにちは", 10) == len("こんにちは")
+
+
+def test_split_at_newline_and_sentence_end():
+    text = "一行目です\n二行目も続きます。三行目はまだまだ長く続いていく"
+    cut = find_split_point(text, 20)
+    assert text[:cut] == "一行目です\n二行目も続きます。"
+    text = "a" * 12 + "\n" + "b" * 30
+    assert text[:find_split_point(text, 20)] == "a" * 12 + "\n"
+
+
+def test_split_at_space_then_hard_limit():
+    text = "word " * 10
+    cut = find_split_point(text, 22)
+    assert text[:cut].endswith(" ") and cut <= 22
+
+    text = "あ" * (DISCORD_MESSAGE_LIMIT + 500)  # 区切りがなければ上限ちょうどで切る
+    assert find_split_point(text, DISCORD_MESSAGE_LIMIT) == DISCORD_MESSAGE_LIMIT
+
+
+def test_break_too_early_is_ignored():
+    # 区切りが前半にしかなければ、短すぎるメッセージにせず上限で切る
+    text = "はい。" + "あ" * 50
+    assert find_split_point(text, 20) == 20
+
+
+def test_emoji_are_not_broken():
+    text = "😀" * (DISCORD_MESSAGE_LIMIT + 10)  # サロゲートペアになる文字
+    head, rest = split_message(text, DISCORD_MESSAGE_LIMIT)
+    assert len(head) <= DISCORD_MESSAGE_LIMIT and head + rest == text
+    head.encode("utf-8")  # 壊れた文字がない
+
+    family = "👨‍👩‍👧"
+    text = "あ" * 18 + family + "い" * 10
+    cut = find_split_point(text, 20)  # 20文字目は ZWJ でつながった絵文字の途中
+    assert text[:cut] == "あ" * 18
+    assert text[cut:].startswith(family)
+
+    text = "か" * 20 + "\u3099" + "き" * 10  # 21文字目は結合文字の濁点
+    assert find_split_point(text, 20) == 19
+
+    text = "あ" * 19 + "👍\U0001F3FD" + "い" * 10  # 肌の色つき
+    assert find_split_point(text, 20) == 19
+
+
+def test_code_fence_is_closed_and_reopened():
+    code = "\n".join(f"print({i})" for i in range(20))
+    text = "例です:\n```python\n" + code + "\n```\nおわり"
+    pieces = []
+    while text:
+        head, text = split_message(text, 60)
+        assert len(head) <= 60
+        pieces.append(head)
+    assert len(pieces) > 2
+    for piece in pieces:
+        assert piece.count("```") % 2 == 0  # どのメッセージもコードブロックが閉じている
+    assert pieces[1].startswith("```python\n")
+    # 閉じて開き直した分を除けば元の本文に戻る
+    restored = "".join(pieces).replace("\n```" + "```python\n", "\n")
+    assert restored == "例です:\n```python\n" + code + "\n```\nおわり"
+
+
+def test_text_outside_fence_is_split_normally():
+    text = "```\nx = 1\n```\n" + "あ" * 100
+    head, rest = split_message(text, 40)
+    assert head.startswith("```\nx = 1\n```\n") and not rest.startswith("```")
+
+
+# --- レート制限 ---
+
+def response_end(path, headers):
+    return SimpleNamespace(
+        url=yarl.URL(f"https://discord.com/api/v10{path}"),
+        response=SimpleNamespace(headers=headers),
+    )
+
+
+def test_tracker_reads_rate_limit_headers():
+    async def run():
+        tracker = RateLimitTracker()
+        assert tracker.edit_interval(123) == EDIT_INTERVAL_MIN  # まだ何も知らない
+
+        await tracker._on_request_end(None, None, response_end(
+            "/channels/123/messages/456", {"X-RateLimit-Remaining": "5", "X-RateLimit-Reset-After": "4.0"}
+        ))
+        # 残り5枠のうち1枠を最終確定用に残し、4秒で4回
+        assert tracker.edit_interval(123) == pytest.approx(1.0, abs=0.05)
+        assert tracker.edit_interval(999) == EDIT_INTERVAL_MIN  # 別チャンネル
+
+        await tracker._on_request_end(None, None, response_end(
+            "/channels/123/messages", {"X-RateLimit-Remaining": "1", "Retry-After": "3"}
+        ))
+        assert tracker.edit_interval(123) == pytest.approx(3.0, abs=0.05)
+
+        await tracker._on_request_end(None, None, response_end(
+            "/channels/123/messages/456", {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "60"}
+        ))
+        assert tracker.edit_interval(123) == EDIT_INTERVAL_MAX
+
+        await tracker._on_request_end(None, None, response_end(
+            "/channels/123/messages/456", {"X-RateLimit-Remaining": "50", "X-RateLimit-Reset-After": "1"}
+        ))
+        assert tracker.edit_interval(123) == EDIT_INTERVAL_MIN
+
+        # リセット時刻を過ぎたら最短間隔に戻る
+        tracker.buckets[123] = (1, time.monotonic() - 1)
+        assert tracker.edit_interval(123) == EDIT_INTERVAL_MIN
+    asyncio.run(run())
+
+
+def test_tracker_ignores_other_requests():
+    async def run():
+        tracker = RateLimitTracker()
+        await tracker._on_request_end(None, None, response_end(
+            "/guilds/1/members", {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "5"}
+        ))
+        await tracker._on_request_end(None, None, response_end("/channels/123/messages", {}))
+        await tracker._on_request_end(None, None, response_end(
+            "/channels/123/messages", {"X-RateLimit-Remaining": "2"}
+        ))
+        assert tracker.buckets == {}
+    asyncio.run(run())
+
+
+# --- ストリーミング中の編集 ---
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content):
+        self.content = content
+        self.edits += 1
+
+
+class FakeChannel:
+    id = 123
+
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content):
+        message = FakeMessage(self, content)
+        self.messages.append(message)
+        return message
+
+
+class FastLimits:
+    def edit_interval(self, channel_id):
+        return 0.01
+
+
+def test_streaming_reply_rolls_over_to_new_messages():
+    async def run():
+        channel = FakeChannel()
+        reply = StreamingReply(channel, FastLimits(), limit=30)
+        reply.start()
+        for sentence in ["こんにちは、マスター。", "今日はいい天気だね！", "どこかに出かけよう？", "京都とかどうかな。"]:
+            reply.append(sentence)
+            await asyncio.sleep(0.02)
+        await reply.finish("\n`usage`")
+
+        contents = [m.content for m in channel.messages]
+        assert all(len(c) <= 30 for c in contents)
+        assert "".join(contents) == "こんにちは、マスター。今日はいい天気だね！どこかに出かけよう？京都とかどうかな。\n`usage`"
+        assert contents[0].endswith("！")  # 文の区切りで次のメッセージへ
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,38 @@
+import asyncio
+
+import numpy as np
+
+from backend.embeddings import LocalNgramProvider
+
+
+def test_local_vectors_are_normalized_and_stable():
+    provider = LocalNgramProvider(dims=128)
+    vec = provider.embed_one("今日はいい天気だね")
+    assert len(vec) == 128
+    assert abs(np.linalg.norm(vec) - 1.0) < 1e-5
+    # 全角/半角・大文字小文字・前後の空白の違いは同じベクトルになる
+    assert np.allclose(provider.embed_one("ＡＩと話す"), provider.embed_one(" aiと話す\n"))
+    assert provider.model == "local:ngram-v1-128"
+
+
+def test_local_similar_texts_are_closer():
+    provider = LocalNgramProvider()
+    base = provider.embed_one("昨日は京都でラーメンを食べたよ")
+    near = provider.embed_one("京都のラーメン美味しかった")
+    far = provider.embed_one("明日の会議の資料を作らないと")
+    assert np.dot(base, near) >= provider.threshold
+    assert np.dot(base, far) < provider.threshold
+
+
+def test_local_empty_text():
+    provider = LocalNgramProvider(dims=16)
+    vectors = asyncio.run(provider.embed_texts(["", "あ"]))
+    assert vectors[0] == [0.0] * 16
+    assert abs(np.linalg.norm(vectors[1]) - 1.0) < 1e-5
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
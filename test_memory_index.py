@@ -0,0 +1,82 @@
+import os
+import time
+
+from backend.memory_index import MemoryIndex
+
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    # 更新時刻の分解能が粗いファイルシステムでも変更が分かるように進めておく
+    stamp = time.time() + len(text) / 1000
+    os.utime(path, (stamp, stamp))
+
+
+def make_index(tmp_path, **kwargs):
+    identity, user, memory = (str(tmp_path / n) for n in ("IDENTITY.md", "USER.md", "MEMORY.md"))
+    write(identity, "# AI Identity\n名前: 澪 (MIO)\n")
+    write(user, "# User Profile\n名前: マスター (ユーザー)\n\n## 好み\n- 好きな食べ物: ラーメン\n")
+    write(memory, "# Long Term Memory\n\n## 約束\n- 京都に旅行する約束をした\n\n## 議論\n- AI倫理について議論した\n")
+    index = MemoryIndex(identity, {user: "ユーザーについて", memory: "これまでの思い出"}, profile_files=[user], **kwargs)
+    index.refresh()
+    return index, identity, user, memory
+
+
+def test_identity_and_profile_are_always_in_system_prompt(tmp_path):
+    index, *_ = make_index(tmp_path)
+    assert "名前: 澪" in index.system_text
+    assert "--- USER.md ---\n# User Profile\n名前: マスター (ユーザー)\n" in index.system_text
+    assert "ラーメン" not in index.system_text and "京都" not in index.system_text  # 見出しより下は索引から
+    assert len(index.chunks) == 3
+    assert all("マスター" not in text for _, text in index.chunks)
+
+
+def test_profile_without_lexical_overlap(tmp_path):
+    # 記憶のどれとも似ていない発言でも、相手の名前は分かる
+    index, *_ = make_index(tmp_path)
+    assert index.select("おはよう") == []
+    assert "名前: マスター" in index.system_text
+
+
+def test_select_relevant_entries(tmp_path):
+    index, *_ = make_index(tmp_path)
+    picked = [text for _, text in index.select("京都旅行はいつにする？")]
+    assert picked == ["約束: 京都に旅行する約束をした"]
+    assert "(これまでの思い出)\n- 約束: 京都に旅行する約束をした" in index.format(index.select("京都旅行"))
+    assert index.select("おはよう") == []
+
+
+def test_budget(tmp_path):
+    index, *_ = make_index(tmp_path, budget=10, min_similarity=-1.0)
+    assert sum(len(text) for _, text in index.select("ラーメン")) <= 10
+
+
+def test_reload_after_change(tmp_path):
+    index, identity, user, memory = make_index(tmp_path)
+    version = index.prompt_version
+    assert not index.refresh()
+
+    write(memory, "# Long Term Memory\n- 海に行った\n")
+    assert index.refresh()
+    assert index.prompt_version == version  # 思い出だけ変わってもシステムプロンプトは同じ
+    assert [text for _, text in index.select("海に行ったね")] == ["海に行った"]
+
+    write(identity, "# AI Identity\n名前: 澪 (MIO)\n一人称: 私\n")
+    assert index.refresh()
+    assert index.prompt_version != version
+
+
+def test_retrieval_disabled_keeps_full_prompt(tmp_path):
+    index, *_ = make_index(tmp_path, retrieval=False)
+    assert "マスター" in index.system_text and "京都" in index.system_text
+    assert index.select("京都") == []
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            with tempfile.TemporaryDirectory() as d:
+                func(pathlib.Path(d))
+            print(f"[OK] {name}")
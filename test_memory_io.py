@@ -0,0 +1,183 @@
+import json
+import asyncio
+
+import pytest
+
+from backend import memory_io
+from backend.database import ConversationDB
+
+MODEL = "local/test"
+
+
+async def lines(items):
+    for item in items:
+        yield item
+
+
+def header(version=memory_io.VERSION):
+    return json.dumps({"type": "header", "format": memory_io.FORMAT, "version": version})
+
+
+async def open_db(tmp_path, name):
+    db = ConversationDB(str(tmp_path / name))
+    await db.init_db()
+    return db
+
+
+async def export_lines(**kwargs):
+    return [line async for line in memory_io.export_ndjson(**kwargs)]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # memory/*.md は作業ディレクトリからの相対パス
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "USER.md").write_text("# User Profile\n名前: マスター\n", encoding="utf-8")
+    return tmp_path
+
+
+async def fill(db):
+    await db.log_message("user", "アーカイブされる発言", embedding=[0.5, -0.5], embedding_model=MODEL)
+    await db.archive_logs()
+    await db.log_message("user", "短期記憶の発言", embedding=[1.0, 2.0], embedding_model=MODEL)
+    await db.log_message("assistant", "ベクトルなしの返事")
+    await db.log_compaction("要約", 0, 0, token_usage=10)
+
+
+def test_import_twice_does_not_duplicate(workdir, monkeypatch):
+    async def run():
+        src = await open_db(workdir, "src.db")
+        await fill(src)
+        monkeypatch.setattr(memory_io, "db", src)
+        exported = await export_lines()
+
+        dst = await open_db(workdir, "dst.db")
+        monkeypatch.setattr(memory_io, "db", dst)
+        embedded = []
+
+        async def embed(texts):
+            embedded.extend(texts)
+            return [[1.0, 0.0] for _ in texts]
+
+        first = await memory_io.import_ndjson(lines(exported), embed=embed)
+        assert (first["conversation_logs"], first["conversation_archive"], first["memory_summaries"]) == (2, 1, 1)
+        assert first["files"] == 1 and first["duplicates"] == 0
+
+        second = await memory_io.import_ndjson(lines(exported), embed=embed)
+        assert (second["conversation_logs"], second["conversation_archive"], second["memory_summaries"]) == (0, 0, 0)
+        assert second["duplicates"] == 4
+        assert second["embedded"] == 0  # 取り込み済みの行はベクトル化し直さない
+        assert len(embedded) == first["embedded"]
+
+        logs = await dst.export_page("conversation_logs")
+        assert [r["content"] for r in logs] == ["短期記憶の発言", "ベクトルなしの返事"]
+        assert len(await dst.export_page("conversation_archive")) == 1
+        assert len(await dst.get_compaction_history()) == 1
+        if dst.fts_enabled:
+            assert len(await dst.search_archive_lexical("アーカイブされる")) == 1
+    asyncio.run(run())
+
+
+def test_already_archived_rows_are_not_reimported(workdir, monkeypatch):
+    async def run():
+        db = await open_db(workdir, "mio.db")
+        await db.log_message("user", "こんにちは")
+        monkeypatch.setattr(memory_io, "db", db)
+        exported = await export_lines(include_files=False)
+
+        # 取り込み先ではもうアーカイブされている
+        await db.archive_logs()
+        stats = await memory_io.import_ndjson(lines(exported))
+        assert stats["conversation_logs"] == 0 and stats["duplicates"] == 1
+
+        # 同じファイルの中の重複も1つにする
+        record = json.dumps({"type": "log", "role": "user", "content": "重複", "timestamp": 1.0})
+        stats = await memory_io.import_ndjson(lines([header(), record, record]))
+        assert stats["conversation_logs"] == 1 and stats["duplicates"] == 1
+    asyncio.run(run())
+
+
+def test_reads_version_1_embeddings(workdir, monkeypatch):
+    async def run():
+        db = await open_db(workdir, "mio.db")
+        monkeypatch.setattr(memory_io, "db", db)
+        record = {"type": "log", "role": "user", "content": "旧形式", "timestamp": 1.0,
+                  "embedding": memory_io.encode_embedding([1.0, 2.0]), "embedding_model": MODEL}
+        await memory_io.import_ndjson(lines([header(1), json.dumps(record)]), reembed="none")
+        assert (await db.export_page("conversation_logs"))[0]["embeddings"] == {MODEL: [1.0, 2.0]}
+    asyncio.run(run())
+
+
+def test_bad_header(workdir, monkeypatch):
+    async def run():
+        db = await open_db(workdir, "mio.db")
+        monkeypatch.setattr(memory_io, "db", db)
+        record = json.dumps({"type": "log", "role": "user", "content": "x", "timestamp": 1.0})
+        with pytest.raises(ValueError, match="missing header"):
+            await memory_io.import_ndjson(lines([record]))
+        with pytest.raises(ValueError, match="missing header"):
+            await memory_io.import_ndjson(lines([json.dumps({"type": "header", "format": "other"})]))
+        with pytest.raises(ValueError, match="unsupported export version"):
+            await memory_io.import_ndjson(lines([header(memory_io.VERSION + 1)]))
+        with pytest.raises(ValueError, match="empty import"):
+            await memory_io.import_ndjson(lines(["", "  "]))
+        with pytest.raises(ValueError, match="reembed"):
+            await memory_io.import_ndjson(lines([header()]), reembed="sometimes")
+        assert await db.export_page("conversation_logs") == []
+    asyncio.run(run())
+
+
+def test_bad_json_and_missing_fields(workdir, monkeypatch):
+    async def run():
+        db = await open_db(workdir, "mio.db")
+        monkeypatch.setattr(memory_io, "db", db)
+        with pytest.raises(ValueError, match="line 2: invalid JSON"):
+            await memory_io.import_ndjson(lines([header(), '{"type": "log", ']))
+        with pytest.raises(ValueError, match="line 2: missing content"):
+            await memory_io.import_ndjson(lines([header(), json.dumps({"type": "log", "role": "user", "timestamp": 1.0})]))
+        bad = {"type": "log", "role": "user", "content": "x", "timestamp": 1.0, "embeddings": {MODEL: "%%%"}}
+        with pytest.raises(ValueError, match="line 2: invalid embedding"):
+            await memory_io.import_ndjson(lines([header(), json.dumps(bad)]))
+
+        # 知らない type は飛ばす
+        stats = await memory_io.import_ndjson(lines([header(), json.dumps({"type": "future", "x": 1})]))
+        assert stats["skipped"] == 1
+    asyncio.run(run())
+
+
+def test_only_memory_files_are_written(workdir, monkeypatch):
+    async def run():
+        db = await open_db(workdir, "mio.db")
+        monkeypatch.setattr(memory_io, "db", db)
+        records = [
+            header(),
+            json.dumps({"type": "file", "path": "memory/USER.md", "content": "# User Profile\n名前: ご主人\n"}),
+            json.dumps({"type": "file", "path": "../evil.md", "content": "x"}),
+            json.dumps({"type": "file", "path": "backend/main.py", "content": "x"}),
+            json.dumps({"type": "file", "path": str(workdir / "memory" / "MEMORY.md"), "content": "x"}),
+        ]
+        stats = await memory_io.import_ndjson(lines(records))
+        assert stats["files"] == 1 and stats["skipped"] == 3
+        assert (workdir / "memory" / "USER.md").read_text(encoding="utf-8") == "# User Profile\n名前: ご主人\n"
+        assert not (workdir.parent / "evil.md").exists()
+        assert not (workdir / "backend").exists()
+        assert not (workdir / "memory" / "MEMORY.md").exists()
+
+        # --no-files なら決まったファイルでも書かない
+        stats = await memory_io.import_ndjson(lines(records[:2]), include_files=False)
+        assert stats["files"] == 0 and stats["skipped"] == 1
+    asyncio.run(run())
+
+
+def test_iter_lines_splits_utf8_across_chunks():
+    async def run():
+        data = "一行目\n二行目\n最後".encode("utf-8")
+        chunks = [data[i:i + 4] for i in range(0, len(data), 4)]  # 文字の途中で切れる
+        assert [line async for line in memory_io.iter_lines(lines(chunks))] == ["一行目", "二行目", "最後"]
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,118 @@
+from backend.memory_sections import MemoryDoc, select_context, apply_ops
+
+DEFAULT_USER = """# User Profile
+名前: マスター (ユーザー)
+特徴: まだ出会ったばかり。これから仲良くなる。
+"""
+
+MEMORY = """# Long Term Memory
+
+## 約束
+- 遊園地に行く約束をした
+  - 来月の予定
+- ラーメン屋に行く
+
+## 議論
+- AI倫理について議論した
+"""
+
+
+def ids(doc):
+    return {entry.text.strip(): entry.id for _, entry in doc.entries()}
+
+
+def test_parse_render_roundtrip():
+    assert MemoryDoc.parse(DEFAULT_USER).render() == DEFAULT_USER
+    doc = MemoryDoc.parse(MEMORY)
+    assert doc.render() == MEMORY
+    # ネストした箇条書きは親のエントリに含まれる
+    assert [len(s.entries) for s in doc.sections] == [0, 2, 1]
+
+
+def test_ids_follow_content():
+    a = MemoryDoc.parse(MEMORY)
+    b = MemoryDoc.parse(MEMORY.replace("AI倫理", "AIの倫理"))
+    assert ids(a)["- ラーメン屋に行く"] == ids(b)["- ラーメン屋に行く"]
+    assert a.sections[2].entries[0].id != b.sections[2].entries[0].id
+
+
+def test_select_only_touched_sections():
+    doc = MemoryDoc.parse(MEMORY)
+    selected = select_context(doc, ["京都のラーメン屋に一緒に行った"])
+    assert list(selected) == [doc.sections[1].id]
+
+
+def test_apply_ops():
+    doc = MemoryDoc.parse(MEMORY)
+    entry_ids = ids(doc)
+    stats = apply_ops(doc, [
+        {"op": "update", "id": entry_ids["- ラーメン屋に行く"], "text": "京都のラーメン屋に行った"},
+        {"op": "add", "section": doc.sections[2].id, "text": "宇宙の話をした"},
+        {"op": "add_section", "heading": "食べ物", "entries": ["ラーメンが好き"]},
+        {"op": "delete", "id": entry_ids["- AI倫理について議論した"]},
+        {"op": "delete", "id": "e-00000000"},
+        "broken",
+    ])
+    assert stats == {"added": 2, "updated": 1, "deleted": 1, "skipped": 2}
+    text = doc.render()
+    assert "- 京都のラーメン屋に行った" in text
+    assert "- 宇宙の話をした" in text
+    assert "## 食べ物\n- ラーメンが好き" in text
+    assert "AI倫理" not in text
+
+
+def test_apply_ops_respects_visible_ids():
+    doc = MemoryDoc.parse(MEMORY)
+    hidden = ids(doc)["- AI倫理について議論した"]
+    stats = apply_ops(doc, [{"op": "delete", "id": hidden}], visible_ids=set())
+    assert stats["skipped"] == 1
+    assert doc.render() == MEMORY
+
+
+def test_apply_ops_skips_add_to_unknown_section():
+    doc = MemoryDoc.parse(MEMORY)
+    stats = apply_ops(doc, [
+        {"op": "add", "section": "s-000000", "text": "どこにも入らない"},
+        {"op": "add", "text": "セクションなし"},
+    ])
+    assert stats == {"added": 0, "updated": 0, "deleted": 0, "skipped": 2}
+    assert doc.render() == MEMORY
+
+
+NESTED = """# T
+
+## Likes
+
+### Food
+- apple
+
+### Music
+- jazz
+"""
+
+
+def test_apply_ops_keeps_parent_headings():
+    doc = MemoryDoc.parse(NESTED)
+    assert doc.render() == NESTED
+    music = doc.section_by_id("Music").id
+    stats = apply_ops(doc, [{"op": "add", "section": music, "text": "ピアノ"}])
+    assert stats["added"] == 1
+    # 小見出しだけを持つ「## Likes」は消さない
+    assert doc.render() == NESTED + "- ピアノ\n"
+
+    # この差分で空になった小見出しは消す
+    apply_ops(doc, [{"op": "delete", "id": ids(doc)["- apple"]}])
+    assert doc.render() == "# T\n\n## Likes\n\n### Music\n- jazz\n- ピアノ\n"
+
+
+def test_apply_ops_plain_lines_stay_plain():
+    doc = MemoryDoc.parse(DEFAULT_USER)
+    apply_ops(doc, [{"op": "add", "section": "top", "text": "- 好きな食べ物: ラーメン"}])
+    assert doc.render().endswith("これから仲良くなる。\n好きな食べ物: ラーメン\n")
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
@@ -0,0 +1,113 @@
+import time
+import asyncio
+import threading
+
+from backend.model_chain import ModelChain
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeModel:
+    """stall 秒止まってから chunks を返す偽モデル（fail なら例外）"""
+
+    def __init__(self, chunks, stall=0.0, fail=None):
+        self.chunks = chunks
+        self.stall = stall
+        self.fail = fail
+        self.released = threading.Event()
+
+    def start_chat(self, history=None):
+        return self
+
+    def send_message(self, content, stream=False):
+        return self._stream()
+
+    def _stream(self):
+        self.released.wait(self.stall)
+        if self.fail:
+            raise self.fail
+        for text in self.chunks:
+            yield FakeChunk(text)
+
+    def generate_content(self, contents):
+        self.released.wait(self.stall)
+        if self.fail:
+            raise self.fail
+        return FakeChunk("".join(self.chunks))
+
+
+def make_chain(models, deadline_ms=100):
+    return ModelChain(list(models), lambda name: models[name], deadline_ms=deadline_ms)
+
+
+async def collect(chain):
+    stream = chain.stream_chat([], "こんにちは")
+    texts = [chunk.text async for chunk in stream]
+    return texts, stream.info
+
+
+def test_primary_answers():
+    chain = make_chain({"main": FakeModel(["a", "b"]), "lite": FakeModel(["x"])})
+    texts, info = asyncio.run(collect(chain))
+    assert texts == ["a", "b"]
+    assert info == {"model": "main", "fallbacks": []}
+
+
+def test_stalled_model_falls_back():
+    stalled = FakeModel(["late"], stall=5)
+    chain = make_chain({"main": stalled, "lite": FakeModel(["x", "y"])})
+    started = time.perf_counter()
+    texts, info = asyncio.run(collect(chain))
+    stalled.released.set()
+    assert texts == ["x", "y"]
+    assert time.perf_counter() - started < 1
+    assert info["model"] == "lite"
+    assert info["fallbacks"][0]["model"] == "main"
+    assert info["fallbacks"][0]["reason"] == "timeout"
+
+
+def test_error_before_first_token_falls_back():
+    chain = make_chain({"main": FakeModel([], fail=RuntimeError("503 overloaded")), "lite": FakeModel(["x"])})
+    texts, info = asyncio.run(collect(chain))
+    assert texts == ["x"]
+    assert "503" in info["fallbacks"][0]["reason"]
+
+
+def test_last_model_has_no_deadline():
+    chain = make_chain({"main": FakeModel(["slow"], stall=0.3)}, deadline_ms=50)
+    texts, info = asyncio.run(collect(chain))
+    assert texts == ["slow"]
+    assert info["model"] == "main"
+
+
+def test_empty_stream_falls_back_then_ends():
+    # チャンクなしで終わっても待ち続けない（次のモデルへ、最後のモデルなら空で終わる）
+    chain = make_chain({"main": FakeModel([]), "lite": FakeModel(["x"])})
+    texts, info = asyncio.run(asyncio.wait_for(collect(chain), 2))
+    assert texts == ["x"]
+    assert info["fallbacks"][0]["reason"] == "empty response"
+
+    chain = make_chain({"main": FakeModel([]), "lite": FakeModel([])})
+    texts, info = asyncio.run(asyncio.wait_for(collect(chain), 2))
+    assert texts == []
+    assert info["model"] == "lite"
+
+
+def test_generate_falls_back():
+    stalled = FakeModel(["late"], stall=5)
+    chain = make_chain({"main": stalled, "lite": FakeModel(["{}"])})
+    resp, info = asyncio.run(chain.generate("prompt"))
+    stalled.released.set()
+    assert resp.text == "{}"
+    assert info["model"] == "lite"
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
@@ -0,0 +1,73 @@
+import asyncio
+
+from backend.prefetch import PrefetchCache, normalize
+
+
+def make_compute(calls):
+    async def compute(text):
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return [float(len(text))], [{"content": f"{text} の記憶"}]
+    return compute
+
+
+def test_normalize():
+    assert normalize("  京都　旅行、いつ行く？！ ") == "京都 旅行、いつ行く"
+    assert normalize("ＡＢＣ") == "abc"
+
+
+def test_exact_match_reuses_embedding():
+    async def run():
+        cache, calls = PrefetchCache(), []
+        assert cache.schedule("京都旅行はいつにする？", make_compute(calls), session="web")
+        assert not cache.schedule("京都旅行はいつにする", make_compute(calls), session="web")  # 同じ下書き
+        embedding, memories = await cache.take("京都旅行はいつにする。", "web")
+        assert embedding == [float(len("京都旅行はいつにする？"))]
+        assert memories[0]["content"].startswith("京都旅行")
+        assert calls == ["京都旅行はいつにする？"]
+        assert await cache.take("京都旅行はいつにする？", "web") is None  # 1回使ったら消える
+    asyncio.run(run())
+
+
+def test_near_match_reuses_memories_only():
+    async def run():
+        cache = PrefetchCache(similarity=0.8)
+        cache.schedule("明日の京都旅行の持ち物を確認したい", make_compute([]), session="web")
+        embedding, memories = await cache.take("明日の京都旅行の持ち物を確認したいな", "web")
+        assert embedding is None  # 別の文のベクトルは保存に使わない
+        assert memories == [{"content": "明日の京都旅行の持ち物を確認したい の記憶"}]
+    asyncio.run(run())
+
+
+def test_sessions_are_separate():
+    async def run():
+        cache = PrefetchCache(similarity=0.8)
+        cache.schedule("明日の京都旅行の持ち物を確認したい", make_compute([]), session="web")
+        assert await cache.take("明日の京都旅行の持ち物を確認したい", "discord") is None
+        assert await cache.take("明日の京都旅行の持ち物を確認したいな", "discord") is None
+        assert cache.misses == 2
+        assert (await cache.take("明日の京都旅行の持ち物を確認したい", "web"))[0] is not None
+
+        # 別セッションの下書きで、まだ計算中の先読みを止めない
+        cache.schedule("ラーメン屋の話の続きをしよう", make_compute([]), session="web")
+        cache.schedule("今日の天気はどうかな", make_compute([]), session="discord")
+        assert await cache.take("ラーメン屋の話の続きをしよう", "web") is not None
+    asyncio.run(run())
+
+
+def test_newer_draft_cancels_older_one_in_same_session():
+    async def run():
+        cache, calls = PrefetchCache(), []
+        cache.schedule("京都旅行は", make_compute(calls), session="web")
+        cache.schedule("京都旅行はいつにする", make_compute(calls), session="web")
+        await asyncio.sleep(0.05)
+        assert await cache.take("京都旅行は", "web") is None
+        assert await cache.take("京都旅行はいつにする", "web") is not None
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
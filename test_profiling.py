@@ -0,0 +1,109 @@
+import os
+import time
+import asyncio
+import threading
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.profiling import RequestProfiler, ProfilingMiddleware, LoopLagMonitor
+
+
+def make_client(profiler):
+    app = FastAPI()
+
+    @app.post("/api/memory/compact")
+    async def compact():
+        await asyncio.sleep(0.02)
+        return {"status": "ok"}
+
+    @app.get("/api/other")
+    async def other():
+        return {"status": "ok"}
+
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+    return TestClient(app)
+
+
+def profiler_threads():
+    return [t for t in threading.enumerate() if t.name == "mio-profiler"]
+
+
+def test_profile_id_header_and_saved_files(tmp_path):
+    for mode in ("sample", "cprofile"):
+        profiler = RequestProfiler(profile_dir=str(tmp_path / mode), mode=mode)
+        client = make_client(profiler)
+
+        # 未計測のときはヘッダーをつけない
+        assert "x-profile-id" not in client.post("/api/memory/compact").headers
+
+        profiler.arm(1, targets=["compact"])
+        assert "x-profile-id" not in client.get("/api/other").headers  # 対象外のパス
+        response = client.post("/api/memory/compact")
+        request_id = response.headers["x-profile-id"]
+        assert request_id.startswith("compact-")
+
+        # 計測結果は status の recent から取れて、ファイルも残っている
+        status = profiler.status()
+        assert status["active"] is None and status["remaining"]["compact"] == 0
+        info = status["recent"][0]
+        assert info["request_id"] == request_id and info["mode"] == mode
+        assert info["files"] and all(os.path.exists(path) for path in info["files"])
+        assert os.path.exists(tmp_path / mode / f"{request_id}.json")
+
+        # N件で止まる
+        assert "x-profile-id" not in client.post("/api/memory/compact").headers
+
+
+def test_sessions_do_not_leak(tmp_path):
+    profiler = RequestProfiler(profile_dir=str(tmp_path), mode="sample")
+    client = make_client(profiler)
+    profiler.arm(3, targets=["compact"])
+    for _ in range(3):
+        client.post("/api/memory/compact")
+    assert profiler.active is None
+    assert len(profiler.recent) == 3
+    assert profiler_threads() == []  # サンプラーのスレッドは止まっている
+
+
+def test_only_one_session_at_a_time(tmp_path):
+    async def run():
+        profiler = RequestProfiler(profile_dir=str(tmp_path), mode="sample")
+        profiler.arm(2, targets=["compact"])
+        first = profiler.start("compact")
+        assert first is not None and profiler.start("compact") is None
+        assert profiler.remaining["compact"] == 1
+        await profiler.stop(first)
+        await profiler.stop(first)  # 二重に止めても何も起きない
+        assert profiler.active is None and len(profiler.recent) == 1
+    asyncio.run(run())
+
+
+def test_loop_lag_is_reported(tmp_path):
+    async def run():
+        profiler = RequestProfiler(profile_dir=str(tmp_path))
+        monitor = LoopLagMonitor(profiler, threshold_ms=0, interval=0.01)
+        monitor.start()
+        assert not monitor.status()["running"]  # 閾値 0 は無効
+
+        monitor.start(threshold_ms=50)
+        profiler.arm(1, targets=["compact"])
+        session = profiler.start("compact")
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)  # イベントループをブロックする
+        await asyncio.sleep(0.05)
+
+        status = monitor.status()
+        assert status["running"] and status["blocked_count"] >= 1
+        assert status["max_lag_ms"] >= 100
+        assert session.lag_events  # 計測中のリクエストにも記録される
+        await profiler.stop(session)
+
+        await monitor.stop()
+        assert not monitor.status()["running"]
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    import pytest
+    raise SystemExit(pytest.main([__file__, "-q"]))
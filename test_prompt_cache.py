@@ -0,0 +1,192 @@
+import time
+import asyncio
+
+import pytest
+
+from backend import prompt_cache
+from backend.memory_index import MemoryIndex
+from backend.prompt_cache import PromptPrefix
+
+LONG_PROMPT = "あなたはAIパートナー「澪（MIO）」です。" * 20
+
+
+class StubClient:
+    """Gemini の代わりに呼び出しを記録するだけのクライアント"""
+
+    def __init__(self, fail_create=False):
+        self.fail_create = fail_create
+        self.calls = []
+        self.count = 0
+
+    def create(self, model, system_instruction, ttl):
+        self.calls.append(("create", model))
+        if self.fail_create:
+            raise RuntimeError("Cached content is too small")
+        self.count += 1
+        return f"cache-{self.count}"
+
+    def refresh(self, cache, ttl):
+        self.calls.append(("refresh", cache))
+
+    def delete(self, cache):
+        self.calls.append(("delete", cache))
+
+    def model(self, name, system_instruction):
+        return ("plain", name, system_instruction)
+
+    def model_from_cache(self, cache):
+        return ("cached", cache)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+
+def make_prefix(client, **kwargs):
+    return PromptPrefix(["main", "lite"], client=client, ttl=60, min_chars=100, enabled=True, **kwargs)
+
+
+def test_short_prompt_is_not_cached():
+    async def run():
+        client = StubClient()
+        prefix = make_prefix(client)
+        chain = prefix.update("短い")
+        await settle()
+        assert chain.get_model("main") == ("plain", "main", "短い")
+        assert client.calls == []
+    asyncio.run(run())
+
+
+def test_cache_created_in_background_and_used_by_primary():
+    async def run():
+        client = StubClient()
+        prefix = make_prefix(client)
+        first = prefix.update(LONG_PROMPT)
+        # 作成中は普通に送る
+        assert first.get_model("main")[0] == "plain"
+        await settle()
+        chain = prefix.update(LONG_PROMPT)
+        assert chain.get_model("main") == ("cached", "cache-1")
+        assert chain.get_model("lite")[0] == "plain"
+        assert client.calls == [("create", "main")]
+        assert prefix.status()["cached"]
+    asyncio.run(run())
+
+
+def test_prompt_change_rebuilds_and_deletes_old_cache():
+    async def run():
+        client = StubClient()
+        prefix = make_prefix(client)
+        prefix.update(LONG_PROMPT)
+        await settle()
+        version = prefix.version
+        chain = prefix.update(LONG_PROMPT + "一人称: 私")
+        assert prefix.version != version
+        assert chain.get_model("main")[0] == "plain"
+        await settle()
+        assert ("delete", "cache-1") in client.calls
+        assert prefix.update(LONG_PROMPT + "一人称: 私").get_model("main") == ("cached", "cache-2")
+    asyncio.run(run())
+
+
+def test_refresh_near_expiry_and_recreate_after_expiry():
+    async def run():
+        client = StubClient()
+        prefix = make_prefix(client)
+        prefix.update(LONG_PROMPT)
+        await settle()
+
+        prefix.expires_at = time.time() + 5  # 残り 5/60 秒
+        prefix.update(LONG_PROMPT)
+        await settle()
+        assert ("refresh", "cache-1") in client.calls
+        assert prefix.expires_at > time.time() + 50
+
+        prefix.expires_at = time.time() - 1  # 使われないうちに切れた
+        chain = prefix.update(LONG_PROMPT)
+        assert chain.get_model("main")[0] == "plain"
+        await settle()
+        assert prefix.update(LONG_PROMPT).get_model("main") == ("cached", "cache-2")
+    asyncio.run(run())
+
+
+def test_create_failure_falls_back_and_waits_before_retry():
+    async def run():
+        client = StubClient(fail_create=True)
+        prefix = make_prefix(client, retry=300)
+        prefix.update(LONG_PROMPT)
+        await settle()
+        chain = prefix.update(LONG_PROMPT)
+        await settle()
+        assert chain.get_model("main")[0] == "plain"
+        assert client.calls == [("create", "main")]
+        assert "too small" in prefix.status()["last_error"]
+    asyncio.run(run())
+
+
+def test_close_deletes_cache():
+    async def run():
+        client = StubClient()
+        prefix = make_prefix(client)
+        prefix.update(LONG_PROMPT)
+        await settle()
+        await prefix.close()
+        assert client.calls[-1] == ("delete", "cache-1")
+        assert not prefix.status()["cached"]
+    asyncio.run(run())
+
+
+# --- main.py が組み立てる本物のシステムプロンプト ---
+
+@pytest.fixture
+def real_prompt(tmp_path, monkeypatch):
+    """デフォルトの記憶ファイルから main.system_prompt() を作る"""
+    from backend import main
+    monkeypatch.chdir(tmp_path)
+    main.ensure_memory_files()
+
+    def build(retrieval, memory_lines=0):
+        if memory_lines:
+            lines = "\n".join(f"- {i}回目の思い出: 一緒に出かけて、帰りに駅前のカフェで話し込んだ" for i in range(memory_lines))
+            (tmp_path / "memory" / "MEMORY.md").write_text(f"# Long Term Memory\n{lines}\n", encoding="utf-8")
+        index = MemoryIndex(retrieval=retrieval)
+        index.refresh()
+        monkeypatch.setattr(main, "memory_index", index)
+        return main.system_prompt()
+    return build
+
+
+def test_real_prompt_is_too_short_to_cache(real_prompt):
+    # 長期記憶を関係する分だけ入れるデフォルトでは、キャッシュの最小サイズに届かないので無効にしてある
+    text = real_prompt(retrieval=True)
+    assert "名前: 澪" in text and "名前: マスター" in text
+    assert len(text) < prompt_cache.PROMPT_CACHE_MIN_CHARS
+    assert not prompt_cache.PROMPT_CACHE_ENABLED
+
+    async def run():
+        client = StubClient()
+        prefix = PromptPrefix(["main"], client=client, enabled=True)
+        prefix.update(text)
+        await settle()
+        assert client.calls == [] and not prefix.status()["cached"]
+    asyncio.run(run())
+
+
+def test_real_prompt_with_full_memory_is_cached(real_prompt):
+    # MIO_MEMORY_RETRIEVAL=0 なら記憶ファイルが全部入るので、育てばキャッシュされる
+    text = real_prompt(retrieval=False, memory_lines=60)
+    assert len(text) >= prompt_cache.PROMPT_CACHE_MIN_CHARS
+
+    async def run():
+        client = StubClient()
+        prefix = PromptPrefix(["main"], client=client, enabled=True)
+        prefix.update(text)
+        await settle()
+        assert prefix.update(text).get_model("main") == ("cached", "cache-1")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    raise SystemExit(pytest.main([__file__, "-q"]))
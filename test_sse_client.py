@@ -0,0 +1,178 @@
+import asyncio
+import json
+
+import aiohttp
+import yarl
+
+from sse_client import SSEParser, SSEEvent, SSEError, iter_sse
+
+STREAM = (
+    'data: {"type": "chunk", "content": "こんにちは、マスター！"}\r\n\r\n'
+    ": keep-alive\n\n"
+    "event: usage\n"
+    "id: 42\n"
+    "retry: 1500\n"
+    "data: line1\n"
+    "data:line2\n"
+    "data\n"
+    "\n"
+    'data: {"type": "end"}\r\r'
+).encode("utf-8")
+
+EXPECTED = [
+    SSEEvent("message", '{"type": "chunk", "content": "こんにちは、マスター！"}', ""),
+    SSEEvent("usage", "line1\nline2\n", "42"),
+    SSEEvent("message", '{"type": "end"}', "42"),
+]
+
+
+def parse_chunks(chunks):
+    parser = SSEParser()
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    parser.close()
+    return events, parser
+
+
+def test_whole_stream():
+    events, parser = parse_chunks([STREAM])
+    assert events == EXPECTED
+    assert parser.retry == 1500
+    assert parser.last_event_id == "42"
+
+
+def test_every_two_way_split():
+    # マルチバイト文字の途中や \r\n の間も含め、全ての位置で分割する
+    for i in range(len(STREAM) + 1):
+        events, _ = parse_chunks([STREAM[:i], STREAM[i:]])
+        assert events == EXPECTED, f"split at {i}"
+
+
+def test_one_byte_at_a_time():
+    events, _ = parse_chunks([STREAM[i:i + 1] for i in range(len(STREAM))])
+    assert events == EXPECTED
+    assert "\ufffd" not in json.loads(events[0].data)["content"]
+
+
+def test_crlf_split_does_not_add_blank_line():
+    events, _ = parse_chunks([b"data: a\r", b"\ndata: b\r\n", b"\r\n"])
+    assert events == [SSEEvent("message", "a\nb", "")]
+
+
+def test_incomplete_event_is_discarded_on_close():
+    events, _ = parse_chunks([b"data: partial\n"])
+    assert events == []
+
+
+def test_bom_and_ignored_fields():
+    events, _ = parse_chunks([b"\xef\xbb\xbfdata: x\nfoo: bar\nid: a\x00b\nretry: soon\n\n"])
+    assert events == [SSEEvent("message", "x", "")]
+
+
+# --- 再接続 ---
+
+class FakeContent:
+    def __init__(self, chunks, fail):
+        self.chunks = chunks
+        self.fail = fail
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.fail:
+            raise aiohttp.ClientPayloadError("connection reset")
+
+
+class FakeResponse:
+    request_info = aiohttp.RequestInfo(
+        yarl.URL("http://mio/api/stream_chat"), "GET", {}, yarl.URL("http://mio/api/stream_chat")
+    )
+    history = ()
+
+    def __init__(self, chunks, fail, status=200):
+        self.status = status
+        self.content = FakeContent(chunks, fail)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, attempts):
+        self.attempts = list(attempts)
+        self.requests = []
+
+    def request(self, method, url, headers=None, timeout=None):
+        self.requests.append(headers)
+        attempt = self.attempts.pop(0)
+        if isinstance(attempt, Exception):
+            raise attempt
+        if isinstance(attempt, int):
+            return FakeResponse([], False, status=attempt)
+        chunks, fail = attempt
+        return FakeResponse(chunks, fail)
+
+
+async def collect(session):
+    return [event.data async for event in iter_sse(session, "http://mio/api/stream_chat", backoff=0)]
+
+
+def test_reconnect_with_last_event_id():
+    session = FakeSession([
+        ([b"retry: 0\nid: 1\ndata: a\n\nid: 2\ndata: b"], True),
+        ([b"data: \xe3\x81", b"\x82\n\n"], False),
+    ])
+    assert asyncio.run(collect(session)) == ["a", "あ"]
+    assert session.requests[1]["Last-Event-ID"] == "1"
+
+
+def test_drop_without_id_is_not_replayed():
+    session = FakeSession([([b"data: a\n\n"], True), ([b"data: a\n\n"], False)])
+    try:
+        asyncio.run(collect(session))
+    except SSEError:
+        pass
+    else:
+        raise AssertionError("SSEError expected")
+    assert len(session.requests) == 1
+
+
+def test_drop_before_first_event_is_not_replayed():
+    # 200 を返したあとはサーバーが発言を受け付けている（送り直すと二重に答える）
+    session = FakeSession([([], True), ([b"data: a\n\n"], False)])
+    try:
+        asyncio.run(collect(session))
+    except SSEError:
+        pass
+    else:
+        raise AssertionError("SSEError expected")
+    assert len(session.requests) == 1
+
+
+def test_retry_when_server_refused_or_unreachable():
+    refused = aiohttp.ClientConnectorError(None, OSError(111, "Connection refused"))
+    session = FakeSession([503, refused, ([b"data: a\n\n"], False)])
+    assert asyncio.run(collect(session)) == ["a"]
+    assert len(session.requests) == 3
+
+
+def test_internal_error_is_not_replayed():
+    session = FakeSession([500, ([b"data: a\n\n"], False)])
+    try:
+        asyncio.run(collect(session))
+    except SSEError:
+        pass
+    else:
+        raise AssertionError("SSEError expected")
+    assert len(session.requests) == 1
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
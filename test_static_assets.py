@@ -0,0 +1,139 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import subprocess
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+from backend import static_assets
+from backend.static_assets import PrecompressedStaticFiles, CACHE_IMMUTABLE, CACHE_REVALIDATE
+
+FRONTEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend")
+
+INDEX = """<!DOCTYPE html>
+<html><head><link rel="stylesheet" href="style.css?v=2"></head>
+<body><script src="app.js?v=2"></script></body></html>
+"""
+
+
+@pytest.fixture
+def frontend(tmp_path):
+    (tmp_path / "index.html").write_text(INDEX, encoding="utf-8")
+    (tmp_path / "style.css").write_text("body { color: #333; }\n" * 50, encoding="utf-8")
+    (tmp_path / "app.js").write_text("console.log('mio');\n" * 50, encoding="utf-8")
+    (tmp_path / "other.txt").write_text("plain", encoding="utf-8")
+    shutil.copy(os.path.join(FRONTEND, "sw.js"), tmp_path / "sw.js")  # 本物の sw.js
+    return tmp_path
+
+
+def make_client(directory):
+    static_files = PrecompressedStaticFiles(directory=str(directory), html=True)
+    app = Starlette(routes=[Mount("/", static_files)])
+    return TestClient(app), static_files
+
+
+def hashed_url(client, name):
+    html = client.get("/", headers={"Accept-Encoding": "identity"}).text
+    stem, ext = os.path.splitext(name)
+    return re.search(rf'{stem}\.[0-9a-f]{{10}}\{ext}', html).group(0)
+
+
+def test_index_points_to_hashed_urls(frontend):
+    client, _ = make_client(frontend)
+    response = client.get("/", headers={"Accept-Encoding": "identity"})
+    assert response.headers["cache-control"] == CACHE_REVALIDATE
+    assert "style.css?v=2" not in response.text and "app.js?v=2" not in response.text
+    assert hashed_url(client, "style.css") and hashed_url(client, "app.js")
+
+
+def test_encoding_follows_accept_encoding(frontend):
+    client, _ = make_client(frontend)
+    url = "/" + hashed_url(client, "app.js")
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    gz = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert gz.headers["content-encoding"] == "gzip" and gz.headers["vary"] == "Accept-Encoding"
+    assert gz.content == plain.content  # httpx が展開する
+
+    if static_assets.brotli is not None:
+        br = client.get(url, headers={"Accept-Encoding": "gzip, deflate, br"})
+        assert br.headers["content-encoding"] == "br" and br.headers["vary"] == "Accept-Encoding"
+        # br を q=0 で断られたら gzip
+        gz = client.get(url, headers={"Accept-Encoding": "br;q=0, gzip"})
+        assert gz.headers["content-encoding"] == "gzip"
+
+    # ETag はエンコーディングごとに違い、一致すれば 304
+    etag = gz.headers["etag"]
+    assert etag != plain.headers["etag"]
+    assert client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+
+
+def test_accepts():
+    assert static_assets._accepts("gzip, br", "br")
+    assert static_assets._accepts("*", "gzip")
+    assert not static_assets._accepts("gzip;q=0", "gzip")
+    assert not static_assets._accepts("identity", "gzip")
+    assert not static_assets._accepts("brotli", "br")
+
+
+def test_immutable_only_for_hashed_urls(frontend):
+    client, _ = make_client(frontend)
+    for name in ("style.css", "app.js"):
+        assert client.get("/" + hashed_url(client, name)).headers["cache-control"] == CACHE_IMMUTABLE
+        assert client.get("/" + name).headers["cache-control"] == CACHE_REVALIDATE  # 古いURL
+    assert client.get("/sw.js").headers["cache-control"] == CACHE_REVALIDATE
+    assert client.get("/").headers["cache-control"] == CACHE_REVALIDATE
+    assert client.get("/other.txt").headers["cache-control"] == static_assets.CACHE_DEFAULT
+
+
+def test_service_worker_has_no_placeholder(frontend):
+    client, static_files = make_client(frontend)
+    sw = client.get("/sw.js").text
+    assert "__MIO_" not in sw
+    assert f'const CACHE_VERSION = "{static_files.store.version}";' in sw
+    shell = json.loads(re.search(r"const APP_SHELL = (\[.*?\]);", sw).group(1))
+    assert shell[0] == "./" and hashed_url(client, "style.css") in shell and hashed_url(client, "app.js") in shell
+
+    # 埋め込み後も、埋め込む前のファイルそのままでも、読み込んだ時点でエラーにならない
+    if shutil.which("node"):
+        served = frontend / "served_sw.js"
+        served.write_text(sw, encoding="utf-8")
+        assert run_service_worker(served) == shell
+        assert run_service_worker(frontend / "sw.js") == ["./"]
+
+
+def run_service_worker(path):
+    """sw.js をトップレベルだけ実行して APP_SHELL を返す"""
+    script = (
+        "const vm = require('vm');"
+        "const src = require('fs').readFileSync(process.argv[1], 'utf8');"
+        "const ctx = { self: { addEventListener() {} }, caches: {}, fetch() {}, URL };"
+        "console.log(JSON.stringify(vm.runInNewContext(src + ';APP_SHELL', ctx)));"
+    )
+    result = subprocess.run(["node", "-e", script, str(path)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout)
+
+
+def test_rebuilds_when_files_change(frontend):
+    client, static_files = make_client(frontend)
+    old_url = hashed_url(client, "style.css")
+    old_version = static_files.store.version
+
+    path = frontend / "style.css"
+    path.write_text("body { color: #000; }\n", encoding="utf-8")
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    new_url = hashed_url(client, "style.css")
+    assert new_url != old_url and static_files.store.version != old_version
+    assert gzip.decompress(static_files.store.get(new_url).gzip) == b"body { color: #000; }\n"
+
+
+if __name__ == "__main__":
+    raise SystemExit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,115 @@
+import asyncio
+
+from aiohttp import web
+
+from backend import tts
+from backend.tts import LocalAivisBackend, CloudAivisBackend, TTSPool
+
+
+class FakeAivis:
+    """ローカルで立てる偽の Aivis Speech (mode: ok / fail / slow)"""
+
+    def __init__(self, name, mode="ok", delay=0.0):
+        self.name = name
+        self.mode = mode
+        self.delay = delay
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def audio_query(self, request):
+        self.requests += 1
+        if self.mode == "fail":
+            return web.Response(status=500)
+        await asyncio.sleep(self.delay)
+        return web.json_response({"text": request.query["text"]})
+
+    async def synthesis(self, request):
+        return web.Response(body=b"RIFF" + self.name.encode())
+
+    async def version(self, request):
+        return web.Response(status=500 if self.mode == "fail" else 200, text="1.0")
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/audio_query", self.audio_query)
+        app.router.add_post("/synthesis", self.synthesis)
+        app.router.add_get("/version", self.version)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await tts.close()
+    return asyncio.run(main())
+
+
+def test_least_outstanding_spreads_load():
+    async def scenario():
+        async with FakeAivis("a", delay=0.2) as a, FakeAivis("b", delay=0.2) as b:
+            pool = TTSPool([LocalAivisBackend(a.url), LocalAivisBackend(b.url)])
+            results = await asyncio.gather(*(pool.synthesize("こんにちは", "LOCAL") for _ in range(4)))
+            assert all(audio for audio, _ in results)
+            assert a.requests == 2 and b.requests == 2
+    run(scenario())
+
+
+def test_failover_and_breaker():
+    async def scenario():
+        async with FakeAivis("bad", mode="fail") as bad, FakeAivis("good") as good:
+            pool = TTSPool([LocalAivisBackend(bad.url), LocalAivisBackend(good.url)])
+            for _ in range(5):
+                audio, backend = await pool.synthesize("テスト", "LOCAL")
+                assert audio == b"RIFFgood"
+                assert backend == f"local:{good.url}"
+            # 3回失敗した時点でブレーカーが開き、それ以降は呼ばれない
+            assert bad.requests == tts.BREAKER_FAILURES
+            assert pool.backends[0].opened_at is not None
+    run(scenario())
+
+
+def test_other_kind_only_with_failover():
+    local, cloud = LocalAivisBackend("http://local"), CloudAivisBackend("http://cloud", "key")
+    assert TTSPool([local, cloud]).candidates("LOCAL") == [local]
+    assert TTSPool([local, cloud], failover=True).candidates("LOCAL") == [local, cloud]
+    # モードの合成先がひとつもなければ、ある方を使う
+    assert TTSPool([cloud]).candidates("LOCAL") == [cloud]
+
+
+def test_health_check_opens_and_closes_breaker():
+    async def scenario():
+        async with FakeAivis("x", mode="fail") as x:
+            pool = TTSPool([LocalAivisBackend(x.url)])
+            await pool.check_health()
+            assert not pool.backends[0].available()
+            x.mode = "ok"
+            await pool.check_health()
+            assert pool.backends[0].available()
+    run(scenario())
+
+
+def test_all_backends_down():
+    async def scenario():
+        async with FakeAivis("bad", mode="fail") as bad:
+            pool = TTSPool([LocalAivisBackend(bad.url)])
+            assert await pool.synthesize("テスト", "LOCAL") == (None, None)
+    run(scenario())
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(f"[OK] {name}")
@@ -0,0 +1,135 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from backend import vision_cache
+from backend.database import ConversationDB, hamming_distance
+
+cv2 = pytest.importorskip("cv2")
+
+
+def room(shift=0, brightness=0, seed=0):
+    """カメラ画像の代わり（なめらかな明暗 + 物の形）を JPEG にする"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:480, 0:640]
+    image = (np.sin((x + shift) / 90.0) * 60 + np.cos(y / 70.0) * 50 + 128).astype(np.float32)
+    for _ in range(6):
+        cx, cy, r = rng.integers(60, 580), rng.integers(60, 420), rng.integers(20, 60)
+        cv2.circle(image, (int(cx + shift), int(cy)), int(r), float(rng.integers(0, 255)), -1)
+    image = np.clip(image + brightness + rng.normal(0, 3, image.shape), 0, 255).astype(np.uint8)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    assert ok
+    return encoded.tobytes()
+
+
+def test_dhash_distance():
+    base = vision_cache.image_hash(room())
+    assert -(1 << 63) <= base < (1 << 63)  # SQLite の INTEGER に入る
+    assert hamming_distance(base, base) == 0
+
+    # 少し明るくなった・数画素ずれただけなら「ほぼ同じ」
+    same = vision_cache.image_hash(room(shift=2, brightness=8))
+    assert hamming_distance(base, same) <= vision_cache.VISION_CACHE_DISTANCE
+
+    # 物が動いた・別の部屋・大きく構図が変わった画像は別物
+    assert hamming_distance(base, vision_cache.image_hash(room(shift=40))) > vision_cache.VISION_CACHE_DISTANCE
+    assert hamming_distance(base, vision_cache.image_hash(room(seed=1))) > vision_cache.VISION_CACHE_DISTANCE
+    assert hamming_distance(base, vision_cache.image_hash(room(shift=200))) > vision_cache.VISION_CACHE_DISTANCE
+
+    assert vision_cache.image_hash(b"not an image") is None
+
+
+async def setup_cache(tmp_path, monkeypatch, gate=None):
+    """Gemini の代わりに説明文を返す（呼ばれた回数を数える）"""
+    db = ConversationDB(str(tmp_path / "vision.db"))
+    await db.init_db()
+    monkeypatch.setattr(vision_cache, "db", db)
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    calls = []
+
+    async def fake_describe(image_bytes, mime_type="image/jpeg"):
+        calls.append(image_bytes)
+        if gate is not None:
+            await gate.wait()
+        return "机とモニターがある部屋"
+
+    monkeypatch.setattr(vision_cache, "describe_image", fake_describe)
+    return calls
+
+
+async def send_frame(image):
+    """main.py と同じ流れ: キャッシュがあれば説明文、なければ画像を送って裏で説明文を作る"""
+    phash = vision_cache.image_hash(image)
+    description = await vision_cache.lookup(phash)
+    if description is None:
+        await vision_cache.remember(phash, image)
+    return description
+
+
+async def settle():
+    await asyncio.gather(*vision_cache._background_tasks)
+
+
+@pytest.mark.parametrize("frames", [1, 2, 3])
+def test_one_describe_call_per_scene(tmp_path, monkeypatch, frames):
+    async def run():
+        calls = await setup_cache(tmp_path, monkeypatch)
+        results = []
+        for i in range(frames):
+            results.append(await send_frame(room(shift=2 * i, brightness=4 * i)))
+            await settle()
+        assert len(calls) == 1  # 何枚送っても説明文を作るのは最初の1回だけ
+        assert results[0] is None  # 1枚目は画像をそのまま送る
+        assert results[1:] == ["机とモニターがある部屋"] * (frames - 1)
+    asyncio.run(run())
+
+
+def test_no_second_describe_while_first_is_running(tmp_path, monkeypatch):
+    async def run():
+        gate = asyncio.Event()
+        calls = await setup_cache(tmp_path, monkeypatch, gate)
+        assert await send_frame(room()) is None
+        assert await send_frame(room(shift=2, brightness=8)) is None  # まだ説明文ができていない
+        assert len(calls) == 1
+        await send_frame(room(seed=1))  # 別の画像は別に作る
+        await asyncio.sleep(0.01)
+        assert len(calls) == 2
+
+        gate.set()
+        await settle()
+        assert await send_frame(room(brightness=4)) == "机とモニターがある部屋"
+        assert len(calls) == 2
+    asyncio.run(run())
+
+
+def test_failed_describe_can_retry(tmp_path, monkeypatch):
+    async def run():
+        calls = await setup_cache(tmp_path, monkeypatch)
+
+        async def broken(image_bytes, mime_type="image/jpeg"):
+            calls.append(image_bytes)
+            raise RuntimeError("quota exceeded")
+
+        monkeypatch.setattr(vision_cache, "describe_image", broken)
+        await send_frame(room())
+        await settle()
+        await send_frame(room())
+        await settle()
+        assert len(calls) == 2  # 作成中の印が残って止まったりしない
+    asyncio.run(run())
+
+
+def test_uploaded_photos_are_not_cached(tmp_path, monkeypatch):
+    async def run():
+        calls = await setup_cache(tmp_path, monkeypatch)
+        # アップロードされた写真（ハッシュなし）は何もしない
+        await vision_cache.remember(None, b"jpeg")
+        assert await vision_cache.lookup(None) is None
+        assert calls == []
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    # monkeypatch を使うので pytest で回す
+    raise SystemExit(pytest.main([__file__, "-q"]))